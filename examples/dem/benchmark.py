@@ -0,0 +1,69 @@
+"""
+Benchmark the GDAL / rasterio settings of the raster clip on the DEM tiles.
+
+Clips every tile to the reference area of an example, once for each of the
+settings below, and prints the time, the throughput and the output size.
+Run it in one of the example containers, so that the tool sources are at /src:
+
+    docker compose run --rm -v ./benchmark.py:/src/benchmark.py de210080_loader python benchmark.py
+
+"""
+
+import argparse
+import glob
+import json
+import shutil
+import time
+from pathlib import Path
+
+from loader import _rio_clip_raster
+from param import Params
+
+# GDAL defaults to a cache of 5% of the memory and a single thread, 'auto' is derived by the tool
+SETTINGS = {
+    "gdal-defaults": {"gdal_cache_mb": 64, "gdal_num_threads": 1},
+    "auto": {},
+    "auto, zstd": {"raster_compression": "zstd"},
+    "auto, uncompressed": {"raster_compression": "none"},
+    "auto, 256 blocks": {"raster_block_size": 256},
+    "auto, 1024 blocks": {"raster_block_size": 1024},
+}
+
+
+def benchmark(tiles: list[str], reference_area: dict, out_path: Path, settings: dict) -> tuple[float, float]:
+    params = Params(dataset_ids=[0], reference_area=reference_area, base_path=str(out_path), **settings)
+    out_path.mkdir(parents=True, exist_ok=True)
+
+    t1 = time.perf_counter()
+    for part, tile in enumerate(tiles, start=1):
+        _rio_clip_raster(tile, params, {fid: out_path / f"{fid}_part_{part}.tif" for fid in params.feature_ids})
+    t2 = time.perf_counter()
+
+    size = sum(p.stat().st_size for p in out_path.glob("*.tif"))
+    return t2 - t1, size / 2**20
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tiles", default="/data/raster/DEM/*.tif", help="glob of the DEM tiles")
+    parser.add_argument("--inputs", default="/in/inputs.json", help="inputs.json of the example holding the reference area")
+    parser.add_argument("--out", default="/tmp/loader_benchmark", help="directory for the clipped tiles, removed after each run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per setting, the fastest one is reported")
+    args = parser.parse_args()
+
+    tiles = sorted(glob.glob(args.tiles))
+    with open(args.inputs) as f:
+        reference_area = json.load(f)["vforwater_loader"]["parameters"]["reference_area"]
+    input_size = sum(Path(tile).stat().st_size for tile in tiles) / 2**20
+    print(f"{len(tiles)} tiles, {input_size:.1f} MiB\n")
+
+    print("| setting | seconds | tiles MiB/s | output MiB |")
+    print("|---|---|---|---|")
+    for name, settings in SETTINGS.items():
+        runs = []
+        for _ in range(args.repeat):
+            runs.append(benchmark(tiles, reference_area, Path(args.out), settings))
+            output_size = runs[-1][1]
+            shutil.rmtree(args.out)
+        seconds = min(run[0] for run in runs)
+        print(f"| {name} | {seconds:.2f} | {input_size / seconds:.1f} | {output_size:.1f} |")
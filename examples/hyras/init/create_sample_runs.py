@@ -57,6 +57,43 @@ def generate_input_data(hyras_ids: List[int], geojson_path: str = '/tool_init/in
         with open(in_folder / 'inputs.json', 'w') as f:
             json.dump(template, f, indent=4)
 
+def generate_collection_input_data(hyras_ids: list[int], geojson_path: str = '/tool_init/init/') -> None:
+    # find all geojson files
+    geojson_files = glob.glob(f'{geojson_path}/*.geojson')
+    out_path = Path(geojson_path).parent / 'all_catchments'
+
+    # create a single in and out folder for all catchments
+    in_folder = out_path / 'in'
+    in_folder.mkdir(parents=True, exist_ok=True)
+    out_folder = out_path / 'out'
+    out_folder.mkdir(parents=True, exist_ok=True)
+
+    # collect one feature per catchment, the id names the output folder
+    features = []
+    for geojson_file in tqdm(geojson_files):
+        with open(geojson_file) as f:
+            geojson = json.load(f)
+        feature = geojson['features'][0]
+        feature['id'] = Path(geojson_file).stem
+        features.append(feature)
+
+    # build the inputs.json template
+    template = {
+        'vforwater_loader': {
+            'parameters': {
+                'dataset_ids': hyras_ids,
+                'start_date': f"{os.getenv('START_YEAR', '2000')}-01-01T12:00:00+01",
+                'end_date': f"{os.getenv('END_YEAR', '2010')}-12-31T12:00:00+01",
+                'reference_area': {'type': 'FeatureCollection', 'features': features},
+            }
+        }
+    }
+
+    # write the template to the in folder
+    with open(in_folder / 'inputs.json', 'w') as f:
+        json.dump(template, f, indent=4)
+
+
 if __name__ == '__main__':
     print('Generating some example tool input parameter files for CAMELS-DE catchments using HYRAS-DE.')
     # TODO: here we could accept some args and download the camels catchments in the first place
@@ -66,5 +103,8 @@ if __name__ == '__main__':
     # get the ids of the hyras entries
     hyras_ids = load_hyras_ids(session)
 
-    # generate the input data
-    generate_input_data(hyras_ids)
+    # generate the input data, either one run per catchment or a single run for all catchments
+    if os.getenv('SINGLE_RUN', 'false').lower() == 'true':
+        generate_collection_input_data(hyras_ids)
+    else:
+        generate_input_data(hyras_ids)
@@ -0,0 +1,105 @@
+"""
+Area-weighted aggregation of gridded datasources per reference area feature.
+
+Instead of the clipped cube, the aggregation mode writes one value per time step
+and feature into a small table. Each cell is weighted by the fraction of it that
+is covered by the feature (see masks.py), and on geographic grids additionally
+by the cosine of its latitude, as the cell area shrinks towards the poles.
+The sum is weighted by the covered fraction only, while min and max consider all
+cells that are covered at least partially.
+The reductions run over both spatial dimensions at once, thus they are
+vectorised over the time axis and stay lazy for dask backed data.
+Raster tiles cover different parts of the same area, hence they are reduced to
+partial statistics per tile first, which are combined afterwards. Within a tile,
+the statistics are accumulated block by block, thus only one block is in memory.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from affine import Affine
+
+from masks import GridMask
+from param import Reducers
+
+
+def cell_weights(fractions: np.ndarray, transform: Affine, row_offset: int, geographic: bool) -> np.ndarray:
+    # on geographic grids, the cell area scales with the cosine of the latitude of the cell center
+    if not geographic:
+        return fractions
+    _, lat = transform * (np.full(fractions.shape[0], 0.5), np.arange(fractions.shape[0]) + row_offset + 0.5)
+    return fractions * np.cos(np.deg2rad(lat))[:, np.newaxis]
+
+
+def aggregate_region(region: xr.Dataset, grid_mask: GridMask, reducer: Reducers, transform: Affine, geographic: bool) -> xr.Dataset:
+    # only the variables on the grid can be reduced
+    dims = (grid_mask.y_dim, grid_mask.x_dim)
+    region = region[[name for name, var in region.data_vars.items() if all(dim in var.dims for dim in dims)]]
+
+    fractions = xr.DataArray(grid_mask.fractions, dims=dims)
+    if reducer == Reducers.MEAN:
+        weights = xr.DataArray(cell_weights(grid_mask.fractions, transform, grid_mask.rows.start, geographic), dims=dims)
+        reduced = region.weighted(weights).mean(dim=dims)
+    elif reducer == Reducers.SUM:
+        reduced = region.weighted(fractions).sum(dim=dims)
+    elif reducer == Reducers.MIN:
+        reduced = region.where(fractions > 0).min(dim=dims)
+    else:
+        reduced = region.where(fractions > 0).max(dim=dims)
+
+    # drop the leftover spatial coordinates, like the grid mapping
+    return reduced.drop_vars([name for name in reduced.coords if name not in reduced.dims])
+
+
+def region_to_frame(reduced: xr.Dataset, feature_id: str) -> pd.DataFrame:
+    # one row per time step, or a single row for sources without a time axis
+    if len(reduced.dims) == 0:
+        df = pd.DataFrame({name: [var.item()] for name, var in reduced.data_vars.items()})
+    else:
+        df = reduced.to_dataframe().reset_index()
+    df.insert(0, "feature_id", feature_id)
+    return df
+
+
+def raster_statistics(data: np.ndarray, nodata: float | None, fractions: np.ndarray, weights: np.ndarray) -> dict[str, np.ndarray]:
+    # partial statistics per band, which can be combined across tiles
+    values = data.astype("float64")
+    valid = (fractions > 0) & ~np.isnan(values)
+    if nodata is not None:
+        valid &= values != nodata
+    values = np.where(valid, values, 0.0)
+
+    return {
+        "weighted_sum": (values * weights).sum(axis=(1, 2)),
+        "weights": np.where(valid, weights, 0.0).sum(axis=(1, 2)),
+        "fraction_sum": (values * fractions).sum(axis=(1, 2)),
+        "min": np.where(valid, values, np.inf).min(axis=(1, 2)),
+        "max": np.where(valid, values, -np.inf).max(axis=(1, 2)),
+        "count": valid.sum(axis=(1, 2)),
+    }
+
+
+def merge_raster_statistics(first: dict[str, np.ndarray], second: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    # the partial statistics of two blocks of the same tile
+    merged = {key: first[key] + second[key] for key in ("weighted_sum", "weights", "fraction_sum", "count")}
+    merged["min"] = np.minimum(first["min"], second["min"])
+    merged["max"] = np.maximum(first["max"], second["max"])
+    return merged
+
+
+def combine_raster_statistics(statistics: list[dict[str, np.ndarray]], reducer: Reducers) -> np.ndarray:
+    # combine the partial statistics of all tiles into one value per band
+    total = {key: np.sum([s[key] for s in statistics], axis=0) for key in ("weighted_sum", "weights", "fraction_sum", "count")}
+    empty = total["count"] == 0
+
+    if reducer == Reducers.MEAN:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = total["weighted_sum"] / total["weights"]
+    elif reducer == Reducers.SUM:
+        values = total["fraction_sum"]
+    elif reducer == Reducers.MIN:
+        values = np.min([s["min"] for s in statistics], axis=0)
+    else:
+        values = np.max([s["max"] for s in statistics], axis=0)
+
+    return np.where(empty, np.nan, values)
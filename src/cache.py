@@ -0,0 +1,215 @@
+"""
+A content-addressed cache for the clipped outputs of file datasources.
+
+The cache key is built from the entry, the identities (path, size, mtime) of all
+datasource files, a hash of the reference area and all parameters that change
+the output. On a hit, the cached files are copied into the dataset folder
+instead of loading and clipping the source again. The files are copied, not
+hard-linked, in both directions, thus editing an output in place never changes
+the cached result. The cache is
+capped in size and evicts the least recently used results first.
+Database sources are never cached, as their content is not versioned.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from json2args.logger import logger
+from metacatalog_api.models import Metadata
+
+from param import Params
+
+MANIFEST_NAME = "manifest.json"
+
+# parameters that do not change the output of an entry
+RUNTIME_FIELDS = {
+    "dataset_ids",
+    "reference_area",
+    "base_path",
+    "io_workers",
+    "cpu_workers",
+    "netcdf_parallel",
+    "simplify_reference_area",
+    "use_file_index",
+    "index_path",
+    "csv_time_index",
+    "sql_batch_size",
+    "sql_partitions",
+    "dask_chunk_size",
+    "dask_scheduler",
+    "dask_workers",
+    "dask_scheduler_address",
+    "gdal_cache_mb",
+    "gdal_num_threads",
+    "netcdf_chunk_cache_mb",
+    "cache_path",
+    "cache_max_size_mb",
+}
+
+
+def _copy(src: Path, dst: Path):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists():
+        dst.unlink()
+    shutil.copy2(src, dst)
+
+
+def _datasource_files(entry: Metadata) -> list[str]:
+    path = entry.datasource.path
+    if "*" in path:
+        return sorted(glob.glob(path))
+    elif Path(path).is_dir():
+        return sorted(str(p) for p in Path(path).rglob("*") if p.is_file())
+    elif Path(path).exists():
+        return [path]
+    return []
+
+
+class ResultCache:
+    def __init__(self, cache_path: str, max_size_mb: int):
+        self.cache_path = Path(cache_path)
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024
+
+        # statistics for the report
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def key(self, entry: Metadata, params: Params) -> str | None:
+        if entry.datasource is None or entry.datasource.type.name in ("internal", "external"):
+            return None
+
+        files = _datasource_files(entry)
+        if len(files) == 0:
+            return None
+
+        # the identity of each source file
+        identities = []
+        for fname in files:
+            stat = os.stat(fname)
+            identities.append((str(Path(fname).resolve()), stat.st_size, stat.st_mtime))
+
+        reference_area = None
+        if params.reference_area is not None:
+            reference_area = hashlib.sha256(json.dumps(params.reference_area, sort_keys=True).encode()).hexdigest()
+
+        payload = {
+            "entry_id": entry.id,
+            "datasource": entry.datasource.model_dump(mode="json"),
+            "files": identities,
+            "reference_area": reference_area,
+            "options": params.model_dump(mode="json", exclude=RUNTIME_FIELDS),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+    def restore(self, key: str, dataset_path: Path) -> str | None:
+        item = self.cache_path / key
+        manifest_file = item / MANIFEST_NAME
+        if not manifest_file.exists():
+            with self._lock:
+                self.misses += 1
+            return None
+
+        t1 = time.time()
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        for name in manifest["files"]:
+            _copy(item / "files" / name, dataset_path / name)
+
+        # mark the result as recently used
+        manifest["last_used"] = time.time()
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f)
+
+        with self._lock:
+            self.hits += 1
+        logger.info(f"Cache hit for dataset <ID={manifest['entry_id']}>: restored {len(manifest['files'])} files in {time.time() - t1:.2f} seconds.")
+
+        # loaders return either absolute paths or names relative to the dataset path, one per feature for many features
+        data_paths = [str(dataset_path / name) if manifest["absolute"] else name for name in manifest["data_path"]]
+        return data_paths if manifest["multi_feature"] else data_paths[0]
+
+    def store(self, key: str, entry: Metadata, data_path: str | list[str], dataset_path: Path):
+        data_paths = data_path if isinstance(data_path, list) else [data_path]
+        outs = [dataset_path / name for name in data_paths]
+        if not all(out.exists() for out in outs):
+            return
+
+        # collect the output files and the metadata files
+        outputs = []
+        for out in outs:
+            if out.is_dir():
+                outputs.extend(p for p in out.rglob("*") if p.is_file())
+            else:
+                outputs.append(out)
+            metafile = out.parent / f"{out.name}.metadata.json"
+            if metafile.exists():
+                outputs.append(metafile)
+        names = [str(p.relative_to(dataset_path)) for p in outputs]
+
+        # write into a temporary folder first, so that a partial result is never used
+        item = self.cache_path / key
+        tmp_item = self.cache_path / f"{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_item, ignore_errors=True)
+        for name in names:
+            _copy(dataset_path / name, tmp_item / "files" / name)
+
+        manifest = {
+            "entry_id": entry.id,
+            "data_path": [str(out.relative_to(dataset_path)) for out in outs],
+            "absolute": Path(data_paths[0]).is_absolute(),
+            "multi_feature": isinstance(data_path, list),
+            "files": names,
+            "size": sum(p.stat().st_size for p in outputs),
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+        with open(tmp_item / MANIFEST_NAME, "w") as f:
+            json.dump(manifest, f)
+
+        shutil.rmtree(item, ignore_errors=True)
+        os.replace(tmp_item, item)
+        with self._lock:
+            self.stored += 1
+        logger.debug(f"Stored {len(names)} files of dataset <ID={entry.id}> in the cache as {key}.")
+
+    def evict(self):
+        # load all manifests and remove the least recently used results until the cache fits
+        items = []
+        for manifest_file in self.cache_path.glob(f"*/{MANIFEST_NAME}"):
+            try:
+                with open(manifest_file) as f:
+                    manifest = json.load(f)
+                items.append((manifest["last_used"], manifest["size"], manifest_file.parent))
+            except Exception as e:
+                logger.warning(f"Removing the unreadable cache item {manifest_file.parent}: {str(e)}")
+                shutil.rmtree(manifest_file.parent, ignore_errors=True)
+
+        total = sum(size for _, size, _ in items)
+        for _, size, item in sorted(items):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(item, ignore_errors=True)
+            total -= size
+            self.evicted += 1
+
+        return total
+
+    def report(self) -> str:
+        total = self.evict()
+        msg = (
+            f"Result cache at {self.cache_path}: {self.hits} hits, {self.misses} misses, {self.stored} results stored, "
+            f"{self.evicted} evicted. Cache size {total / 1024 / 1024:.1f} of {self.max_size / 1024 / 1024:.0f} MB."
+        )
+        logger.info(msg)
+        return msg
@@ -0,0 +1,140 @@
+"""
+GDAL / rasterio and netCDF runtime settings of the loader.
+
+With the default settings, GDAL uses a block cache of 5% of the memory in every
+worker process, compresses on a single thread and the netCDF library keeps a
+small chunk cache per variable. ``io_environment`` sets the GDAL block cache, the
+number of GDAL threads and the netCDF chunk cache for the duration of a task.
+Unless set in the parameters, they are derived from the available cores and
+memory, which are shared by all CPU workers. ``geotiff_options`` holds the
+creation options of all GeoTIFF outputs.
+"""
+
+import os
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio as rio
+from json2args.logger import logger
+
+from param import Params, RasterCompressions
+from scheduler import default_cpu_workers
+
+# share of the memory used for the GDAL block cache and the netCDF chunk cache, split across the CPU workers
+# initial values, not yet validated on the DEM tile sets, see the benchmark in examples/dem/README.md
+GDAL_CACHE_SHARE = 0.25
+NETCDF_CACHE_SHARE = 0.05
+
+# the chunk cache of the netCDF library before the first running task changed it
+_CHUNK_CACHE_LOCK = threading.Lock()
+_chunk_cache_users = 0
+_previous_chunk_cache: tuple[int, int, float] | None = None
+
+
+def available_memory() -> int:
+    # the limit of the container, if there is one, or the physical memory
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+            if limit.isdigit() and int(limit) < 2**60:
+                return int(limit)
+        except OSError:
+            continue
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _workers(params: Params) -> int:
+    return params.cpu_workers if params.cpu_workers is not None else default_cpu_workers()
+
+
+def gdal_cache_mb(params: Params) -> int:
+    if params.gdal_cache_mb is not None:
+        return params.gdal_cache_mb
+    return int(np.clip(available_memory() * GDAL_CACHE_SHARE / _workers(params) / 2**20, 64, 2048))
+
+
+def gdal_num_threads(params: Params) -> int:
+    # the CPU workers run in parallel, thus each one gets its share of the cores
+    if params.gdal_num_threads is not None:
+        return params.gdal_num_threads
+    return max(1, (os.cpu_count() or 1) // _workers(params))
+
+
+def netcdf_chunk_cache_mb(params: Params) -> int:
+    if params.netcdf_chunk_cache_mb is not None:
+        return params.netcdf_chunk_cache_mb
+    return int(np.clip(available_memory() * NETCDF_CACHE_SHARE / _workers(params) / 2**20, 32, 512))
+
+
+def gdal_options(params: Params) -> dict[str, int]:
+    # GDAL reads a cache size below 100000 as megabytes
+    return {"GDAL_CACHEMAX": gdal_cache_mb(params), "GDAL_NUM_THREADS": gdal_num_threads(params)}
+
+
+def geotiff_options(params: Params, dtype: str) -> dict:
+    # the creation options of tiled GeoTIFF outputs, as rasterio profile keys
+    options = {
+        "driver": "GTiff",
+        "tiled": True,
+        "blockxsize": params.raster_block_size,
+        "blockysize": params.raster_block_size,
+        "compress": params.raster_compression.value,
+        "bigtiff": "IF_SAFER",
+        "num_threads": gdal_num_threads(params),
+    }
+    if params.raster_compression != RasterCompressions.NONE and params.raster_predictor:
+        options["predictor"] = 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+    return options
+
+
+def cog_options(params: Params) -> list[str]:
+    # the same settings as creation options of the GDAL COG driver, which always tiles and picks the predictor itself
+    options = [f"COMPRESS={params.raster_compression.value.upper()}", f"BLOCKSIZE={params.raster_block_size}", "BIGTIFF=IF_SAFER", f"NUM_THREADS={gdal_num_threads(params)}"]
+    if params.raster_compression != RasterCompressions.NONE and params.raster_predictor:
+        options.append("PREDICTOR=YES")
+    return options
+
+
+def describe_environment(params: Params) -> str:
+    # the effective settings, logged along with each output
+    return (
+        f"GDAL_CACHEMAX={gdal_cache_mb(params)}MB, GDAL_NUM_THREADS={gdal_num_threads(params)}, netCDF chunk cache={netcdf_chunk_cache_mb(params)}MB, "
+        f"COMPRESS={params.raster_compression.value}, BLOCKSIZE={params.raster_block_size}, PREDICTOR={params.raster_predictor}"
+    )
+
+
+@contextmanager
+def _netcdf_chunk_cache(size: int) -> Iterator[None]:
+    # the chunk cache is global to the process, thus the first of several concurrent tasks sets it and the last one restores it
+    global _chunk_cache_users, _previous_chunk_cache
+    try:
+        import netCDF4
+    except ImportError:
+        logger.debug("The netCDF4 library is not installed, the netCDF chunk cache is not set.")
+        yield
+        return
+
+    with _CHUNK_CACHE_LOCK:
+        if _chunk_cache_users == 0:
+            _previous_chunk_cache = netCDF4.get_chunk_cache()
+            _, nelems, preemption = _previous_chunk_cache
+            netCDF4.set_chunk_cache(size, nelems, preemption)
+        _chunk_cache_users += 1
+    try:
+        yield
+    finally:
+        with _CHUNK_CACHE_LOCK:
+            _chunk_cache_users -= 1
+            if _chunk_cache_users == 0:
+                netCDF4.set_chunk_cache(*_previous_chunk_cache)
+
+
+@contextmanager
+def io_environment(params: Params) -> Iterator[dict[str, int]]:
+    # the netCDF chunk cache applies to all files opened in this process until the task is finished
+    options = gdal_options(params)
+    with _netcdf_chunk_cache(netcdf_chunk_cache_mb(params) * 2**20), rio.Env(**options):
+        yield options
@@ -0,0 +1,377 @@
+"""
+A persistent spatio-temporal index for multi-file datasources.
+
+For wildcard and directory datasources, the loader used to open every single
+file, just to find out if it overlaps the requested time range or reference area.
+The FileIndex stores the bounding box, CRS, time range and shape of each file in a
+sidecar JSON file next to the data. A record is only rebuilt if the size or
+modification time of the file changed, thus the files are opened once.
+If the data directory is not writeable, the index can be redirected to
+``Params.index_path`` instead. Datasets loaded concurrently may share an index
+file, thus the new records are merged into the index on disk under a lock.
+
+For sorted CSV files, the CSVTimeIndex maps sampled timestamps to byte offsets.
+Then, only the byte range covering the requested period has to be read.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+import rasterio as rio
+import rioxarray
+import xarray as xr
+from json2args.logger import logger
+
+from param import Params
+
+INDEX_FILE_NAME = ".loader_index.json"
+INDEX_VERSION = 1
+
+# a timestamp is sampled for every n-th row of a CSV file
+CSV_INDEX_SAMPLE_ROWS = 1000
+
+# one lock per index file, held while the index on disk is merged and replaced
+_INDEX_LOCKS: dict[Path, threading.Lock] = {}
+_INDEX_LOCKS_LOCK = threading.Lock()
+
+
+def _index_lock(index_file: Path) -> threading.Lock:
+    with _INDEX_LOCKS_LOCK:
+        return _INDEX_LOCKS.setdefault(index_file.resolve(), threading.Lock())
+
+
+def _index_location(path: Path, file_name: str, params: Params) -> Path:
+    # index files are stored next to the data, or in the index_path if given
+    if params.index_path is not None:
+        digest = hashlib.sha1(str(path / file_name).encode()).hexdigest()
+        return Path(params.index_path) / f"{digest}.json"
+    return path / file_name
+
+
+def _write_json(target: Path, content: dict):
+    # write to a temporary file first, so that concurrent readers never see a partial index
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp_file, target)
+
+
+class FileIndex:
+    def __init__(self, index_file: Path | None, base_dir: Path):
+        self.index_file = index_file
+        self.base_dir = base_dir
+        self.records: dict[str, dict] = self._load()
+
+        # the records built by this instance, which are merged into the index on disk
+        self._updated: dict[str, dict] = {}
+
+    def _load(self) -> dict[str, dict]:
+        # load an existing index, without an index file, the records only live in memory
+        if self.index_file is None or not self.index_file.exists():
+            return {}
+        try:
+            with open(self.index_file) as f:
+                content = json.load(f)
+            if content.get("version") == INDEX_VERSION:
+                return content.get("files", {})
+        except Exception as e:
+            logger.warning(f"Could not read the file index {self.index_file}. It will be rebuilt. Error: {str(e)}")
+        return {}
+
+    @classmethod
+    def for_files(cls, fnames: list[str], params: Params) -> "FileIndex":
+        # the index is stored for the common parent directory of all files
+        base_dir = Path(os.path.commonpath([str(Path(name).resolve().parent) for name in fnames]))
+
+        if not params.use_file_index:
+            index_file = None
+        else:
+            index_file = _index_location(base_dir, INDEX_FILE_NAME, params)
+
+        return cls(index_file, base_dir)
+
+    def _key(self, fname: str) -> str:
+        return os.path.relpath(Path(fname).resolve(), self.base_dir)
+
+    def record(self, fname: str, kind: str, time_dim: str | None = None, read_args: dict | None = None) -> dict:
+        key = self._key(fname)
+        stat = os.stat(fname)
+
+        # check if the record is still valid
+        rec = self.records.get(key)
+        if rec is not None and rec["mtime"] == stat.st_mtime and rec["size"] == stat.st_size and rec["kind"] == kind and rec["time_dim"] == time_dim:
+            return rec
+
+        # build a new record
+        if kind == "netcdf":
+            rec = _netcdf_record(fname, time_dim)
+        elif kind == "raster":
+            rec = _raster_record(fname)
+        elif kind == "csv":
+            rec = _csv_record(fname, time_dim, read_args or {})
+        else:
+            raise ValueError(f"Unknown file kind '{kind}' for the file index.")
+        rec.update(mtime=stat.st_mtime, size=stat.st_size, kind=kind, time_dim=time_dim)
+
+        self.records[key] = rec
+        self._updated[key] = rec
+        return rec
+
+    def save(self):
+        if self.index_file is None or len(self._updated) == 0:
+            return
+
+        # another dataset might have saved records of other files in the meantime, thus they are merged
+        try:
+            with _index_lock(self.index_file):
+                records = self._load()
+                records.update(self._updated)
+                _write_json(self.index_file, {"version": INDEX_VERSION, "files": records})
+            self.records = records
+            self._updated = {}
+            logger.debug(f"Saved the file index with {len(records)} records to {self.index_file}.")
+        except OSError as e:
+            logger.warning(f"Could not save the file index to {self.index_file}. Set 'index_path' to a writeable location. Error: {str(e)}")
+
+
+def _timestamp_or_none(value) -> str | None:
+    if value is None or pd.isnull(value):
+        return None
+    return pd.Timestamp(value).isoformat()
+
+
+def _netcdf_record(fname: str, time_dim: str | None) -> dict:
+    with xr.open_dataset(fname, decode_coords="all", mask_and_scale=True) as ds:
+        time_min = time_max = None
+        if time_dim is not None and time_dim in ds.coords:
+            time_min = _timestamp_or_none(ds[time_dim].min().values)
+            time_max = _timestamp_or_none(ds[time_dim].max().values)
+
+        # not every file has a CRS or detectable spatial dimensions
+        try:
+            bbox = list(ds.rio.bounds())
+        except Exception:
+            bbox = None
+        crs = ds.rio.crs.to_wkt() if ds.rio.crs is not None else None
+
+        return {"time_min": time_min, "time_max": time_max, "bbox": bbox, "crs": crs, "shape": dict(ds.sizes)}
+
+
+def _raster_record(fname: str) -> dict:
+    with rio.open(fname, "r") as src:
+        return {
+            "time_min": None,
+            "time_max": None,
+            "bbox": list(src.bounds),
+            "crs": src.crs.to_wkt() if src.crs is not None else None,
+            "shape": {"band": src.count, "y": src.height, "x": src.width},
+        }
+
+
+def _csv_record(fname: str, time_dim: str | None, read_args: dict) -> dict:
+    time_min = time_max = None
+    rows = None
+    if time_dim is not None:
+        # only parse the timestamp column
+        args = {k: v for k, v in read_args.items() if k not in ("usecols", "parse_dates")}
+        df = pd.read_csv(fname, usecols=[time_dim], **args)
+        tstamps = pd.to_datetime(df[time_dim])
+        time_min = _timestamp_or_none(tstamps.min())
+        time_max = _timestamp_or_none(tstamps.max())
+        rows = len(df)
+
+    return {"time_min": time_min, "time_max": time_max, "bbox": None, "crs": None, "shape": {"rows": rows}}
+
+
+def _localize(value: str, like) -> pd.Timestamp:
+    # compare the file times in the timezone of the requested dates, like the loaders do
+    ts = pd.Timestamp(value)
+    tz = getattr(like, "tzinfo", None)
+    if ts.tzinfo is None:
+        return ts.tz_localize(tz)
+    elif tz is None:
+        return ts.tz_convert("UTC").tz_localize(None)
+    return ts
+
+
+def overlaps_time(record: dict, params: Params) -> bool:
+    if record.get("time_min") is None or record.get("time_max") is None:
+        return True
+    if params.start_date is not None and params.start_date > _localize(record["time_max"], params.start_date):
+        return False
+    if params.end_date is not None and params.end_date < _localize(record["time_min"], params.end_date):
+        return False
+    return True
+
+
+def overlaps_area(record: dict, reference_area: gpd.GeoDataFrame | None) -> bool:
+    if reference_area is None or record.get("bbox") is None:
+        return True
+
+    # GeoJSON reference areas are always WGS84
+    ref = reference_area if reference_area.crs is not None else reference_area.set_crs(4326)
+    if record.get("crs") is not None:
+        ref = ref.to_crs(record["crs"])
+
+    bminx, bminy, bmaxx, bmaxy = record["bbox"]
+
+    # the file bounds might be flipped, if the y axis is ascending
+    bminy, bmaxy = min(bminy, bmaxy), max(bminy, bmaxy)
+
+    # the file is needed if it overlaps any of the features
+    bounds = ref.bounds
+    overlaps = ~((bounds.maxx < bminx) | (bounds.minx > bmaxx) | (bounds.maxy < bminy) | (bounds.miny > bmaxy))
+    return bool(overlaps.any())
+
+
+class CSVTimeIndex:
+    """
+    Byte-offset index of a CSV file sorted by its timestamp column.
+    Only plain line-based CSV files are supported, i.e. no quoted line breaks.
+    """
+
+    def __init__(self, fname: str, header: bytes, samples: list[tuple[pd.Timestamp, int]], data_start: int, size: int):
+        self.fname = fname
+        self.header = header
+        self.samples = samples
+        self.data_start = data_start
+        self.size = size
+
+    @classmethod
+    def load_or_build(cls, fname: str, time_col: str, separator: str, params: Params) -> "CSVTimeIndex":
+        path = Path(fname).resolve()
+        index_file = _index_location(path.parent, f"{path.name}.tidx.json", params)
+        stat = os.stat(fname)
+
+        # try to use an existing index, it is invalidated by size and mtime
+        if index_file.exists():
+            try:
+                with open(index_file) as f:
+                    content = json.load(f)
+                if content["version"] == INDEX_VERSION and content["size"] == stat.st_size and content["mtime"] == stat.st_mtime and content["time_col"] == time_col:
+                    samples = [(pd.Timestamp(ts), offset) for ts, offset in content["samples"]]
+                    return cls(fname, content["header"].encode(), samples, content["data_start"], content["size"])
+            except Exception as e:
+                logger.debug(f"Could not read the CSV time index {index_file}. It will be rebuilt. Error: {str(e)}")
+
+        index = cls.build(fname, time_col, separator)
+        try:
+            _write_json(
+                index_file,
+                {
+                    "version": INDEX_VERSION,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                    "time_col": time_col,
+                    "header": index.header.decode(),
+                    "data_start": index.data_start,
+                    "samples": [(ts.isoformat(), offset) for ts, offset in index.samples],
+                },
+            )
+        except OSError as e:
+            logger.warning(f"Could not save the CSV time index to {index_file}. Set 'index_path' to a writeable location. Error: {str(e)}")
+
+        return index
+
+    @classmethod
+    def build(cls, fname: str, time_col: str, separator: str) -> "CSVTimeIndex":
+        t1 = time.time()
+        samples = []
+        with open(fname, "rb") as f:
+            header = f.readline()
+            column = _column_position(header, time_col, separator)
+            data_start = f.tell()
+
+            offset = data_start
+            last = None
+            for row, line in enumerate(iter(f.readline, b"")):
+                if row % CSV_INDEX_SAMPLE_ROWS == 0:
+                    samples.append((_parse_timestamp(line, column, separator), offset))
+                last = (line, offset)
+                offset += len(line)
+
+            # always sample the last row, so that the time range is known
+            if last is not None and samples[-1][1] != last[1]:
+                samples.append((_parse_timestamp(last[0], column, separator), last[1]))
+
+        t2 = time.time()
+        logger.debug(f"Built the CSV time index for {fname} with {len(samples)} samples in {t2 - t1:.2f} seconds.")
+        return cls(fname, header, samples, data_start, offset)
+
+    @property
+    def time_min(self) -> pd.Timestamp | None:
+        return self.samples[0][0] if len(self.samples) > 0 else None
+
+    @property
+    def time_max(self) -> pd.Timestamp | None:
+        return self.samples[-1][0] if len(self.samples) > 0 else None
+
+    def byte_range(self, start: datetime | None, end: datetime | None) -> tuple[int, int]:
+        # begin at the last sample before start, all rows >= start follow it
+        begin = self.data_start
+        if start is not None:
+            earlier = [offset for ts, offset in self.samples if ts < start]
+            if len(earlier) > 0:
+                begin = earlier[-1]
+
+        # stop at the first sample after end
+        stop = self.size
+        if end is not None:
+            later = [offset for ts, offset in self.samples if ts > end]
+            if len(later) > 0:
+                stop = later[0]
+
+        return begin, stop
+
+    def read_bytes(self, start: datetime | None, end: datetime | None) -> bytes:
+        begin, stop = self.byte_range(start, end)
+        with open(self.fname, "rb") as f:
+            f.seek(begin)
+            chunk = f.read(max(stop - begin, 0))
+
+        logger.debug(f"Read {len(chunk)} of {self.size} bytes from {self.fname} using the CSV time index.")
+        return self.header + chunk
+
+
+def _column_position(header: bytes, time_col: str, separator: str) -> int:
+    names = [name.strip().strip('"') for name in header.decode().rstrip("\r\n").split(separator)]
+    return names.index(time_col)
+
+
+def _parse_timestamp(line: bytes, column: int, separator: str) -> pd.Timestamp:
+    value = line.decode().rstrip("\r\n").split(separator)[column].strip().strip('"')
+    ts = pd.Timestamp(value)
+
+    # the loader compares timestamps without timezone in UTC
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert("UTC").tz_localize(None)
+    return ts
+
+
+def csv_first_last_timestamps(fname: str, time_col: str, separator: str) -> tuple[pd.Timestamp | None, pd.Timestamp | None]:
+    # read only the first and the last row of a sorted CSV file
+    with open(fname, "rb") as f:
+        column = _column_position(f.readline(), time_col, separator)
+        first = f.readline()
+        if first.strip() == b"":
+            return None, None
+
+        # go back from the end of the file until the last full line is found
+        size = f.seek(0, os.SEEK_END)
+        block = min(size, 4096)
+        while True:
+            f.seek(size - block)
+            lines = f.read(block).rstrip(b"\r\n").splitlines()
+            if len(lines) > 1 or block == size:
+                break
+            block = min(size, block * 2)
+
+    return _parse_timestamp(first, column, separator), _parse_timestamp(lines[-1], column, separator)
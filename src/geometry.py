@@ -0,0 +1,84 @@
+"""
+Preparation of the reference area geometries for clipping.
+
+The reference area is given as GeoJSON in WGS84, while the datasources come in
+their own CRS. The features are reprojected once per target CRS and kept for the
+lifetime of the process. All geometries are prepared, thus repeated intersection
+tests against them are fast.
+Optionally, detailed polygons are simplified to a tolerance derived from the cell
+size of the grid, as vertices far below the grid resolution only slow down the
+rasterisation. The simplified geometry is never used on its own: cells close to
+its boundary are decided against the exact geometry (see masks.py), thus the
+simplification does not change which cells are selected.
+"""
+
+import hashlib
+import json
+import threading
+
+import shapely
+from json2args.logger import logger
+from pyproj import CRS
+from shapely.geometry.base import BaseGeometry
+
+from param import Params
+
+# the simplification tolerance as a fraction of the cell size, has to stay below one cell (see masks.py)
+SIMPLIFY_CELL_FRACTION = 0.25
+
+# features with fewer vertices are not worth simplifying
+SIMPLIFY_MIN_VERTICES = 1000
+
+_GEOMETRIES: dict[tuple, dict[str, "ReferenceGeometry"]] = {}
+_GEOMETRIES_LOCK = threading.Lock()
+
+
+class ReferenceGeometry:
+    def __init__(self, feature_id: str, exact: BaseGeometry, tolerance: float = 0.0):
+        self.feature_id = feature_id
+        self.exact = exact
+        self.tolerance = tolerance
+        self.geometry = exact.simplify(tolerance, preserve_topology=True) if tolerance > 0 else exact
+
+        # identifies the geometry in its CRS along with the simplification, used to cache masks
+        self.key = f"{hashlib.sha1(exact.wkb).hexdigest()}-{tolerance!r}"
+
+        shapely.prepare(self.exact)
+        shapely.prepare(self.geometry)
+
+    @property
+    def simplified(self) -> bool:
+        return self.tolerance > 0
+
+
+def reference_geometries(params: Params, crs=4326, cell_size: float | None = None) -> dict[str, ReferenceGeometry]:
+    if params.reference_area is None:
+        return {}
+
+    # the cell size is only needed to simplify the geometries
+    crs = CRS.from_user_input(crs)
+    tolerance = abs(cell_size) * SIMPLIFY_CELL_FRACTION if params.simplify_reference_area and cell_size else 0.0
+
+    area_hash = hashlib.sha1(json.dumps(params.reference_area, sort_keys=True).encode()).hexdigest()
+    key = (area_hash, crs.to_wkt(), tolerance)
+    with _GEOMETRIES_LOCK:
+        if key in _GEOMETRIES:
+            return _GEOMETRIES[key]
+
+    # reproject the features into the target CRS
+    ref = params.reference_area_df
+    if not crs.equals(ref.crs):
+        ref = ref.to_crs(crs)
+        logger.debug(f"Reprojected {len(ref)} reference area features to {crs.name}.")
+
+    geometries = {}
+    for fid, exact in ref.geometry.items():
+        n_vertices = shapely.get_num_coordinates(exact)
+        geometries[fid] = ReferenceGeometry(fid, exact, tolerance if n_vertices >= SIMPLIFY_MIN_VERTICES else 0.0)
+        if geometries[fid].simplified:
+            logger.debug(f"Simplified the feature '{fid}' from {n_vertices} to {shapely.get_num_coordinates(geometries[fid].geometry)} vertices (tolerance: {tolerance:g}).")
+
+    with _GEOMETRIES_LOCK:
+        _GEOMETRIES[key] = geometries
+
+    return geometries
@@ -1,31 +1,45 @@
+import contextlib
 import glob
-import subprocess
-import sys
 import os
+import shutil
+import subprocess
 import time
-from concurrent.futures import Executor
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
-import geopandas as gpd
+import dask
+import numpy as np
 import pandas as pd
 import polars as pl
 import rasterio as rio
 import rioxarray
+import shapely
 import xarray as xr
 from json2args.logger import logger
 from metacatalog_api import core
 from metacatalog_api.models import Metadata
-
+from rasterio.windows import Window
+from sqlalchemy import Engine, text
+
+from aggregate import aggregate_region, cell_weights, combine_raster_statistics, merge_raster_statistics, raster_statistics, region_to_frame
+from environment import cog_options, describe_environment, gdal_options, geotiff_options, io_environment
+from file_index import CSVTimeIndex, FileIndex, csv_first_last_timestamps, overlaps_area, overlaps_time
+from geometry import reference_geometries
+from masks import coverage_fractions, get_grid_mask, union_window, window_mask
 from param import Params
-from utils import whitebox_log_handler, parse_catchment_id
-from writer import dispatch_save_file, entry_metadata_saver, xarray_to_netcdf_saver
-
-sys.path.append("/whitebox/")
-from WBT.whitebox_tools import WhiteboxTools
+from query import build_select, get_engine, time_windows
+from raster import build_mosaic, clip_raster_blocks, fill_value
+from sampling import sample_points
+from scheduler import Scheduler, dask_config, default_cpu_workers
+from temporal import CDO_PERIODS, PANDAS_FREQUENCIES, resample_pandas, resample_polars, resample_xarray
+from utils import parse_catchment_id, reference_area_ascii_path
+from writer import dataframe_batches_saver, dataframe_to_csv_saver, dispatch_save_file, entry_metadata_saver, xarray_to_netcdf_saver, xarray_to_parquet_saver, xarray_to_zarr_saver
 
 
 # Maybe this function becomes part of metacatalog core or a metacatalog extension
-def load_entry_data(entry: Metadata, executor: Executor, params: Params) -> str | None:
+def load_entry_data(entry: Metadata, executor: Scheduler, params: Params) -> str | list[str] | None:
     if entry.datasource is None:
         raise ValueError("Entry datasource is not set.")
 
@@ -42,49 +56,105 @@ def load_entry_data(entry: Metadata, executor: Executor, params: Params) -> str
     return data_path
 
 
-def load_sql_source(entry: Metadata, executor: Executor, params: Params) -> str:
+def load_sql_source(entry: Metadata, executor: Scheduler, params: Params) -> str:
     if entry.datasource is None:
         raise ValueError("Entry datasource is not set.")
 
-    # if the source is external, we can't use it right now, as it is not clear
-    # yet if the Datasource.path is the connection or the path inside the database
+    # external sources put the table behind the connection URI, like: postgresql://user@host:5432/db#schema.table
     if entry.datasource.type.name == "external":
-        raise NotImplementedError("External database datasources are not supported yet.")
+        uri, _, table = entry.datasource.path.partition("#")
+        if table == "":
+            raise ValueError(f"The external datasource path of <ID={entry.id}> has to name the table after the connection URI, like 'postgresql://host/db#table'.")
+    else:
+        with core.connect() as session:
+            uri = session.bind.url.render_as_string(hide_password=False)
+        table = entry.datasource.path
 
-    # build the query
-    columns = entry.datasource.variable_names
-    if entry.datasource.temporal_scale is not None:
-        columns = [*entry.datasource.temporal_scale.dimension_names, *columns]
-    if entry.datasource.spatial_scale is not None:
-        columns = [*columns, *entry.datasource.spatial_scale.dimension_names]
-    if len(columns) == 0:
-        columns = ["*"]
+    # each database URI has one connection pool, shared by the partitions of all datasets loaded concurrently
+    engine = get_engine(uri, pool_size=executor.io_workers * max(params.sql_partitions, 1))
+    args = entry.datasource.args or {}
+    filename = f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
 
-    sql = f"SELECT {', '.join(columns)} FROM {entry.datasource.path} "
-    if entry.datasource.temporal_scale is not None:
-        if params.start_date is not None or params.end_date is not None:
-            dim_name = entry.datasource.temporal_scale.dimension_names[0]
-            filt = []
-            if params.start_date is not None:
-                filt.append(f"{dim_name} >= '{params.start_date}'")
-            if params.end_date is not None:
-                filt.append(f"{dim_name} <= '{params.end_date}'")
-            sql += f" WHERE {' AND '.join(filt)}"
+    # split long time ranges into time windows, which are queried concurrently
+    windows = time_windows(entry, params, engine, table, params.sql_partitions)
+    if len(windows) > 1:
+        return _load_sql_partitions(entry, engine, table, windows, params)
+
+    # build the query, the time range and reference area are passed as bound parameters
+    sql, bind = build_select(entry, params, engine, table=table)
+    logger.info(f"SQL - {sql}")
+
+    target_name = f"{filename}.csv"
 
-    with core.connect() as session:
-        data = pl.read_database(query=sql, connection=session.bind, **entry.datasource.args)
+    # in streaming mode, the result is written batch by batch while it is read from the database
+    if params.sql_batch_size is not None:
+        target_path = params.dataset_path / target_name
+        batches = _iter_sql_batches(engine, sql, bind, params.sql_batch_size, args)
+        dataframe_batches_saver(batches, str(target_path))
+
+        metafile_name = f"{target_path}.metadata.json"
+        entry_metadata_saver(entry, metafile_name)
+        logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
+        return target_name
+
+    data = pl.read_database(query=sql, connection=engine, execute_options={"parameters": bind}, **args)
 
     # dispatch a save task for the data
-    target_name = f"{entry.variable.name.replace(' ', '_')}_{entry.id}.csv"
     dispatch_save_file(entry=entry, data=data, executor=executor, base_path=str(params.dataset_path), target_name=target_name, save_meta=True)
     return target_name
 
 
+def _load_sql_partitions(entry: Metadata, engine: Engine, table: str, windows: list[tuple], params: Params) -> str:
+    args = entry.datasource.args or {}
+    filename = f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
+    dataset_base_path = params.dataset_path / filename
+    dataset_base_path.mkdir(parents=True, exist_ok=True)
+
+    def read_partition(part: int, window: tuple) -> str:
+        sql, bind = build_select(entry, params, engine, table=table, time_window=window)
+        target_name = str(dataset_base_path / f"{filename}_part_{part}.csv")
+        if params.sql_batch_size is not None:
+            return dataframe_batches_saver(_iter_sql_batches(engine, sql, bind, params.sql_batch_size, args), target_name)
+
+        data = pl.read_database(query=sql, connection=engine, execute_options={"parameters": bind}, **args)
+        return dataframe_to_csv_saver(data, target_name)
+
+    # the partitions get their own pool, as this function already runs in one of the scheduler's I/O workers
+    # and waiting there for other I/O tasks could exhaust the pool
+    logger.info(f"Reading dataset <ID={entry.id}> from {table} in {len(windows)} concurrent time windows.")
+    with ThreadPoolExecutor(max_workers=len(windows), thread_name_prefix="loader-sql") as pool:
+        futures = [pool.submit(read_partition, part, window) for part, window in enumerate(windows, start=1)]
+
+    # the parts are numbered by their time window, not by the order they finished
+    parts = []
+    for (window_start, window_end, _), future in zip(windows, futures, strict=True):
+        try:
+            parts.append(future.result())
+        except Exception as e:
+            logger.error(f"ERRORED: reading the time window {window_start} - {window_end} of dataset <ID={entry.id}>: {str(e)}")
+
+    if len(parts) > 0:
+        metafile_name = str(params.dataset_path / f"{filename}.metadata.json")
+        entry_metadata_saver(entry, metafile_name)
+        logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
+
+    return str(dataset_base_path)
+
+
+def _iter_sql_batches(engine: Engine, sql: str, bind: dict, batch_size: int, args: dict) -> Iterator[pl.DataFrame]:
+    # use a server-side cursor, so that only one batch is held in memory at a time
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(text(sql), bind)
+        columns = list(result.keys())
+        for rows in result.partitions(batch_size):
+            yield pl.DataFrame([tuple(row) for row in rows], schema=columns, orient="row", infer_schema_length=None, schema_overrides=args.get("schema_overrides"))
+
+
 def load_http_source(entry: Metadata):
     raise NotImplementedError("HTTP datasources are not supported yet.")
 
 
-def load_file_source(entry: Metadata, executor: Executor, params: Params) -> str | None:
+def load_file_source(entry: Metadata, executor: Scheduler, params: Params) -> str | list[str] | None:
     if entry.datasource is None:
         raise ValueError("Entry datasource is not set.")
 
@@ -115,7 +185,7 @@ def load_file_source(entry: Metadata, executor: Executor, params: Params) -> str
     return out_path
 
 
-def load_csv_file(entry: Metadata, executor: Executor, params: Params) -> str:
+def load_csv_file(entry: Metadata, executor: Scheduler, params: Params) -> str | list[str] | None:
     if entry.datasource is None:
         raise ValueError("Entry datasource is not set.")
 
@@ -152,13 +222,84 @@ def load_csv_file(entry: Metadata, executor: Executor, params: Params) -> str:
     if has_tstamp:
         args["parse_dates"] = [tstamp_col]
 
-    # Initialize data without the timestamp column if it will be used as index
-    init_columns = [col for col in column_names if col != tstamp_col] if has_tstamp else column_names
-    data = pd.DataFrame(columns=init_columns)
-    if has_tstamp:
-        # Set the index name on the empty DataFrame so it's preserved during concat
-        data.index.name = tstamp_col
+    # check if the polars scan can handle the reader arguments of the datasource
+    polars_args = _polars_csv_args(entry.datasource.args or {})
+    if params.csv_engine == "polars" and polars_args is None:
+        logger.info(f"The datasource args {entry.datasource.args} of <ID={entry.id}> are not supported by the polars engine. Falling back to pandas.")
+    use_polars = params.csv_engine == "polars" and polars_args is not None
+
+    # sorted CSV files can be read by byte range, if a time range is requested
+    has_time_range = params.start_date is not None or params.end_date is not None
+    use_time_index = use_polars and params.csv_time_index and has_tstamp and has_time_range and _supports_csv_time_index(polars_args)
+
+    # use the file index to skip all files that do not overlap the time range, without parsing them
+    # with the CSV time index, reading the first and last rows is cheaper
+    if has_tstamp and len(fnames) > 1 and has_time_range and not use_time_index:
+        index = FileIndex.for_files(fnames, params)
+        fnames = [name for name in fnames if overlaps_time(index.record(name, "csv", time_dim=tstamp_col, read_args=entry.datasource.args), params)]
+        index.save()
+        logger.info(f"{len(fnames)} CSV files overlap with the time range: {params.start_date} - {params.end_date}")
+
+    if len(fnames) == 0:
+        logger.warning(f"No CSV files left to load for dataset <ID={entry.id}>.")
+        return None
+
+    if use_time_index:
+        data = _read_csv_time_index(fnames, column_names, tstamp_col, polars_args, params)
+    elif use_polars:
+        data = _scan_csv_polars(fnames, column_names, tstamp_col, polars_args, params)
+    else:
+        data = _read_csv_pandas(fnames, column_names, tstamp_col, args, params)
+
+    if data is None:
+        logger.warning(f"None of the CSV files of dataset <ID={entry.id}> overlap the time range: {params.start_date} - {params.end_date}")
+        return None
+
+    # reduce the time axis before anything is written, the location columns are kept as groups
+    spatial_dims = entry.datasource.spatial_scale.dimension_names if entry.datasource.spatial_scale is not None else []
+    if params.temporal_resolution is not None and has_tstamp:
+        logger.info(f"python - resample({tstamp_col}='{PANDAS_FREQUENCIES[params.temporal_resolution]}').{params.temporal_reducer.value}() grouped by {spatial_dims}")
+        if isinstance(data, pl.LazyFrame):
+            data = resample_polars(data, tstamp_col, params.temporal_resolution, params.temporal_reducer, group_by=spatial_dims)
+        else:
+            data = resample_pandas(data, tstamp_col, params.temporal_resolution, params.temporal_reducer, group_by=spatial_dims).set_index(tstamp_col)
+
+    # save the data
+    catchment_id = parse_catchment_id(source_path)
+    target_name = f"{os.path.basename(source_path).rsplit('_', 1)[0]}_{catchment_id}.csv"
+    logger.info(f" ENTRY ID : {target_name}")
+    # target_name = f"{entry.variable.name.replace(' ', '_')}_{entry.id}.csv"
+
+    # with many features, point data is split into the feature folders, other data is saved once
+    if params.multi_feature and len(spatial_dims) >= 2:
+        target_names = []
+        for fid, feature_data in _split_points_by_feature(data, spatial_dims[0], spatial_dims[1], params).items():
+            dispatch_save_file(entry=entry, data=feature_data, executor=executor, base_path=str(params.feature_path(fid)), target_name=target_name, save_meta=True)
+            target_names.append(f"{fid}/{target_name}")
+        return target_names
+
+    dispatch_save_file(entry=entry, data=data, executor=executor, base_path=str(params.dataset_path), target_name=target_name, save_meta=True)
+    return target_name
+
+
+def _split_points_by_feature(data: pd.DataFrame | pl.LazyFrame, x: str, y: str, params: Params) -> dict[str, pd.DataFrame | pl.DataFrame]:
+    # the data is read once and the points are assigned to each feature they intersect
+    if isinstance(data, pl.LazyFrame):
+        data = data.collect()
+    xs, ys = data[x].to_numpy(), data[y].to_numpy()
+
+    parts = {}
+    for fid, geometry in reference_geometries(params).items():
+        mask = shapely.intersects_xy(geometry.exact, xs, ys)
+        parts[fid] = data.filter(pl.Series(mask)) if isinstance(data, pl.DataFrame) else data[mask]
+        logger.debug(f"{int(mask.sum())} of {len(mask)} points are within the feature '{fid}'.")
 
+    return parts
+
+
+def _read_csv_pandas(fnames: list[str], column_names: list[str], tstamp_col: str | None, args: dict, params: Params) -> pd.DataFrame:
+    has_tstamp = tstamp_col is not None
+    frames = []
     for fname in fnames:
         try:
             df = pd.read_csv(fname, **args)
@@ -167,17 +308,23 @@ def load_csv_file(entry: Metadata, executor: Executor, params: Params) -> str:
             continue
 
         if has_tstamp:
-            tstamp_col = entry.datasource.temporal_scale.dimension_names[0]
             df[tstamp_col] = pd.to_datetime(df[tstamp_col])
             df.set_index(tstamp_col, inplace=True)
             df.index.name = tstamp_col
             df_min = df.index.min()
             df_max = df.index.max()
-            if (params.start_date is not None and params.start_date > df_max) or (params.end_date is not None and params.end_date < df_min):
+            if (params.start_date is not None and _naive_utc(params.start_date) > df_max) or (params.end_date is not None and _naive_utc(params.end_date) < df_min):
                 logger.debug(f"Skipping {fname} as it is not in the time range: {params.start_date} - {params.end_date}")
                 continue
-        # concat
-        data = pd.concat([data, df])
+        frames.append(df)
+
+    # concat all files at once, instead of copying the accumulated data for each file
+    if len(frames) > 0:
+        data = pd.concat(frames)
+    else:
+        # Initialize data without the timestamp column if it will be used as index
+        init_columns = [col for col in column_names if col != tstamp_col] if has_tstamp else column_names
+        data = pd.DataFrame(columns=init_columns)
 
     # finished, if we have a timestamp index, we sort asc and filter by time range
     if has_tstamp:
@@ -186,19 +333,110 @@ def load_csv_file(entry: Metadata, executor: Executor, params: Params) -> str:
         data.sort_index(ascending=True, inplace=True)
         # filter by time range if specified
         if params.start_date is not None or params.end_date is not None:
-            time_slice = slice(params.start_date, params.end_date)
+            time_slice = slice(_naive_utc(params.start_date), _naive_utc(params.end_date))
             data = data.loc[time_slice]
 
-    # save the data
-    catchment_id = parse_catchment_id(source_path)
-    target_name = f"{os.path.basename(source_path).rsplit('_', 1)[0]}_{catchment_id}.csv"
-    logger.info(f" ENTRY ID : {target_name}")
-    # target_name = f"{entry.variable.name.replace(' ', '_')}_{entry.id}.csv"
-    dispatch_save_file(entry=entry, data=data, executor=executor, base_path=str(params.dataset_path), target_name=target_name, save_meta=True)
-    return target_name
+    return data
+
+
+# pandas read_csv arguments that have a polars scan_csv counterpart
+PANDAS_TO_POLARS_CSV_ARGS = {
+    "sep": "separator",
+    "delimiter": "separator",
+    "skiprows": "skip_rows",
+    "na_values": "null_values",
+    "comment": "comment_prefix",
+    "quotechar": "quote_char",
+}
+
+
+def _polars_csv_args(args: dict) -> dict | None:
+    polars_args = {}
+    for key, value in args.items():
+        if key in PANDAS_TO_POLARS_CSV_ARGS:
+            polars_args[PANDAS_TO_POLARS_CSV_ARGS[key]] = value
+        elif key == "header" and value is None:
+            polars_args["has_header"] = False
+        elif key == "header" and value == 0:
+            continue
+        elif key == "decimal":
+            polars_args["decimal_comma"] = value == ","
+        elif key == "encoding" and str(value).lower().replace("-", "") == "utf8":
+            continue
+        else:
+            # there is no safe translation for this argument
+            return None
+
+    return polars_args
+
+
+def _naive_utc(date: datetime | None) -> datetime | None:
+    # the CSV timestamps carry no timezone, thus compare in UTC like the netCDF loader does
+    if date is None or date.tzinfo is None:
+        return date
+    return pd.Timestamp(date).tz_convert("UTC").tz_localize(None).to_pydatetime()
+
+
+def _scan_csv_polars(fnames: list[str], column_names: list[str], tstamp_col: str | None, polars_args: dict, params: Params) -> pl.LazyFrame:
+    # build one lazy scan over all files, the projection and the time filter are pushed down into the scan
+    data = pl.scan_csv(fnames, try_parse_dates=True, **polars_args).select(column_names)
+    logger.info(f"polars - pl.scan_csv(<{len(fnames)} files>, {polars_args}).select({column_names})")
+
+    return _filter_csv_polars(data, tstamp_col, params)
+
+
+def _supports_csv_time_index(polars_args: dict) -> bool:
+    # the byte offsets are only valid for plain CSV files with a header in the first line
+    return not any(key in polars_args for key in ("skip_rows", "comment_prefix", "has_header"))
+
+
+def _read_csv_time_index(fnames: list[str], column_names: list[str], tstamp_col: str, polars_args: dict, params: Params) -> pl.LazyFrame | None:
+    separator = polars_args.get("separator", ",")
+    start, end = _naive_utc(params.start_date), _naive_utc(params.end_date)
+
+    frames = []
+    for fname in fnames:
+        # check the time range by reading only the first and last rows
+        first, last = csv_first_last_timestamps(fname, tstamp_col, separator)
+        if first is None or (start is not None and start > last) or (end is not None and end < first):
+            logger.debug(f"Skipping {fname} as it is not in the time range: {params.start_date} - {params.end_date}")
+            continue
 
+        # read only the byte range that covers the time range
+        index = CSVTimeIndex.load_or_build(fname, tstamp_col, separator, params)
+        chunk = index.read_bytes(start, end)
+        frames.append(pl.read_csv(chunk, columns=column_names, try_parse_dates=True, **polars_args).lazy())
 
-def load_netcdf_file(entry: Metadata, executor: Executor, params: Params) -> str:
+    if len(frames) == 0:
+        return None
+
+    logger.info(f"polars - pl.read_csv(<byte ranges of {len(frames)} files>, {polars_args}, columns={column_names})")
+    data = pl.concat(frames, how="vertical_relaxed").select(column_names)
+    return _filter_csv_polars(data, tstamp_col, params)
+
+
+def _filter_csv_polars(data: pl.LazyFrame, tstamp_col: str | None, params: Params) -> pl.LazyFrame:
+    if tstamp_col is None:
+        return data
+
+    # make sure the timestamp column is a date or datetime, dates are kept to not change the output format
+    dtype = data.collect_schema()[tstamp_col]
+    if dtype == pl.String:
+        data = data.with_columns(pl.col(tstamp_col).str.to_datetime())
+
+    # filter by time range if specified
+    tstamp = pl.col(tstamp_col).cast(pl.Datetime) if dtype == pl.Date else pl.col(tstamp_col)
+    if params.start_date is not None:
+        data = data.filter(tstamp >= _naive_utc(params.start_date))
+    if params.end_date is not None:
+        data = data.filter(tstamp <= _naive_utc(params.end_date))
+    data = data.sort(tstamp_col, maintain_order=True)
+    logger.info(f"polars - .filter({_naive_utc(params.start_date)} <= {tstamp_col} <= {_naive_utc(params.end_date)}).sort('{tstamp_col}')")
+
+    return data
+
+
+def load_netcdf_file(entry: Metadata, executor: Scheduler, params: Params) -> str | list[str] | None:
     if entry.datasource is None:
         raise ValueError("Entry datasource is not set.")
 
@@ -224,105 +462,368 @@ def load_netcdf_file(entry: Metadata, executor: Executor, params: Params) -> str
     # get the time axis
     temporal_dims = entry.datasource.temporal_scale.dimension_names if entry.datasource.temporal_scale is not None else []
 
-    # get a path for the current dataset path
-    dataset_base_path = params.dataset_path / f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
-
-    # create a counter for the saved parts
-    part = 0
-    # preprocess each netcdf / grib / zarr file
+    # collect all files that overlap the time range along with their first time step
+    # the file index holds the time range and bounding box, thus the files are not opened here
+    index = FileIndex.for_files(fnames, params)
+    reference_area = params.reference_area_df if params.reference_area is not None else None
+    candidates = []
     for fname in fnames:
-        # read the min and max time and check if we can skip
-        ds = xr.open_dataset(fname, decode_coords="all", mask_and_scale=True)
+        record = index.record(fname, "netcdf", time_dim=temporal_dims[0] if len(temporal_dims) > 0 else None)
 
         # check if we there is a time axis
         if len(temporal_dims) > 0:
-            # get the min and max time
-            min_time = pd.to_datetime(ds[temporal_dims[0]].min().values)
-            max_time = pd.to_datetime(ds[temporal_dims[0]].max().values)
-
-            if (params.start_date is not None and params.start_date > max_time.tz_localize(params.start_date.tzinfo)) or (
-                params.end_date is not None and params.end_date < min_time.tz_localize(params.end_date.tzinfo)
-            ):
+            if not overlaps_time(record, params):
                 logger.debug(f"skipping {fname} as it is not in the time range: {params.start_date} - {params.end_date}")
-                ds.close()
                 continue
         else:
-            ds.close()
             logger.warning(f"The dataset {fname} does not contain a datetime coordinate.")
 
-        # this does not work for ie HYRAS netCDF files
-        if params.netcdf_backend == "cdo":
-            ds.close()
-            path = _clip_netcdf_cdo(fname, params)
-            return path
+        if not overlaps_area(record, reference_area):
+            logger.debug(f"skipping {fname} as it does not overlap with the reference area.")
+            continue
 
-        elif params.netcdf_backend == "xarray":
-            data = _clip_netcdf_xarray(entry, fname, ds, params)
+        min_time = pd.Timestamp(record["time_min"]) if record["time_min"] is not None else None
+        candidates.append((min_time, fname))
+    index.save()
 
-        elif params.netcdf_backend == "parquet":
-            # use the xarray clip first
-            ds = _clip_netcdf_xarray(entry, fname, ds, params)
+    if len(candidates) == 0:
+        logger.warning(f"None of the files of dataset <ID={entry.id}> overlap the time range: {params.start_date} - {params.end_date}")
+        return None
 
-            data = ds.to_dask_dataframe()[entry.datasource.dimension_names].dropna()
+    # order the files by time, so that the part numbers do not depend on the order in which the tasks finish
+    candidates.sort(key=lambda c: (c[0] is None, c[0] if c[0] is not None else pd.Timestamp.min, c[1]))
+
+    # point features and the aggregation mode only write a table of the values per feature
+    if params.point_features or _aggregation_mode(params):
+        return _netcdf_files_to_table(entry, [fname for _, fname in candidates], executor, params)
+
+    # cdo clips the files in concurrent subprocesses and merges them along time
+    if params.netcdf_backend == "cdo":
+        return _netcdf_files_to_cdo(entry, [fname for _, fname in candidates], params)
+
+    # zarr outputs are a single store per entry, which all files are appended to
+    if params.netcdf_backend == "zarr":
+        return _netcdf_files_to_zarr(entry, [fname for _, fname in candidates], params)
+
+    # as we write many files in parallel here, we need to provide the target names one-by-one
+    # each file is read once and clipped to all features, which each get their own part
+    filename = f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
+    suffix = "parquet" if params.netcdf_backend == "parquet" else "nc"
+    base_paths = {fid: params.feature_path(fid) / filename for fid in _feature_ids(params)}
+    for base_path in base_paths.values():
+        base_path.mkdir(parents=True, exist_ok=True)
+    jobs = [(fname, {fid: str(base / f"{filename}_part_{part}.{suffix}") for fid, base in base_paths.items()}) for part, (_, fname) in enumerate(candidates, start=1)]
+
+    # clip and save the files, either one file per task in the CPU pool or procedurally
+    # resampled outputs are written from all files at once, as a period can span several files
+    parts = {fid: [] for fid in base_paths}
+    if _resample_mode(entry, params):
+        logger.info(f"Resampling {len(jobs)} files of dataset <ID={entry.id}> into one part per feature.")
+        targets = {fid: str(base / f"{filename}_part_1.{suffix}") for fid, base in base_paths.items()}
+        future = executor.submit_cpu(_netcdf_files_to_resampled_part, entry, [fname for fname, _ in jobs], params, targets)
+        try:
+            for fid, out_path in future.result().items():
+                parts[fid].append(out_path)
+        except Exception as e:
+            logger.error(f"ERRORED: resampling the files of dataset <ID={entry.id}>: {str(e)}")
+    elif params.netcdf_parallel and len(jobs) > 1:
+        logger.info(f"Clipping {len(jobs)} files of dataset <ID={entry.id}> in parallel using {executor.cpu_workers} CPU workers.")
+        futures = [(fname, executor.submit_cpu(_netcdf_file_to_part, entry, fname, params, targets)) for fname, targets in jobs]
+        for fname, future in futures:
+            try:
+                out_paths = future.result()
+            except Exception as e:
+                logger.error(f"ERRORED: clipping {fname} of dataset <ID={entry.id}>: {str(e)}")
+                continue
+            for fid, out_path in out_paths.items():
+                parts[fid].append(out_path)
+    else:
+        for fname, targets in jobs:
+            for fid, out_path in _netcdf_file_to_part(entry, fname, params, targets).items():
+                parts[fid].append(out_path)
+
+    # if there are many files, we save the metadata only once per feature
+    for fid, feature_parts in parts.items():
+        if len(feature_parts) > 0:
+            metafile_name = str(params.feature_path(fid) / f"{filename}.metadata.json")
+            entry_metadata_saver(entry, metafile_name)
+            logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
 
-        # if we are still here, dispatch the save task for intermediate file chunk
-        # we do not need the future here, we can directly move to the next file
+    # return the out_path, or one per feature
+    if params.multi_feature:
+        return [str(base_path) for base_path in base_paths.values()]
+    return str(next(iter(base_paths.values())))
+
+
+def _netcdf_files_to_zarr(entry: Metadata, fnames: list[str], params: Params) -> str | list[str] | None:
+    filename = f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
+    time_dim = entry.datasource.temporal_scale.dimension_names[0] if entry.datasource.temporal_scale is not None else None
+    targets = {fid: params.feature_path(fid) / f"{filename}.zarr" for fid in _feature_ids(params)}
+
+    # a store from an earlier run would be appended to
+    for target in targets.values():
+        if target.exists():
+            shutil.rmtree(target)
+
+    # resampled stores are written from all files at once, as a period can span several files
+    if _resample_mode(entry, params):
+        logger.info(f"Resampling {len(fnames)} files of dataset <ID={entry.id}> into {len(targets)} zarr stores.")
+        with io_environment(params), dask_config(params), _open_resampled_regions(entry, fnames, params) as regions:
+            for fid, target in targets.items():
+                if fid in regions:
+                    xarray_to_zarr_saver(regions[fid], str(target), append_dim=time_dim, time_chunk=params.zarr_time_chunk)
+    else:
+        # the appends have to happen in time order, thus the files are processed one after another
+        # and dask parallelizes the chunks within each file
+        logger.info(f"Appending {len(fnames)} files of dataset <ID={entry.id}> along '{time_dim}' to {len(targets)} zarr stores.")
+        for fname in fnames:
+            with io_environment(params), dask_config(params), _open_netcdf(fname, params) as ds:
+                regions = _clip_netcdf_xarray(entry, fname, ds, params)
+                for fid, target in targets.items():
+                    if fid in regions:
+                        xarray_to_zarr_saver(regions[fid], str(target), append_dim=time_dim, time_chunk=params.zarr_time_chunk)
+
+    # save the metadata next to each store
+    out_paths = []
+    for target in targets.values():
+        if not target.exists():
+            logger.warning(f"No data of dataset <ID={entry.id}> was written to {target}.")
+            continue
+        metafile_name = f"{target}.metadata.json"
+        entry_metadata_saver(entry, metafile_name)
+        logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
+        out_paths.append(str(target))
 
-        # as we write many files in parallel here, we need to provide the target names one-by-one
-        # and supress the creation of metadata files
-        dataset_base_path.mkdir(parents=True, exist_ok=True)
+    if len(out_paths) == 0:
+        return None
+    return out_paths if params.multi_feature else out_paths[0]
+
+
+def _aggregation_mode(params: Params) -> bool:
+    if params.spatial_aggregation is None:
+        return False
+    if params.reference_area is None:
+        logger.warning("The spatial aggregation needs a reference area. The full datasets are written instead.")
+        return False
+    return True
+
+
+def _netcdf_files_to_table(entry: Metadata, fnames: list[str], executor: Scheduler, params: Params) -> str | None:
+    # each file is reduced on its own, only the small tables are collected
+    if params.netcdf_parallel and len(fnames) > 1:
+        logger.info(f"Reducing {len(fnames)} files of dataset <ID={entry.id}> in parallel using {executor.cpu_workers} CPU workers.")
+        futures = [(fname, executor.submit_cpu(_netcdf_file_to_frame, entry, fname, params)) for fname in fnames]
+        frames = []
+        for fname, future in futures:
+            try:
+                frames.append(future.result())
+            except Exception as e:
+                logger.error(f"ERRORED: reducing {fname} of dataset <ID={entry.id}>: {str(e)}")
+    else:
+        frames = [_netcdf_file_to_frame(entry, fname, params) for fname in fnames]
 
-        # we will actually save, so increate the part counter
-        part += 1
+    frames = [frame for frame in frames if len(frame) > 0]
+    if len(frames) == 0:
+        logger.warning(f"None of the files of dataset <ID={entry.id}> overlap the reference area.")
+        return None
 
-        # get the filename
-        filename = f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
-        target_name = f"{filename}_part_{part}.nc"
+    time_dim = entry.datasource.temporal_scale.dimension_names[0] if entry.datasource.temporal_scale is not None else None
+    table = pd.concat(frames, ignore_index=True)
+    table = table.sort_values([col for col in ("feature_id", time_dim) if col in table.columns], kind="stable", ignore_index=True)
 
-        # use the dispatch_save_file function to save the data
-        # dispatch_save_file(entry=entry, data=data, executor=executor, base_path=str(dataset_base_path), target_name=target_name, save_meta=False)
-        xarray_to_netcdf_saver(data=data, target_name=str(dataset_base_path / target_name))
+    # the tables are resampled after all files are collected, thus periods spanning several files are complete
+    if params.temporal_resolution is not None and time_dim in table.columns:
+        table = resample_pandas(table, time_dim, params.temporal_resolution, params.temporal_reducer, group_by=["feature_id"])
+        logger.info(f"python - table.groupby(['feature_id', pd.Grouper(key='{time_dim}', freq='{PANDAS_FREQUENCIES[params.temporal_resolution]}')]).{params.temporal_reducer.value}()")
 
-        # if there are many files, we save the metadata only once
-        if part == 1:
-            metafile_name = str(params.dataset_path / f"{filename}.metadata.json")
-            entry_metadata_saver(entry, metafile_name)
-            logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
+    return _save_table(entry, table, executor, params)
 
-    # return the out_path
-    return str(dataset_base_path)
 
+def _netcdf_file_to_frame(entry: Metadata, fname: str, params: Params) -> pd.DataFrame:
+    # the reduced regions and samples are small, thus they are computed at once
+    with io_environment(params), dask_config(params), _open_netcdf(fname, params) as ds:
+        if params.point_features:
+            sampled = _sample_netcdf_xarray(entry, fname, ds, params)
+            if sampled is None:
+                return pd.DataFrame()
+            frame = sampled.compute().to_dataframe().reset_index()
+            return frame[["feature_id"] + [col for col in frame.columns if col != "feature_id"]]
 
-def _clip_netcdf_cdo(path: Path, params: Params):
-    # get the output name
-    out_name = params.intermediate_path / path.name
+        regions = _clip_netcdf_xarray(entry, fname, ds, params)
+        (regions,) = dask.compute(regions)
 
-    # build the several commands
-    ref = params.reference_area_df
-    bnd = ref.geometry[0].bounds
+    frames = [region_to_frame(region, fid) for fid, region in regions.items()]
+    return pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame()
 
-    # create the lonlatbox command
-    lonlat_cmd = f"-sellonlatbox,{bnd[0]},{bnd[2]},{bnd[1]},{bnd[3]}"
 
-    # create the selregion command
-    selregion_cmd = f"-selregion,{params.base_path}/reference_area.ascii"
+def _save_table(entry: Metadata, table: pd.DataFrame, executor: Scheduler, params: Params) -> str:
+    # a single table holds the values of all features
+    name = "points" if params.point_features else params.spatial_aggregation.value
+    target_name = f"{entry.variable.name.replace(' ', '_')}_{entry.id}_{name}.{params.aggregation_format.value}"
+    dispatch_save_file(entry=entry, data=table, executor=executor, base_path=str(params.dataset_path), target_name=target_name, save_meta=True)
+    if params.point_features:
+        logger.info(f"Sampled dataset <ID={entry.id}> at {len(params.feature_ids)} points ({params.point_interpolation.value}) into {len(table)} rows.")
+    else:
+        logger.info(f"Aggregated dataset <ID={entry.id}> to {len(table)} rows using the area-weighted {params.spatial_aggregation.value}.")
 
-    # build the full command
-    cmd = ["cdo", selregion_cmd, lonlat_cmd, str(path), str(out_name)]
+    return str(params.dataset_path / target_name)
 
-    # run
+
+def _sample_netcdf_xarray(entry: Metadata, file_name: str, data: xr.Dataset, params: Params) -> xr.Dataset | None:
+    # the point features are sampled all at once, for all time steps
+    ds = _select_netcdf_xarray(entry, file_name, data, params)
+    if ds is None:
+        return None
+
+    geometries = reference_geometries(params, ds.rio.crs)
+    logger.info(f"python - sample_points(ds, <{len(geometries)} points>, method={params.point_interpolation.value})")
+    return sample_points(ds, geometries, params.point_interpolation)
+
+
+def _feature_ids(params: Params) -> list[str]:
+    # without a reference area, the full dataset is one output in the datasets path
+    if params.reference_area is None:
+        return [""]
+    return params.feature_ids
+
+
+def _netcdf_file_to_part(entry: Metadata, fname: str, params: Params, targets: dict[str, str]) -> dict[str, str]:
+    if params.netcdf_backend not in ("xarray", "parquet"):
+        logger.error(f"The netCDF backend '{params.netcdf_backend}' is not supported for {fname}.")
+        return {}
+
+    # this runs in a worker process, so the file is opened here and not passed in
+    # the clip stays lazy and the writers stream the result chunk by chunk using the configured dask scheduler
+    out_paths = {}
+    t1 = time.time()
+    with io_environment(params), dask_config(params), _open_netcdf(fname, params) as ds:
+        regions = _clip_netcdf_xarray(entry, fname, ds, params)
+
+        for fid, target_name in targets.items():
+            if fid not in regions:
+                continue
+
+            if params.netcdf_backend == "xarray":
+                out_paths[fid] = xarray_to_netcdf_saver(data=regions[fid], target_name=target_name, profile=params.netcdf_encoding.value, keep_packing=params.keep_packing)
+            else:
+                time_dim = entry.datasource.temporal_scale.dimension_names[0] if entry.datasource.temporal_scale is not None else None
+                out_paths[fid] = xarray_to_parquet_saver(data=regions[fid], target_name=target_name, time_dim=time_dim, partition_by_year=params.parquet_partition_by_year)
+
+    logger.info(f"Wrote {len(out_paths)} outputs of {fname} in {time.time() - t1:.2f} seconds ({describe_environment(params)}).")
+    return out_paths
+
+
+def _open_netcdf(fname: str, params: Params) -> xr.Dataset:
+    # without a chunk size, the on-disk chunks are used as they are
+    if params.dask_chunk_size is None:
+        return xr.open_dataset(fname, decode_coords="all", mask_and_scale=True, chunks={})
+
+    # otherwise dask combines the on-disk chunks up to the configured chunk size
+    with dask.config.set({"array.chunk-size": params.dask_chunk_size}):
+        ds = xr.open_dataset(fname, decode_coords="all", mask_and_scale=True, chunks="auto")
+    logger.debug(f"Opened {fname} lazily with chunks {dict(ds.chunks)}")
+
+    return ds
+
+
+def _netcdf_files_to_cdo(entry: Metadata, fnames: list[str], params: Params) -> str | list[str] | None:
+    filename = f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
+    intermediate = params.intermediate_path / filename
+    intermediate.mkdir(parents=True, exist_ok=True)
+
+    # each file is clipped to each feature by its own cdo process, the parts are merged per feature
+    jobs = [(fname, fid, intermediate / f"{fid or filename}_part_{part}.nc") for part, fname in enumerate(fnames, start=1) for fid in _feature_ids(params)]
+
+    # the subprocesses get their own pool, as this function already runs in one of the scheduler's I/O workers
+    workers = params.cdo_workers or params.cpu_workers or default_cpu_workers()
+    logger.info(f"Clipping {len(fnames)} files of dataset <ID={entry.id}> using up to {workers} concurrent cdo processes with {params.cdo_threads} threads each.")
+    t1 = time.time()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="loader-cdo") as pool:
+        futures = [(fname, fid, out_path, pool.submit(_clip_netcdf_cdo, entry, fname, fid, out_path, params)) for fname, fid, out_path in jobs]
+
+    # the parts are kept in the order of the files, not the order they finished
+    parts = {fid: [] for fid in _feature_ids(params)}
+    timings = []
+    for fname, fid, out_path, future in futures:
+        try:
+            timings.append(future.result())
+        except Exception as e:
+            logger.error(f"ERRORED: clipping {fname} of dataset <ID={entry.id}> using cdo: {str(e)}")
+            continue
+        parts[fid].append(str(out_path))
+    t2 = time.time()
+    if len(timings) > 0:
+        logger.info(f"cdo clipped {len(timings)} parts in {t2 - t1:.2f} seconds ({sum(timings):.2f} seconds summed over the processes, slowest: {max(timings):.2f} seconds).")
+
+    out_paths = []
+    for fid, feature_parts in parts.items():
+        if len(feature_parts) == 0:
+            logger.warning(f"No files of dataset <ID={entry.id}> were clipped{f' for {fid}' if params.multi_feature else ''}.")
+            continue
+
+        target = params.feature_path(fid) / f"{filename}.nc"
+        _merge_netcdf_cdo(entry, feature_parts, target, params)
+        metafile_name = f"{target}.metadata.json"
+        entry_metadata_saver(entry, metafile_name)
+        logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
+        out_paths.append(str(target))
+
+    shutil.rmtree(intermediate, ignore_errors=True)
+    with contextlib.suppress(OSError):
+        intermediate.parent.rmdir()
+
+    # return the out_path, or one per feature
+    if len(out_paths) == 0:
+        return None
+    if params.multi_feature:
+        return out_paths
+    return out_paths[0]
+
+
+def _clip_netcdf_cdo(entry: Metadata, fname: str, feature_id: str, out_path: Path, params: Params) -> float:
+    # cdo applies the chained operators from right to left: variables, time range, bounding box and region
+    operators = []
+    if params.reference_area is not None:
+        minx, miny, maxx, maxy = reference_geometries(params)[feature_id].exact.bounds
+        operators.append(f"-selregion,{reference_area_ascii_path(params, feature_id)}")
+        operators.append(f"-sellonlatbox,{minx},{maxx},{miny},{maxy}")
+    if entry.datasource.temporal_scale is not None and (params.start_date is not None or params.end_date is not None):
+        start = _naive_utc(params.start_date).isoformat() if params.start_date is not None else "0001-01-01T00:00:00"
+        end = _naive_utc(params.end_date).isoformat() if params.end_date is not None else "9999-12-31T23:59:59"
+        operators.append(f"-seldate,{start},{end}")
+    operators.append(f"-selname,{','.join(entry.datasource.variable_names)}")
+
+    return _run_cdo(["cdo", "-O", "-P", str(params.cdo_threads), *operators, fname, str(out_path)])
+
+
+def _merge_netcdf_cdo(entry: Metadata, parts: list[str], target: Path, params: Params):
+    # the temporal aggregation runs after the merge, thus periods spanning several files are complete
+    operators = []
+    if params.temporal_resolution is not None and entry.datasource.temporal_scale is not None:
+        operators.append(f"-{CDO_PERIODS[params.temporal_resolution]}{params.temporal_reducer.value}")
+
+    if len(parts) == 1 and len(operators) == 0:
+        shutil.move(parts[0], target)
+        return
+
+    _run_cdo(["cdo", "-O", "-P", str(params.cdo_threads), *operators, "-mergetime", *parts, str(target)])
+
+
+def _run_cdo(cmd: list[str]) -> float:
     t1 = time.time()
-    subprocess.run(cmd)
+    result = subprocess.run(cmd, capture_output=True, text=True)
     t2 = time.time()
+    if result.returncode != 0:
+        raise RuntimeError(f"'{' '.join(cmd)}' failed with exit code {result.returncode}: {result.stderr.strip()}")
 
     # log the command
     logger.info(" ".join(cmd))
     logger.info(f"took {t2 - t1:.2f} seconds")
 
-    return str(out_name)
+    return t2 - t1
 
 
-def _clip_netcdf_xarray(entry: Metadata, file_name: str, data: xr.Dataset, params: Params):
+def _select_netcdf_xarray(entry: Metadata, file_name: str, data: xr.Dataset, params: Params) -> xr.Dataset | None:
     if entry.datasource is None:
         raise ValueError("Entry datasource is not set.")
 
@@ -353,18 +854,16 @@ def _clip_netcdf_xarray(entry: Metadata, file_name: str, data: xr.Dataset, param
             data.rio.write_crs(4326, inplace=True)
         else:
             logger.error("Dataset has no CRS and no lat/lon coordinate axes or data variables. Cannot clip.")
-            return data
+            return None
     else:
         # inform the user that we are processing the file using xarray
         logger.info(f"Processing {file_name} in Python using rioxarray and xarray (source ID={entry.id})...")
 
-    # start a timer
-    t1 = time.time()
-
     # extract only the needed variables and coordinates
     variable_names = entry.datasource.variable_names
     if True:
-        ds = data[variable_names].copy()
+        # selecting the variables is a shallow copy, the data stays lazy
+        ds = data[variable_names]
         for coord in data.coords:
             if coord not in ds.coords:
                 ds = ds.assign_coords({coord: data.coords[coord]})
@@ -372,29 +871,10 @@ def _clip_netcdf_xarray(entry: Metadata, file_name: str, data: xr.Dataset, param
     else:
         ds = data
 
-    # first go for the lonlatbox clip
-    ref = params.reference_area_df
-    bounds = ref.geometry[0].bounds
-
-    # then the region clip
+    # first go for the time clip, so that only the requested period is read
     if entry.datasource.temporal_scale is not None:
         time_dim = entry.datasource.temporal_scale.dimension_names[0]
-        ds.chunk({entry.datasource.temporal_scale.dimension_names[0]: "auto"})
-
-        logger.info(f"python - ds.chunk{{'{time_dim}': 'auto'}})")
-    else:
-        time_dim = None
 
-    # do the lonlat and then the region clip
-    lonlatbox = ds.rio.clip_box(*bounds, crs=4326)
-    region = lonlatbox.rio.clip([ref.geometry[0]], crs=4326, all_touched=params.cell_touches)
-
-    # log out
-    logger.info(f"python - lonlatbox df.rio.clip_box(({','.join([str(_) for _ in bounds])}), crs=4326)")
-    logger.info(f"python - region = lonlatbox.rio.clip([ref.geometry[0]], crs=4326, all_touched={params.cell_touches})")
-
-    # do the time clip
-    if time_dim is not None:
         # TODO: check the attrs of time_dim to see if there is timezone information
 
         # convert params to UTC as we assume any xarray souce to use UTC dates
@@ -404,28 +884,122 @@ def _clip_netcdf_xarray(entry: Metadata, file_name: str, data: xr.Dataset, param
         )
 
         # subset the time axis
-        region = region.sel(**{time_dim: time_slice})
-        logger.info(f"python - region.sel({time_dim}=slice({time_slice.start}, {time_slice.stop}))")
+        ds = ds.sel(**{time_dim: time_slice})
+        logger.info(f"python - ds.sel({time_dim}=slice({time_slice.start}, {time_slice.stop}))")
+
+    return ds
+
+
+def _clip_netcdf_xarray(entry: Metadata, file_name: str, data: xr.Dataset, params: Params, persist: bool = True) -> dict[str, xr.Dataset]:
+    # start a timer
+    t1 = time.time()
+
+    # without a CRS, the dataset can not be clipped
+    ds = _select_netcdf_xarray(entry, file_name, data, params)
+    if ds is None:
+        return dict.fromkeys(_feature_ids(params), data)
+
+    # without a reference area, there is nothing to clip
+    if params.reference_area is None:
+        return {"": ds}
+
+    # the features are reprojected to the grid once, and the masks are cached per grid and geometry
+    # thus only the first file of a grid is rasterised
+    geometries = reference_geometries(params, ds.rio.crs, cell_size=min(abs(r) for r in ds.rio.resolution()))
+    aggregate = params.spatial_aggregation is not None
+    transform, geographic = ds.rio.transform(), ds.rio.crs.is_geographic
+    masks = {}
+    for fid, geometry in geometries.items():
+        mask = get_grid_mask(ds, geometry, all_touched=params.cell_touches, coverage=aggregate)
+        if mask is None:
+            logger.debug(f"The feature '{fid}' does not overlap with {file_name}.")
+            continue
+        masks[fid] = mask
+
+    if len(masks) == 0:
+        return {}
+
+    # with many features, the window around all of them is read once and kept in memory
+    origin = (0, 0)
+    if params.multi_feature and persist:
+        rows, cols = union_window(list(masks.values()))
+        ds = ds.isel({ds.rio.y_dim: rows, ds.rio.x_dim: cols}).persist()
+        origin = (rows.start, cols.start)
+        logger.info(f"python - ds.isel({ds.rio.y_dim}=slice({rows.start}, {rows.stop}), {ds.rio.x_dim}=slice({cols.start}, {cols.stop})).persist() for {len(masks)} features")
+
+    # the region of each feature is cut by its window and masked
+    regions = {fid: mask.apply(ds, origin=origin) for fid, mask in masks.items()}
+    logger.info(f"python - region = mask.apply(ds) with cached cell masks (all_touched={params.cell_touches}) for {len(regions)} features")
+
+    # in the aggregation mode, each region is reduced to one value per time step
+    if aggregate:
+        regions = {fid: aggregate_region(region, masks[fid], params.spatial_aggregation, transform, geographic) for fid, region in regions.items()}
+        logger.info(f"python - region.weighted(<coverage>).{params.spatial_aggregation.value}(dim=({ds.rio.y_dim}, {ds.rio.x_dim})) for {len(regions)} features")
 
     t2 = time.time()
     logger.info(f"took {t2 - t1:.2f} seconds")
 
-    # return the new dataset
-    return region
+    # return the new datasets by feature id
+    return regions
+
+
+def _resample_netcdf(entry: Metadata, ds: xr.Dataset, params: Params) -> xr.Dataset:
+    # the resampling stays lazy, thus only the reduced data is computed when the output is written
+    if params.temporal_resolution is None or entry.datasource.temporal_scale is None:
+        return ds
+
+    time_dim = entry.datasource.temporal_scale.dimension_names[0]
+    logger.debug(f"python - ds.resample({time_dim}='{PANDAS_FREQUENCIES[params.temporal_resolution]}').{params.temporal_reducer.value}()")
+    return resample_xarray(ds, time_dim, params.temporal_resolution, params.temporal_reducer)
+
+
+def _resample_mode(entry: Metadata, params: Params) -> bool:
+    return params.temporal_resolution is not None and entry.datasource.temporal_scale is not None
+
+
+@contextlib.contextmanager
+def _open_resampled_regions(entry: Metadata, fnames: list[str], params: Params) -> Iterator[dict[str, xr.Dataset]]:
+    # a period can span several files, thus all files are combined lazily along time and resampled once
+    # the files stay open until the caller wrote the regions
+    time_dim = entry.datasource.temporal_scale.dimension_names[0]
+    with contextlib.ExitStack() as stack:
+        datasets = [stack.enter_context(_open_netcdf(fname, params)) for fname in fnames]
+        if len(datasets) == 1:
+            ds = datasets[0]
+        else:
+            ds = xr.concat(datasets, dim=time_dim, data_vars="minimal", coords="minimal", compat="override", join="exact", combine_attrs="override")
+            logger.info(f"python - xr.concat(<{len(datasets)} files>, dim='{time_dim}')")
+
+        # the combined window of many features is not persisted, as it spans all files
+        regions = _clip_netcdf_xarray(entry, fnames[0] if len(fnames) == 1 else f"{len(fnames)} files of dataset <ID={entry.id}>", ds, params, persist=False)
+        yield {fid: _resample_netcdf(entry, region, params) for fid, region in regions.items()}
+
+
+def _netcdf_files_to_resampled_part(entry: Metadata, fnames: list[str], params: Params, targets: dict[str, str]) -> dict[str, str]:
+    # the resampled data of all files is written as a single part per feature
+    out_paths = {}
+    t1 = time.time()
+    with io_environment(params), dask_config(params), _open_resampled_regions(entry, fnames, params) as regions:
+        for fid, target_name in targets.items():
+            if fid not in regions:
+                continue
+
+            if params.netcdf_backend == "xarray":
+                out_paths[fid] = xarray_to_netcdf_saver(data=regions[fid], target_name=target_name, profile=params.netcdf_encoding.value, keep_packing=params.keep_packing)
+            else:
+                time_dim = entry.datasource.temporal_scale.dimension_names[0]
+                out_paths[fid] = xarray_to_parquet_saver(data=regions[fid], target_name=target_name, time_dim=time_dim, partition_by_year=params.parquet_partition_by_year)
+
+    logger.info(f"Wrote {len(out_paths)} resampled outputs of {len(fnames)} files in {time.time() - t1:.2f} seconds ({describe_environment(params)}).")
+    return out_paths
 
 
-def load_raster_file(entry: Metadata, executor: Executor, params: Params) -> str:
+def load_raster_file(entry: Metadata, executor: Scheduler, params: Params) -> str | list[str]:
     if entry.datasource is None:
         raise ValueError("Entry datasource is not set.")
 
     # get the reference area
-    reference_area = params.reference_area_df
-
-    # get a path for the current dataset path
-    dataset_base_path = params.dataset_path / f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
-
-    # create the base path
-    dataset_base_path.mkdir(parents=True, exist_ok=True)
+    reference_area = params.reference_area_df if params.reference_area is not None else None
 
     # get the file name from the source
     source_file_name = entry.datasource.path
@@ -440,121 +1014,214 @@ def load_raster_file(entry: Metadata, executor: Executor, params: Params) -> str
         names = [source_file_name]
 
     # filter
-    fnames = [name for name in names if Path(name).suffix.lower() in (".tif", ".tiff", ".dem")]
+    fnames = sorted(name for name in names if Path(name).suffix.lower() in (".tif", ".tiff", ".dem"))
 
     # info
     logger.info(f"Exploded the final list of raster tiles to : {fnames}")
 
-    # define an error handler
-    def error_handler(future):
-        exc = future.exception()
-        if exc is not None:
-            logger.error(f"ERRORED: clipping dataset <ID={entry.id}>: {str(exc)}")
-
-    # collect all futures
-    # futures = []
-
-    part = 1
-
-    # go for each file
-    for fname in fnames:
+    # use the file index to skip all tiles that do not overlap the reference area, without opening them
+    if len(fnames) > 1:
+        index = FileIndex.for_files(fnames, params)
+        fnames = [name for name in fnames if overlaps_area(index.record(name, "raster"), reference_area)]
+        index.save()
+        logger.info(f"{len(fnames)} raster tiles overlap with the reference area.")
+
+    # point features and the aggregation mode only write a table of the values per feature
+    if params.point_features:
+        return _sample_raster_files(entry, fnames, executor, params)
+    if _aggregation_mode(params):
+        return _aggregate_raster_files(entry, fnames, executor, params)
+
+    # get a path for the current dataset path, per feature, and create them
+    filename = f"{entry.variable.name.replace(' ', '_')}_{entry.id}"
+    base_paths = {fid: params.feature_path(fid) / filename for fid in _feature_ids(params)}
+    for base_path in base_paths.values():
+        base_path.mkdir(parents=True, exist_ok=True)
+
+    # clip each tile in the CPU pool, each tile is read once for all features
+    futures = []
+    for part, fname in enumerate(fnames, start=1):
         # derive an out-name
         if len(fnames) == 1:
-            out_name = f"{entry.variable.name.replace(' ', '_')}_{entry.id}.tif"
+            out_name = f"{filename}.tif"
         else:
-            out_name = f"{entry.variable.name.replace(' ', '_')}_{entry.id}_part_{part}.tif"
-
-        # submit each save task to the executor
-        # future = executor.submit(_rio_clip_raster, fname, reference_area, dataset_base_path, out_name=out_name, touched=params.cell_touches)
-        # future.add_done_callback(error_handler)
-        # futures.append(future)
+            out_name = f"{filename}_part_{part}.tif"
 
-        # call procedurally
-        out_path = _rio_clip_raster(fname, reference_area, base_path=dataset_base_path, out_name=out_name, touched=params.cell_touches)
-        if out_path is not None:
-            part += 1
+        targets = {fid: base_path / out_name for fid, base_path in base_paths.items()}
+        future = executor.submit_cpu(_rio_clip_raster, fname, params, targets=targets)
+        futures.append((fname, future))
 
     # wait until all are finished
-    # tiles = [future.result() for future in futures if future.result() is not None]
-
-    # run the merge function and delete the other files
-    # if len(tiles) > 1:
-    #     logger.debug('Starting WhitboxTools mosaic operation...')
-    #     _wbt_merge_raster(dataset_base_path, f"{entry.variable.name.replace(' ', '_')}_{entry.id}.tif")
-
-    #     # remove the tiles
-    #     for tile in tiles:
-    #         Path(tile).unlink()
-
-    # # check if there is exactly one tile
-    # elif len(tiles) == 1:
-    #     # rename the file
-    #     new_name = dataset_base_path / f"{entry.variable.name.replace(' ', '_')}_{entry.id}.tif"
-    #     Path(tiles[0]).rename(new_name)
-    #     tiles = [str(new_name)]
-    # else:
-    #     logger.warning(f'No tiles were clipped for the reference area. It might not be covered by dataset <ID={entry.id}>')
-
-    # save the metadata
-    metafile_name = str(params.dataset_path / f"{entry.variable.name.replace(' ', '_')}_{entry.id}.metadata.json")
-    entry_metadata_saver(entry, metafile_name)
-    logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
-
-    # some logging
-    return str(dataset_base_path)
+    tiles = {fid: [] for fid in base_paths}
+    for fname, future in futures:
+        try:
+            out_paths = future.result()
+        except Exception as e:
+            logger.error(f"ERRORED: clipping {fname} of dataset <ID={entry.id}>: {str(e)}")
+            continue
+        for fid, out_path in out_paths.items():
+            tiles[fid].append(out_path)
+
+    # the parts of each feature are combined into one mosaic in the CPU pool, the features run concurrently
+    mosaics = {}
+    for fid, feature_tiles in tiles.items():
+        if len(feature_tiles) > 1 or (len(feature_tiles) == 1 and params.raster_cog):
+            mosaics[fid] = executor.submit_cpu(build_mosaic, feature_tiles, base_paths[fid], filename, cog=params.raster_cog, config=gdal_options(params), options=cog_options(params))
+    for fid, future in mosaics.items():
+        try:
+            mosaic = future.result()
+            logger.info(f"Combined {len(tiles[fid])} clipped tiles of dataset <ID={entry.id}> into {mosaic} ({describe_environment(params)}).")
+        except Exception as e:
+            logger.error(f"ERRORED: building the mosaic of dataset <ID={entry.id}>{f' for {fid}' if params.multi_feature else ''}: {str(e)}")
 
+    for fid, feature_tiles in tiles.items():
+        if len(feature_tiles) == 0:
+            logger.warning(f"No tiles were clipped for the reference area{f' {fid}' if params.multi_feature else ''}. It might not be covered by dataset <ID={entry.id}>")
 
-def _rio_clip_raster(file_name: str, reference_area: gpd.GeoDataFrame, base_path: Path, out_name: str | None = None, touched: bool = False) -> str | None:
-    t1 = time.time()
+        # save the metadata
+        metafile_name = str(params.feature_path(fid) / f"{filename}.metadata.json")
+        entry_metadata_saver(entry, metafile_name)
+        logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
 
-    # open the raster file using rasterio
-    with rio.open(file_name, "r") as src:
-        # figure out a nodata value
-        nodata = src.nodata
-        if nodata is None:
-            nodata = -9999
-        # do the masking
-        try:
-            out_raster, out_transform = rio.mask.mask(src, reference_area.geometry, crop=True, all_touched=touched, nodata=nodata)
-        except ValueError as e:
-            if "Input shapes do not overlap raster" in str(e):
-                logger.debug(f"Skipping {file_name} as it does not overlap with the reference area.")
-                return None
-            else:
-                logger.exception(f"An unexpected error occured: {str(e)}")
+    # return the out_path, or one per feature
+    if params.multi_feature:
+        return [str(base_path) for base_path in base_paths.values()]
+    return str(next(iter(base_paths.values())))
 
-        # save the out meta
-        out_meta = src.meta.copy()
 
-        # update the metadata
-        out_meta.update({"height": out_raster.shape[1], "width": out_raster.shape[2], "transform": out_transform, "nodata": nodata})
+def _rio_clip_raster(file_name: str, params: Params, targets: dict[str, Path]) -> dict[str, str]:
+    t1 = time.time()
 
-    # finally save the raster
-    if out_name is None:
-        out_path = base_path / Path(file_name).name
-    else:
-        out_path = base_path / out_name
+    # open the raster file using rasterio, with the tuned GDAL settings
+    out_paths = {}
+    with io_environment(params), rio.open(file_name, "r") as src:
+        # without a reference area, the tile is used as it is
+        if params.reference_area is None:
+            for fid, out_path in targets.items():
+                shutil.copy(file_name, out_path)
+                out_paths[fid] = str(out_path)
+            return out_paths
+
+        # figure out a nodata value, that the data type of the raster can hold
+        nodata = fill_value(src.dtypes[0], src.nodata)
+
+        # the features are reprojected into the CRS of the raster, and each window is clipped block by block
+        geometries = reference_geometries(params, src.crs, cell_size=min(abs(r) for r in src.res))
+        options = geotiff_options(params, src.dtypes[0])
+        n_read = 0
+        for fid, out_path in targets.items():
+            n_bytes = clip_raster_blocks(src, geometries[fid], out_path, params.cell_touches, nodata, options)
+            if n_bytes is None:
+                continue
+            n_read += n_bytes
+            out_paths[fid] = str(out_path)
 
-    with rio.open(str(out_path), "w", **out_meta) as dst:
-        dst.write(out_raster)
+        if len(out_paths) == 0:
+            logger.debug(f"Skipping {file_name} as it does not overlap with the reference area.")
+            return out_paths
 
     t2 = time.time()
-    logger.info(f"Clipped {file_name} to {out_path} in {t2 - t1:.2f} seconds.")
+    logger.info(f"Clipped {file_name} to {len(out_paths)} of {len(targets)} reference areas in {t2 - t1:.2f} seconds ({n_read / 2**20:.1f} MiB read, {n_read / 2**20 / max(t2 - t1, 1e-6):.1f} MiB/s, {describe_environment(params)}).")
 
-    # return the output path
-    return str(out_path)
+    # return the output paths by feature id
+    return out_paths
 
 
-def _wbt_merge_raster(input_folder: Path, out_name: str):
-    # initialize the whitebox tools
-    wbt = WhiteboxTools()
-    wbt.set_verbose_mode(True)
+def _aggregate_raster_files(entry: Metadata, fnames: list[str], executor: Scheduler, params: Params) -> str | None:
+    # the tiles cover different parts of the area, thus each one yields partial statistics, which are combined here
+    futures = [(fname, executor.submit_cpu(_rio_raster_statistics, fname, params)) for fname in fnames]
+    statistics = {}
+    for fname, future in futures:
+        try:
+            tile_statistics = future.result()
+        except Exception as e:
+            logger.error(f"ERRORED: aggregating {fname} of dataset <ID={entry.id}>: {str(e)}")
+            continue
+        for fid, stats in tile_statistics.items():
+            statistics.setdefault(fid, []).append(stats)
+
+    if len(statistics) == 0:
+        logger.warning(f"No tiles of dataset <ID={entry.id}> overlap the reference area.")
+        return None
+
+    # one row per feature and band
+    frames = []
+    for fid in params.feature_ids:
+        if fid in statistics:
+            values = combine_raster_statistics(statistics[fid], params.spatial_aggregation)
+            frames.append(pd.DataFrame({"feature_id": fid, "band": np.arange(1, len(values) + 1), entry.variable.name.replace(" ", "_"): values}))
+
+    return _save_table(entry, pd.concat(frames, ignore_index=True), executor, params)
 
-    # this could be mirrored in the params
-    wbt.set_compress_rasters(True)
 
-    # set whitebox path to the newly created folder
-    wbt.set_working_dir(str(input_folder))
+def _sample_raster_files(entry: Metadata, fnames: list[str], executor: Scheduler, params: Params) -> str | None:
+    # each point is within one of the tiles, the samples of all other tiles are NaN
+    name = entry.variable.name.replace(" ", "_")
+    futures = [(fname, executor.submit_cpu(_rio_sample_raster, fname, params, name)) for fname in fnames]
+    frames = []
+    for fname, future in futures:
+        try:
+            frames.append(future.result())
+        except Exception as e:
+            logger.error(f"ERRORED: sampling {fname} of dataset <ID={entry.id}>: {str(e)}")
+
+    if len(frames) == 0:
+        logger.warning(f"No tiles of dataset <ID={entry.id}> could be sampled.")
+        return None
+
+    # keep the first valid sample of each point and band
+    table = pd.concat(frames, ignore_index=True).groupby(["feature_id", "band"], sort=True).first().reset_index()
+    return _save_table(entry, table, executor, params)
+
+
+def _rio_sample_raster(file_name: str, params: Params, name: str) -> pd.DataFrame:
+    # nodata cells are read as NaN
+    with io_environment(params), rioxarray.open_rasterio(file_name, masked=True, chunks={}) as da:
+        geometries = reference_geometries(params, da.rio.crs)
+        sampled = sample_points(da.to_dataset(name=name), geometries, params.point_interpolation)
+        table = sampled.compute().to_dataframe().reset_index()
+
+    return table[["feature_id", "band", name]]
+
+
+def _rio_raster_statistics(file_name: str, params: Params) -> dict[str, dict[str, np.ndarray]]:
+    # partial statistics of the tile per feature, weighted by the covered fraction of each cell
+    statistics = {}
+    with io_environment(params), rio.open(file_name, "r") as src:
+        geometries = reference_geometries(params, src.crs, cell_size=min(abs(r) for r in src.res))
+        windows = {}
+        for fid, geometry in geometries.items():
+            window = window_mask(geometry, src.transform, src.height, src.width, all_touched=True)
+            if window is not None:
+                windows[fid] = window
+        if len(windows) == 0:
+            logger.debug(f"Skipping {file_name} as it does not overlap with the reference area.")
+            return statistics
+
+        # read and reduce the blocks of the file one by one, a block is read once for all features it overlaps
+        rows, cols = union_window(list(windows.values()))
+        for _, block in src.block_windows(1):
+            block_rows = slice(max(block.row_off, rows.start), min(block.row_off + block.height, rows.stop))
+            block_cols = slice(max(block.col_off, cols.start), min(block.col_off + block.width, cols.stop))
+            if block_rows.start >= block_rows.stop or block_cols.start >= block_cols.stop:
+                continue
 
-    # run the mosaic tool on the raster source
-    wbt.mosaic(output=out_name, method="nn", callback=whitebox_log_handler)
+            data = None
+            for fid, (r, c, mask) in windows.items():
+                sub_rows = slice(max(r.start, block_rows.start), min(r.stop, block_rows.stop))
+                sub_cols = slice(max(c.start, block_cols.start), min(c.stop, block_cols.stop))
+                if sub_rows.start >= sub_rows.stop or sub_cols.start >= sub_cols.stop:
+                    continue
+                sub_mask = mask[sub_rows.start - r.start : sub_rows.stop - r.start, sub_cols.start - c.start : sub_cols.stop - c.start]
+                if not sub_mask.any():
+                    continue
+
+                if data is None:
+                    data = src.read(window=Window.from_slices(block_rows, block_cols))
+                fractions = coverage_fractions(geometries[fid], src.transform, (sub_rows, sub_cols, sub_mask))
+                weights = cell_weights(fractions, src.transform, sub_rows.start, src.crs.is_geographic)
+                values = data[:, sub_rows.start - block_rows.start : sub_rows.stop - block_rows.start, sub_cols.start - block_cols.start : sub_cols.stop - block_cols.start]
+                block_statistics = raster_statistics(values, src.nodata, fractions, weights)
+                statistics[fid] = merge_raster_statistics(statistics[fid], block_statistics) if fid in statistics else block_statistics
+
+    return statistics
@@ -0,0 +1,227 @@
+"""
+Cached clip masks for gridded datasources.
+
+Rasterising the reference area is the expensive part of clipping a netCDF file,
+but all variables and years of a datasource like HYRAS share the same grid.
+A GridMask holds the row / column window covering a geometry and the boolean
+cell mask within that window. Masks are cached per process, keyed by a grid
+fingerprint (CRS, transform, shape) and the key of the reference geometry, thus
+every further file on the same grid is clipped by a plain ``isel`` and ``where``.
+The cells are selected like ``rio.clip`` does, including ``all_touched``. For
+the aggregation, the masks additionally hold the fraction of each cell covered.
+
+Simplified geometries (see geometry.py) are rasterised first. The exact boundary
+lies within the tolerance of the simplified one, thus only the cells along the
+simplified boundary may differ, and these are decided against the exact geometry.
+Any part of a grid can be masked on its own, which lets large raster windows be
+clipped block by block (see raster.py).
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rioxarray
+import shapely
+import xarray as xr
+from affine import Affine
+from json2args.logger import logger
+from rasterio.features import geometry_mask
+from rasterio.windows import from_bounds
+from shapely.geometry.base import BaseGeometry
+
+from geometry import ReferenceGeometry
+
+# the masks are small, but a run might see many grids and features
+MAX_CACHED_MASKS = 256
+
+_MASKS: OrderedDict[tuple, "GridMask | None"] = OrderedDict()
+_MASKS_LOCK = threading.Lock()
+
+
+class GridMask:
+    def __init__(self, y_dim: str, x_dim: str, rows: slice, cols: slice, mask: np.ndarray, fractions: np.ndarray | None = None):
+        self.y_dim = y_dim
+        self.x_dim = x_dim
+        self.rows = rows
+        self.cols = cols
+        self.mask = mask
+
+        # the fraction of each cell covered by the geometry, only built for the aggregation
+        self.fractions = fractions
+
+    def apply(self, data: xr.Dataset, origin: tuple[int, int] = (0, 0)) -> xr.Dataset:
+        # the origin is the offset of data in the full grid, if it was already cut to a window
+        rows = slice(self.rows.start - origin[0], self.rows.stop - origin[0])
+        cols = slice(self.cols.start - origin[1], self.cols.stop - origin[1])
+        region = data.isel({self.y_dim: rows, self.x_dim: cols})
+
+        # only variables on the grid are masked, like rio.clip does
+        # where() drops the encoding, which holds the packing and fill value of the source
+        mask = xr.DataArray(self.mask, dims=(self.y_dim, self.x_dim))
+        for name, var in region.data_vars.items():
+            if self.y_dim in var.dims and self.x_dim in var.dims:
+                masked = var.where(mask)
+                masked.encoding = var.encoding
+                region[name] = masked
+
+        return region.rio.set_spatial_dims(x_dim=self.x_dim, y_dim=self.y_dim)
+
+
+def grid_fingerprint(data: xr.Dataset) -> tuple:
+    return (data.rio.crs.to_wkt(), tuple(data.rio.transform())[:6], data.rio.height, data.rio.width, data.rio.y_dim, data.rio.x_dim)
+
+
+def get_grid_mask(data: xr.Dataset, geometry: ReferenceGeometry, all_touched: bool, coverage: bool = False) -> GridMask | None:
+    # the geometry has to be in the CRS of the grid already
+    # for the coverage fractions, all touched cells are needed, as each one is covered partially
+    all_touched = all_touched or coverage
+    key = (grid_fingerprint(data), geometry.key, all_touched, coverage)
+    with _MASKS_LOCK:
+        if key in _MASKS:
+            _MASKS.move_to_end(key)
+            logger.debug(f"Reusing the cached clip mask of the feature '{geometry.feature_id}'.")
+            return _MASKS[key]
+
+    grid_mask = None
+    window = window_mask(geometry, data.rio.transform(), data.rio.height, data.rio.width, all_touched)
+    if window is not None:
+        rows, cols, mask = window
+        fractions = coverage_fractions(geometry, data.rio.transform(), window) if coverage else None
+        grid_mask = GridMask(y_dim=data.rio.y_dim, x_dim=data.rio.x_dim, rows=rows, cols=cols, mask=mask, fractions=fractions)
+        logger.debug(f"Rasterised the feature '{geometry.feature_id}' into {int(mask.sum())} cells of the {data.rio.height}x{data.rio.width} grid.")
+
+    with _MASKS_LOCK:
+        _MASKS[key] = grid_mask
+        while len(_MASKS) > MAX_CACHED_MASKS:
+            _MASKS.popitem(last=False)
+
+    return grid_mask
+
+
+def bounds_window(geometry: ReferenceGeometry, transform: Affine, height: int, width: int, pad: int = 1) -> tuple[slice, slice] | None:
+    # the rows and columns covering the bounding box of the geometry, padded by some cells for all_touched
+    window = from_bounds(*geometry.exact.bounds, transform=transform)
+    row_start, col_start = max(int(np.floor(window.row_off)) - pad, 0), max(int(np.floor(window.col_off)) - pad, 0)
+    row_stop, col_stop = min(int(np.ceil(window.row_off + window.height)) + pad, height), min(int(np.ceil(window.col_off + window.width)) + pad, width)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return slice(row_start, row_stop), slice(col_start, col_stop)
+
+
+def cell_mask(geometry: ReferenceGeometry, transform: Affine, shape: tuple[int, int], all_touched: bool, exact: bool = False) -> np.ndarray:
+    # the selected cells of a window with the given transform, which can be any part of the grid
+    # only the part of the geometry around the window is rasterised, thus large geometries are cheap to mask block by block
+    x0, y0 = transform * (-2, -2)
+    x1, y1 = transform * (shape[1] + 2, shape[0] + 2)
+    rect = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+    if exact or not geometry.simplified:
+        part = shapely.clip_by_rect(geometry.exact, *rect)
+        if part.is_empty:
+            return np.zeros(shape, dtype=bool)
+        return geometry_mask([part], out_shape=shape, transform=transform, all_touched=all_touched, invert=True)
+
+    # the simplified boundary next to the window can still decide its edge cells, thus it is rasterised with a margin
+    part = shapely.clip_by_rect(geometry.geometry, *rect)
+    padded_transform = transform * Affine.translation(-1, -1)
+    mask = np.zeros((shape[0] + 2, shape[1] + 2), dtype=bool)
+    if not part.is_empty:
+        mask = geometry_mask([part], out_shape=mask.shape, transform=padded_transform, all_touched=all_touched, invert=True)
+    _refine_boundary_cells(mask, geometry, padded_transform, all_touched, part)
+    return mask[1:-1, 1:-1]
+
+
+def window_mask(geometry: ReferenceGeometry, transform: Affine, height: int, width: int, all_touched: bool, exact: bool = False) -> tuple[slice, slice, np.ndarray] | None:
+    # rasterise only the window around the geometry
+    window = bounds_window(geometry, transform, height, width)
+    if window is None:
+        return None
+    row_window, col_window = window
+
+    win_transform = transform * Affine.translation(col_window.start, row_window.start)
+    mask = cell_mask(geometry, win_transform, (row_window.stop - row_window.start, col_window.stop - col_window.start), all_touched, exact=exact)
+    if not mask.any():
+        return None
+
+    # shrink the window to the selected cells
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    return (
+        slice(row_window.start + int(rows[0]), row_window.start + int(rows[-1]) + 1),
+        slice(col_window.start + int(cols[0]), col_window.start + int(cols[-1]) + 1),
+        mask[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1],
+    )
+
+
+def _refine_boundary_cells(mask: np.ndarray, geometry: ReferenceGeometry, transform: Affine, all_touched: bool, part: BaseGeometry):
+    # the exact boundary is within the tolerance (less than a cell) of the simplified boundary,
+    # thus only the cells along the simplified boundary and their neighbours can differ from the exact mask
+    # part is the simplified geometry around the mask, its cut edges are outside and only add some cells to check
+    if part.is_empty:
+        return
+    line = geometry_mask([part.boundary], out_shape=mask.shape, transform=transform, all_touched=True, invert=True)
+    padded = np.pad(line, 1)
+    band = np.zeros_like(line)
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            band |= padded[dy : dy + line.shape[0], dx : dx + line.shape[1]]
+    rows, cols = np.nonzero(band)
+
+    if all_touched:
+        x0, y0 = transform * (cols, rows)
+        x1, y1 = transform * (cols + 1, rows + 1)
+        cells = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+        mask[rows, cols] = shapely.intersects(geometry.exact, cells)
+    else:
+        xs, ys = transform * (cols + 0.5, rows + 0.5)
+        mask[rows, cols] = shapely.contains_xy(geometry.exact, xs, ys)
+
+
+def coverage_fractions(geometry: ReferenceGeometry, transform: Affine, window: tuple[slice, slice, np.ndarray]) -> np.ndarray:
+    # the fraction of each cell in the window that is covered by the exact geometry
+    rows, cols, mask = window
+    win_transform = transform * Affine.translation(cols.start, rows.start)
+    fractions = np.zeros(mask.shape, dtype="float64")
+
+    r, c = np.nonzero(mask)
+    x0, y0 = win_transform * (c, r)
+    x1, y1 = win_transform * (c + 1, r + 1)
+    xmin, xmax, ymin, ymax = np.minimum(x0, x1), np.maximum(x0, x1), np.minimum(y0, y1), np.maximum(y0, y1)
+
+    # cells within the geometry are covered fully, that is a fast test against the prepared geometry
+    cells = shapely.box(xmin, ymin, xmax, ymax)
+    inside = shapely.contains_properly(geometry.exact, cells)
+    fractions[r[inside], c[inside]] = 1.0
+
+    # the cells along the boundary are clipped row by row, thus each cell only clips a strip of the geometry
+    cell_area = abs(transform.a * transform.e - transform.b * transform.d)
+    for row in np.unique(r[~inside]):
+        sel = (r == row) & ~inside
+        strip = shapely.clip_by_rect(geometry.exact, xmin[sel].min(), ymin[sel][0], xmax[sel].max(), ymax[sel][0])
+        fractions[row, c[sel]] = [shapely.area(shapely.clip_by_rect(strip, *bounds)) / cell_area for bounds in zip(xmin[sel], ymin[sel], xmax[sel], ymax[sel], strict=True)]
+
+    return np.clip(fractions, 0.0, 1.0)
+
+
+def simplification_mismatches(geometry: ReferenceGeometry, transform: Affine, height: int, width: int, all_touched: bool) -> int:
+    # number of cells selected differently than by the exact geometry, to verify the simplification
+    cells = []
+    for exact in (False, True):
+        window = window_mask(geometry, transform, height, width, all_touched, exact=exact)
+        if window is None:
+            cells.append(set())
+            continue
+        rows, cols, mask = window
+        r, c = np.nonzero(mask)
+        cells.append(set(zip((r + rows.start).tolist(), (c + cols.start).tolist(), strict=True)))
+
+    return len(cells[0] ^ cells[1])
+
+
+def union_window(windows: list) -> tuple[slice, slice]:
+    # the window covering all masks, either GridMasks or (rows, cols, mask) tuples
+    bounds = [(w.rows, w.cols) if isinstance(w, GridMask) else w[:2] for w in windows]
+    rows = slice(min(r.start for r, _ in bounds), max(r.stop for r, _ in bounds))
+    cols = slice(min(c.start for _, c in bounds), max(c.stop for _, c in bounds))
+    return rows, cols
@@ -6,6 +6,7 @@ This could be a general pattern for json2args. We would need a factory function
 that consumes the yml to build the model and uses the inputs.json to instantiate it
 """
 
+import re
 import tempfile
 from datetime import datetime
 from enum import Enum
@@ -13,6 +14,7 @@ from pathlib import Path
 from typing import List
 
 import geopandas as gpd
+import pandas as pd
 from pydantic import BaseModel, Field
 
 
@@ -20,6 +22,56 @@ class NetCDFBackends(str, Enum):
     XARRAY = "xarray"
     CDO = "cdo"
     PARQUET = "parquet"
+    ZARR = "zarr"
+
+
+class NetCDFEncodings(str, Enum):
+    DEFAULT = "default"
+    FAST = "fast"
+    COMPACT = "compact"
+    TIMESERIES = "timeseries"
+
+
+class DaskSchedulers(str, Enum):
+    THREADS = "threads"
+    PROCESSES = "processes"
+    DISTRIBUTED = "distributed"
+
+
+class Reducers(str, Enum):
+    MEAN = "mean"
+    SUM = "sum"
+    MIN = "min"
+    MAX = "max"
+
+
+class PointInterpolations(str, Enum):
+    NEAREST = "nearest"
+    BILINEAR = "bilinear"
+
+
+class TemporalResolutions(str, Enum):
+    HOURLY = "hourly"
+    DAILY = "daily"
+    MONTHLY = "monthly"
+    YEARLY = "yearly"
+
+
+class RasterCompressions(str, Enum):
+    NONE = "none"
+    DEFLATE = "deflate"
+    LZW = "lzw"
+    ZSTD = "zstd"
+
+
+class TableFormats(str, Enum):
+    CSV = "csv"
+    PARQUET = "parquet"
+
+
+class CSVEngines(str, Enum):
+    PANDAS = "pandas"
+    POLARS = "polars"
 
 
 class Params(BaseModel):
@@ -32,10 +84,86 @@ class Params(BaseModel):
     end_date: datetime = None
     cell_touches: bool = True
 
+    # simplify detailed reference areas to the grid resolution before rasterising, the selected cells do not change
+    simplify_reference_area: bool = False
+
+    # reduce gridded sources to one area-weighted value per time step and feature, written as a table
+    spatial_aggregation: Reducers | None = None
+    aggregation_format: TableFormats = TableFormats.CSV
+
+    # gridded sources are sampled at point features, instead of clipped
+    point_interpolation: PointInterpolations = PointInterpolations.NEAREST
+
+    # reduce the time axis to a coarser resolution while loading, None keeps the native resolution
+    temporal_resolution: TemporalResolutions | None = None
+    temporal_reducer: Reducers = Reducers.MEAN
+
+    # worker counts for the I/O-bound and CPU-bound pools, None derives them from the available cores
+    io_workers: int | None = None
+    cpu_workers: int | None = None
+
+    # clip the files of multi-file netCDF sources in parallel, one file per task
+    netcdf_parallel: bool = True
+
+    # number of concurrent cdo subprocesses of the cdo backend and the threads of each one (cdo -P), None uses the CPU workers
+    cdo_workers: int | None = None
+    cdo_threads: int = 1
+
+    # keep a persistent index of the time range and bounding box of each file in multi-file sources
+    use_file_index: bool = True
+    index_path: str | None = None
+
+    # read sorted CSV files by byte range using a sidecar timestamp to byte-offset index
+    csv_time_index: bool = False
+
+    # stream SQL results in batches of this many rows into the output file, None reads the full result at once
+    sql_batch_size: int | None = None
+
+    # split the time range of database sources into this many windows, which are queried concurrently
+    sql_partitions: int = 1
+
+    # netCDF files are processed lazily in chunks of about this size, aligned to the on-disk chunks. None uses the on-disk chunks as they are
+    dask_chunk_size: str | None = "128MiB"
+
+    # the dask scheduler for the chunked netCDF processing, a distributed cluster is started locally, if no address is given
+    dask_scheduler: DaskSchedulers = DaskSchedulers.THREADS
+    dask_workers: int | None = None
+    dask_scheduler_address: str | None = None
+
+    # encoding profile of netCDF outputs and whether to keep the scale_factor / add_offset packing of the source
+    netcdf_encoding: NetCDFEncodings = NetCDFEncodings.DEFAULT
+    keep_packing: bool = True
+
+    # write parquet outputs of netCDF sources into one hive partition per year
+    parquet_partition_by_year: bool = False
+
+    # number of time steps per chunk of zarr outputs, None derives it from the clipped area
+    zarr_time_chunk: int | None = None
+
+    # raster windows are clipped and written in blocks of this many cells per side, which are also the output tiles
+    raster_block_size: int = Field(default=512, ge=16, multiple_of=16)
+
+    # the clipped parts of tiled raster sources are combined by a VRT, optionally materialised as a single COG
+    raster_cog: bool = False
+
+    # compression of the GeoTIFF outputs, the predictor is picked by the data type
+    raster_compression: RasterCompressions = RasterCompressions.DEFLATE
+    raster_predictor: bool = True
+
+    # GDAL block cache and threads, and the netCDF chunk cache per worker process, None derives them from the available cores and memory
+    gdal_cache_mb: int | None = None
+    gdal_num_threads: int | None = None
+    netcdf_chunk_cache_mb: int | None = None
+
+    # reuse clipped outputs of earlier runs from a local cache, None disables the cache
+    cache_path: str | None = None
+    cache_max_size_mb: int = 10240
+
     # stuff that we do not change in the tool
     base_path: str = "/out"
     dataset_folder_name: str = "datasets"
     netcdf_backend: NetCDFBackends = NetCDFBackends.XARRAY
+    csv_engine: CSVEngines = CSVEngines.POLARS
 
     @property
     def dataset_path(self) -> Path:
@@ -56,6 +184,64 @@ class Params(BaseModel):
 
         return p
 
+    @property
+    def intermediate_path(self) -> Path:
+        # files that are merged into the outputs, like the parts of the cdo backend
+        p = Path(self.base_path) / "intermediate"
+        p.mkdir(parents=True, exist_ok=True)
+
+        return p
+
+    @property
+    def reference_features(self) -> list[dict]:
+        # the reference area can be a FeatureCollection, a single Feature or a bare geometry
+        if self.reference_area is None:
+            return []
+        if self.reference_area.get("type") == "FeatureCollection":
+            return self.reference_area["features"]
+        if self.reference_area.get("type") == "Feature":
+            return [self.reference_area]
+        return [{"type": "Feature", "geometry": self.reference_area, "properties": {}}]
+
+    @property
+    def feature_ids(self) -> list[str]:
+        # use the feature id, an id property or the position, made safe to be used as a folder name
+        ids = []
+        for n, feature in enumerate(self.reference_features):
+            fid = feature.get("id", (feature.get("properties") or {}).get("id"))
+            fid = re.sub(r"[^\w\-.]", "_", str(fid)) if fid is not None else f"feature_{n}"
+
+            # make duplicates unique
+            unique, k = fid, 1
+            while unique in ids:
+                unique = f"{fid}_{k}"
+                k += 1
+            ids.append(unique)
+
+        return ids
+
+    @property
+    def point_features(self) -> bool:
+        # a reference area of points only is sampled instead of clipped
+        features = self.reference_features
+        return len(features) > 0 and all((feature.get("geometry") or {}).get("type") == "Point" for feature in features)
+
+    @property
+    def multi_feature(self) -> bool:
+        return len(self.reference_features) > 1
+
+    def feature_path(self, feature_id: str) -> Path:
+        # with many features, each one gets its own subfolder in the datasets path
+        if not self.multi_feature:
+            return self.dataset_path
+
+        p = self.dataset_path / feature_id
+        p.mkdir(parents=True, exist_ok=True)
+        return p
+
     @property
     def reference_area_df(self) -> gpd.GeoDataFrame:
-        return gpd.GeoDataFrame.from_features([self.reference_area])
+        # the features are indexed by their id, GeoJSON is always WGS84
+        df = gpd.GeoDataFrame.from_features(self.reference_features, crs=4326)
+        df.index = pd.Index(self.feature_ids, name="feature_id")
+        return df
@@ -0,0 +1,195 @@
+"""
+Build the SQL queries for database datasources.
+
+All values are passed as bound parameters. The time range and the reference
+area are pushed into the database, so that only the rows we actually keep are
+transferred. If PostGIS is available, the bounding box prefilter is followed by
+an exact intersection with the reference area. Otherwise, only the coordinate
+range of the reference area is used as a predicate.
+
+Long time ranges can be split into time windows, which are then queried
+concurrently. Each database URI gets one engine with a connection pool, which
+keeps a connection for every window of every concurrently loaded dataset
+(io_workers x sql_partitions). Up to as many additional connections are opened
+on demand, e.g. for the metadata queries, beyond that a read waits for a free
+connection, thus a run never opens more than twice the pool size.
+A temporal aggregation is pushed into the database as well, by grouping the
+filtered rows by their truncated timestamps (see temporal.py). The time windows
+then start at period boundaries, thus no period is split between two windows.
+"""
+
+import threading
+from datetime import datetime
+
+import pandas as pd
+from json2args.logger import logger
+from metacatalog_api.models import Metadata
+from sqlalchemy import Engine, create_engine, text
+
+from param import Params
+from temporal import SQL_FUNCTIONS, floor_to_period, sql_time_bucket
+
+# one engine with a connection pool per database URI
+_ENGINES: dict[str, Engine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+# remember per database, if PostGIS is available
+_POSTGIS_AVAILABLE: dict[str, bool] = {}
+
+
+def get_engine(uri: str, pool_size: int = 5) -> Engine:
+    # the engine is shared by all threads, which might be streaming from it, thus it is never replaced
+    # at most pool_size connections beyond the pool size are opened on demand and closed once returned
+    with _ENGINES_LOCK:
+        if uri not in _ENGINES:
+            _ENGINES[uri] = create_engine(uri, pool_size=pool_size, max_overflow=pool_size, pool_pre_ping=True)
+            logger.debug(f"Created a connection pool of size {pool_size} for {_ENGINES[uri].url.render_as_string(hide_password=True)}")
+        elif pool_size > _ENGINES[uri].pool.size():
+            engine = _ENGINES[uri]
+            logger.warning(f"A connection pool of size {pool_size} was requested for {engine.url.render_as_string(hide_password=True)}, but the existing pool keeps {engine.pool.size()} connections. Reads beyond {2 * engine.pool.size()} connections wait for a free one.")
+
+    return _ENGINES[uri]
+
+
+def has_postgis(engine: Engine) -> bool:
+    url = engine.url.render_as_string(hide_password=True)
+    if url not in _POSTGIS_AVAILABLE:
+        _POSTGIS_AVAILABLE[url] = _check_postgis(engine)
+    return _POSTGIS_AVAILABLE[url]
+
+
+def _check_postgis(engine: Engine) -> bool:
+    if engine.dialect.name != "postgresql":
+        return False
+    try:
+        with engine.connect() as connection:
+            return connection.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'postgis'")).first() is not None
+    except Exception as e:
+        logger.debug(f"Could not check for the PostGIS extension: {str(e)}")
+        return False
+
+
+def build_select(entry: Metadata, params: Params, engine: Engine, table: str | None = None, time_window: tuple[datetime, datetime, bool] | None = None) -> tuple[str, dict]:
+    datasource = entry.datasource
+    if table is None:
+        table = datasource.path
+
+    # select the columns
+    columns = datasource.variable_names
+    if datasource.temporal_scale is not None:
+        columns = [*datasource.temporal_scale.dimension_names, *columns]
+    if datasource.spatial_scale is not None:
+        columns = [*columns, *datasource.spatial_scale.dimension_names]
+    if len(columns) == 0:
+        columns = ["*"]
+
+    predicates, bind = [], {}
+
+    # filter the time range, a time window includes its end only if it is the last one
+    if datasource.temporal_scale is not None and time_window is not None:
+        dim_name = datasource.temporal_scale.dimension_names[0]
+        window_start, window_end, closed = time_window
+        predicates.append(f"{dim_name} >= :start_date")
+        predicates.append(f"{dim_name} {'<=' if closed else '<'} :end_date")
+        bind.update(start_date=window_start, end_date=window_end)
+    elif datasource.temporal_scale is not None:
+        dim_name = datasource.temporal_scale.dimension_names[0]
+        if params.start_date is not None:
+            predicates.append(f"{dim_name} >= :start_date")
+            bind["start_date"] = params.start_date
+        if params.end_date is not None:
+            predicates.append(f"{dim_name} <= :end_date")
+            bind["end_date"] = params.end_date
+
+    # filter the reference area
+    if datasource.spatial_scale is not None and params.reference_area is not None:
+        predicates.extend(_spatial_predicates(datasource.spatial_scale.dimension_names, params, has_postgis(engine), bind))
+
+    sql = f"SELECT {', '.join(columns)} FROM {table}"
+    if len(predicates) > 0:
+        sql += f" WHERE {' AND '.join(predicates)}"
+
+    # reduce the time axis in the database, thus only the aggregated rows are transferred
+    if datasource.temporal_scale is not None and params.temporal_resolution is not None:
+        sql = _group_by_time(sql, entry, params, engine.dialect.name)
+
+    return sql, bind
+
+
+def _group_by_time(sql: str, entry: Metadata, params: Params, dialect: str) -> str:
+    datasource = entry.datasource
+    dim_name = datasource.temporal_scale.dimension_names[0]
+    bucket = sql_time_bucket(dim_name, params.temporal_resolution, dialect)
+    if bucket is None:
+        logger.warning(f"The temporal aggregation can not be pushed into '{dialect}' databases. Dataset <ID={entry.id}> is loaded in its native resolution.")
+        return sql
+
+    # the location columns are kept as groups, all variables are reduced
+    keys = [bucket, *(datasource.spatial_scale.dimension_names if datasource.spatial_scale is not None else [])]
+    reducer = SQL_FUNCTIONS[params.temporal_reducer]
+    columns = [f"{bucket} AS {dim_name}", *[f"{reducer}({name}) AS {name}" for name in datasource.variable_names], *keys[1:]]
+    return f"SELECT {', '.join(columns)} FROM ({sql}) AS source GROUP BY {', '.join(keys)} ORDER BY {', '.join(keys)}"
+
+
+def time_windows(entry: Metadata, params: Params, engine: Engine, table: str, n: int) -> list[tuple[datetime, datetime, bool]]:
+    if entry.datasource.temporal_scale is None or n < 2:
+        return []
+    dim_name = entry.datasource.temporal_scale.dimension_names[0]
+
+    # use the requested time range and ask the database for the missing bounds
+    start, end = params.start_date, params.end_date
+    if start is None or end is None:
+        with engine.connect() as connection:
+            row = connection.execute(text(f"SELECT MIN({dim_name}), MAX({dim_name}) FROM {table}")).one()
+        start = start if start is not None else row[0]
+        end = end if end is not None else row[1]
+    if start is None or end is None:
+        return []
+
+    # the database might return naive timestamps, while the requested dates have a timezone
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if start.tzinfo is None and end.tzinfo is not None:
+        start = start.tz_localize(end.tzinfo)
+    elif end.tzinfo is None and start.tzinfo is not None:
+        end = end.tz_localize(start.tzinfo)
+    if start >= end:
+        return []
+
+    edges = pd.date_range(start, end, periods=n + 1).to_pydatetime()
+
+    # with a temporal aggregation, the inner edges are moved to the start of their period
+    if params.temporal_resolution is not None:
+        inner = sorted({floor_to_period(edge, params.temporal_resolution).to_pydatetime() for edge in edges[1:-1]})
+        edges = [edges[0], *[edge for edge in inner if edges[0] < edge < edges[-1]], edges[-1]]
+        n = len(edges) - 1
+        if n < 2:
+            return []
+
+    return [(edges[i], edges[i + 1], i == n - 1) for i in range(n)]
+
+
+def _spatial_predicates(dimension_names: list[str], params: Params, postgis: bool, bind: dict) -> list[str]:
+    # GeoJSON reference areas are always WGS84, which is also what metacatalog uses
+    geometry = params.reference_area_df.geometry.union_all()
+    minx, miny, maxx, maxy = geometry.bounds
+    bind.update(minx=minx, miny=miny, maxx=maxx, maxy=maxy)
+
+    # two dimensions are x and y coordinate columns
+    if len(dimension_names) >= 2:
+        x, y = dimension_names[0], dimension_names[1]
+        predicates = [f"{x} BETWEEN :minx AND :maxx", f"{y} BETWEEN :miny AND :maxy"]
+        if postgis:
+            bind["wkt"] = geometry.wkt
+            predicates.append(f"ST_Intersects(ST_GeomFromText(:wkt, 4326), ST_SetSRID(ST_MakePoint({x}, {y}), 4326))")
+        return predicates
+
+    # a single dimension is a geometry column, which can only be filtered with PostGIS
+    elif len(dimension_names) == 1:
+        if not postgis:
+            logger.warning(f"The spatial dimension '{dimension_names[0]}' is a geometry column, but PostGIS is not available. The reference area is not applied.")
+            return []
+        geom = dimension_names[0]
+        bind["wkt"] = geometry.wkt
+        return [f"{geom} && ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326)", f"ST_Intersects({geom}, ST_GeomFromText(:wkt, 4326))"]
+
+    return []
@@ -0,0 +1,113 @@
+"""
+Block-streaming clip and mosaic of raster files.
+
+Large catchments on high resolution DEMs do not fit into memory as a single
+array. The window covering a feature is therefore processed in blocks that are
+aligned to the tiles of the output GeoTIFF: each block is read, masked and written
+on its own, thus the memory used is bounded by the block size and does not depend
+on the size of the catchment. Blocks outside of the feature are not read at all,
+and blocks that lie within it are written without rasterising.
+The outputs are tiled and compressed GeoTIFFs.
+
+The clipped parts of tiled sources are combined by a VRT, a small XML file that
+references the parts, thus the mosaic costs no extra copy. Optionally, the mosaic
+is materialised into a single Cloud-Optimized GeoTIFF with overviews.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+import shapely
+from rasterio.windows import Window
+from rasterio.windows import bounds as window_bounds
+
+from geometry import ReferenceGeometry
+from masks import bounds_window, cell_mask
+
+
+def fill_value(dtype: str, nodata: float | None) -> float:
+    # the nodata value of the source is kept, otherwise -9999 is used, if the data type can hold it
+    if nodata is not None:
+        return nodata
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu" or np.iinfo(dtype).min <= -9999:
+        return -9999
+    # unsigned integers use their maximum, small signed integers their minimum
+    return np.iinfo(dtype).max if dtype.kind == "u" else np.iinfo(dtype).min
+
+
+def clip_raster_blocks(src: rio.DatasetReader, geometry: ReferenceGeometry, out_path: Path, all_touched: bool, nodata: float, options: dict) -> int | None:
+    # the geometry has to be in the CRS of the raster already, the options are the GeoTIFF creation options (see environment.py)
+    # returns the number of bytes read, or None if no cell is selected
+    window = bounds_window(geometry, src.transform, src.height, src.width, pad=0)
+    if window is None:
+        return None
+    rows, cols = window
+    height, width = rows.stop - rows.start, cols.stop - cols.start
+
+    block_size = options["blockxsize"]
+    profile = {key: value for key, value in src.profile.items() if key in ("dtype", "count", "crs")}
+    profile.update(options, height=height, width=width, transform=src.window_transform(Window.from_slices(rows, cols)), nodata=nodata)
+
+    n_read, n_selected = 0, 0
+    with rio.open(str(out_path), "w", **profile) as dst:
+        for row in range(0, height, block_size):
+            for col in range(0, width, block_size):
+                block = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+                source_block = Window(cols.start + col, rows.start + row, block.width, block.height)
+                transform = src.window_transform(source_block)
+                cell_box = shapely.box(*window_bounds(source_block, src.transform))
+
+                # blocks outside of the geometry are only filled
+                if not geometry.exact.intersects(cell_box):
+                    dst.write(np.full((src.count, block.height, block.width), nodata, dtype=profile["dtype"]), window=block)
+                    continue
+
+                data = src.read(window=source_block)
+                n_read += data.nbytes
+                if geometry.exact.contains(cell_box):
+                    n_selected += block.height * block.width
+                else:
+                    mask = cell_mask(geometry, transform, (block.height, block.width), all_touched)
+                    data[:, ~mask] = nodata
+                    n_selected += int(mask.sum())
+                dst.write(data, window=block)
+
+    # the bounding box might not select a single cell
+    if n_selected == 0:
+        Path(out_path).unlink()
+        return None
+
+    return n_read
+
+
+def build_mosaic(tiles: list[str], base_path: Path, name: str, cog: bool, config: dict[str, int], options: list[str]) -> str:
+    # the GDAL bindings are only needed for the mosaic, thus all other sources load without them
+    from osgeo import gdal
+
+    gdal.UseExceptions()
+
+    # the GDAL bindings use their own GDAL library, thus the config options are set on it directly
+    for key, value in config.items():
+        gdal.SetConfigOption(key, str(value))
+
+    # several tiles are combined by a VRT, which only references them and is written instantly
+    source = tiles[0]
+    if len(tiles) > 1:
+        source = str(base_path / f"{name}.vrt")
+        vrt = gdal.BuildVRT(source, sorted(tiles))
+        vrt.FlushCache()
+        vrt = None
+    if not cog:
+        return source
+
+    # the COG holds all tiles and overviews in a single file, which replaces the tiles
+    target = base_path / f"{name}.tif"
+    tmp_target = base_path / f"{name}.cog.tif"
+    gdal.Translate(str(tmp_target), source, format="COG", creationOptions=options)
+    for path in {*tiles, source}:
+        Path(path).unlink(missing_ok=True)
+    tmp_target.replace(target)
+
+    return str(target)
@@ -2,7 +2,7 @@ import os
 import sys
 import platform
 import time
-from concurrent.futures import ThreadPoolExecutor as PoolExecutor
+from concurrent.futures import as_completed
 
 from json2args import get_parameter
 from json2args.logger import logger
@@ -11,9 +11,13 @@ from dotenv import load_dotenv
 from tqdm import tqdm
 from metacatalog_api import core
 from metacatalog_api import __version__ as metacatalog_version
+from metacatalog_api.models import Metadata
 from param import Params
 from loader import load_entry_data
-from utils import reference_area_to_file
+from cache import ResultCache
+from environment import describe_environment
+from scheduler import Scheduler, start_dask_cluster
+from utils import reference_area_to_file, resolve_entries
 from version import __version__
 
 # always load .env files
@@ -53,6 +57,11 @@ START DATE:         {params.start_date}
 END DATE:           {params.end_date}
 REFERENCE AREA:     {params.reference_area is not None}
 CELL TOUCHES:       {params.cell_touches}
+I/O WORKERS:        {params.io_workers or 'auto'}
+CPU WORKERS:        {params.cpu_workers or 'auto'}
+DASK SCHEDULER:     {params.dask_scheduler.value} (chunk size: {params.dask_chunk_size or 'on-disk'})
+RESULT CACHE:       {params.cache_path or 'disabled'}
+I/O SETTINGS:       {describe_environment(params)}
 
 DATASET IDS:
 {', '.join(map(str, params.dataset_ids))}
@@ -88,46 +97,95 @@ tool_start = time.time()
 # debug the params before we do anything with them
 #logger.debug(f"JSON dump of parameters received: {params.model_dump_json()}")
 
+# the scheduler forks its CPU workers right away, thus it is created before any other thread is started
+scheduler = Scheduler(io_workers=params.io_workers, cpu_workers=params.cpu_workers)
+
+# start a local dask cluster, if the distributed scheduler is requested without an address
+# this has to happen before any task is submitted, as the tasks connect to it
+dask_cluster = None
+if params.dask_scheduler == 'distributed' and params.dask_scheduler_address is None:
+    dask_cluster = start_dask_cluster(params)
+
 # save the reference area to a file for later reuse
+# the loading tasks depend on it, as they may read the file
+reference_area_future = None
 if params.reference_area is not None:
-    reference_area = reference_area_to_file(params)
+    reference_area_future = scheduler.submit_io(reference_area_to_file, params, add_ascii=params.netcdf_backend == 'cdo')
+
+# the result cache is optional
+cache = None
+if params.cache_path is not None:
+    cache = ResultCache(params.cache_path, params.cache_max_size_mb)
+
+
+def load_dataset(entry: Metadata) -> dict | None:
+    # check the cache for the clipped output of an earlier run
+    cache_key = cache.key(entry, params) if cache is not None else None
+    if cache_key is not None:
+        data_path = cache.restore(cache_key, params.dataset_path)
+        if data_path is not None:
+            return {'entry': entry, 'data_path': data_path}
+
+    # load the entry and return the data path
+    data_path = load_entry_data(entry, scheduler, params)
+
+    # if data_path is None, we skip this step
+    if data_path is None:
+        logger.error(f"Could not load data for dataset <ID={entry.id}>. The content of '/out/datasets' might miss something.")
+        return None
+
+    # return the mapping from entry to data_path
+    return {'entry': entry, 'data_path': data_path, 'cache_key': cache_key}
+
 
 # load the datasets
 # save the entries and their data_paths for later use
-file_mapping = []
-with PoolExecutor() as executor:
-    logger.debug(f"START {type(executor).__name__} - Pool to load and clip data source files.")
-    logger.info(f"A total of {len(params.dataset_ids)} are requested. Start loading data sources.")
-    
-    for dataset_id in tqdm(params.dataset_ids):
+logger.debug(f"START {type(scheduler).__name__} - {scheduler.io_workers} I/O workers and {scheduler.cpu_workers} CPU workers to load and clip data source files.")
+logger.info(f"A total of {len(params.dataset_ids)} are requested. Start loading data sources.")
+
+# resolve the metadata of all requested datasets at once
+t1 = time.time()
+entries = resolve_entries(params.dataset_ids)
+logger.info(f"Resolved the metadata of {len(entries)} datasets in {time.time() - t1:.2f} seconds.")
+
+# load the entries concurrently, an id that is requested several times is processed once per occurrence
+futures = {}
+for position, dataset_id in enumerate(params.dataset_ids):
+    if dataset_id not in entries:
+        logger.error(f"Could not find dataset <ID={dataset_id}>.")
+        continue
+    futures[scheduler.submit_io(load_dataset, entries[dataset_id], depends_on=[reference_area_future])] = (position, dataset_id)
+results = {}
+for future in tqdm(as_completed(futures), total=len(futures)):
+    position, dataset_id = futures[future]
+    try:
+        results[position] = future.result()
+    except Exception as e:
+        logger.exception(f"ERRORED on dataset <ID={dataset_id}>.\nError: {str(e)}")
+
+# keep the mapping in the order of the requested dataset ids
+file_mapping = [results[position] for position in sorted(results) if results[position] is not None]
+
+# wait until all results are finished
+scheduler.shutdown(wait=True)
+logger.info(f"STOP {type(scheduler).__name__} - Pools finished all tasks and shutdown.")
+scheduler.report()
+if dask_cluster is not None:
+    dask_cluster.close()
+
+# store the new results in the cache, after all their files are written
+if cache is not None:
+    stored_keys = set()
+    for mapping in file_mapping:
+        # the repeated occurrences of a dataset share their cache key
+        if mapping.get('cache_key') is None or mapping['cache_key'] in stored_keys:
+            continue
+        stored_keys.add(mapping['cache_key'])
         try:
-            matches = core.entries(ids=dataset_id)
-            if len(matches) == 0:
-                logger.error(f"Could not find dataset <ID={dataset_id}>.")
-                continue
-            elif len(matches) > 1:
-                logger.warning(f"Found multiple datasets with ID <ID={dataset_id}>. Using the first one.")
-                entry = matches[0]
-            else:
-                entry = matches[0]
-            
-            # load the entry and return the data path
-            data_path = load_entry_data(entry, executor, params)
-
-            # if data_path is None, we skip this step
-            if data_path is None:
-                logger.error(f"Could not load data for dataset <ID={dataset_id}>. The content of '/out/datasets' might miss something.")
-                continue
-
-            # save the mapping from entry to data_path
-            file_mapping.append({'entry': entry, 'data_path': data_path})
+            cache.store(mapping['cache_key'], mapping['entry'], mapping['data_path'], params.dataset_path)
         except Exception as e:
-            logger.exception(f"ERRORED on dataset <ID={dataset_id}>.\nError: {str(e)}")
-            continue
-    
-    # wait until all results are finished
-    executor.shutdown(wait=True)
-    logger.info(f"STOP {type(executor).__name__} - Pool finished all tasks and shutdown.")
+            logger.warning(f"Could not store dataset <ID={mapping['entry'].id}> in the result cache: {str(e)}")
+    cache.report()
 
 # we're finished.
 t2 = time.time()
@@ -0,0 +1,47 @@
+"""
+Sampling of gridded datasources at point features.
+
+Reference areas made of points, like gauges or stations, are not clipped, but the
+cell values at their locations are read. All points are looked up at once, for all
+time steps together. 'nearest' reads the cell that contains the point: the
+coordinates are converted into cell indices by the inverse grid transform and the
+cells are gathered by a vectorised ``isel``. 'bilinear' interpolates between the
+four surrounding cell centers with xarray's ``interp``. Points outside of the grid
+are NaN.
+"""
+
+import numpy as np
+import rioxarray
+import xarray as xr
+
+from geometry import ReferenceGeometry
+from param import PointInterpolations
+
+
+def sample_points(data: xr.Dataset, geometries: dict[str, ReferenceGeometry], method: PointInterpolations) -> xr.Dataset:
+    # the geometries have to be in the CRS of the grid already
+    y_dim, x_dim = data.rio.y_dim, data.rio.x_dim
+    data = data[[name for name, var in data.data_vars.items() if y_dim in var.dims and x_dim in var.dims]]
+
+    xs = np.array([geometry.exact.x for geometry in geometries.values()])
+    ys = np.array([geometry.exact.y for geometry in geometries.values()])
+
+    if method == PointInterpolations.NEAREST:
+        # pointwise indexing of all points at once, points outside of the grid are masked afterwards
+        cols, rows = ~data.rio.transform() * (xs, ys)
+        rows, cols = np.floor(rows).astype(int), np.floor(cols).astype(int)
+        height, width = data.rio.height, data.rio.width
+        valid = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        indexers = {
+            y_dim: xr.DataArray(np.clip(rows, 0, height - 1), dims="feature_id"),
+            x_dim: xr.DataArray(np.clip(cols, 0, width - 1), dims="feature_id"),
+        }
+        sampled = data.isel(indexers).where(xr.DataArray(valid, dims="feature_id"))
+    else:
+        # the cell centers are the coordinates, points beyond the outermost centers are NaN
+        indexers = {y_dim: xr.DataArray(ys, dims="feature_id"), x_dim: xr.DataArray(xs, dims="feature_id")}
+        sampled = data.interp(indexers, method="linear")
+
+    # the cell coordinates of the points are not needed in the table
+    sampled = sampled.drop_vars([name for name in sampled.coords if name not in sampled.dims])
+    return sampled.assign_coords(feature_id=list(geometries.keys()))
@@ -0,0 +1,261 @@
+"""
+Task scheduling for the loader.
+
+The Scheduler wraps two pools: a thread pool for I/O-bound work (database reads,
+file opens, writes) and a process pool for CPU-bound work (rasterio / rioxarray
+clipping). It implements the ``concurrent.futures.Executor`` interface, so it can
+be passed wherever the loader expects an executor. ``submit`` always goes to the
+I/O pool, CPU-bound work has to be submitted explicitly using ``submit_cpu``.
+
+Tasks can depend on other futures: they are only handed to a pool once all
+dependencies have finished. Every task is timed, so the Scheduler can report the
+summed task time against the wall-clock time at the end of the run.
+
+The worker processes are forked once, when the Scheduler is created. At that
+point the main thread is the only thread running, thus the workers can not
+inherit a lock held by another thread, like those of the logging, HDF5 or GDAL.
+
+Chunked netCDF processing runs on dask within these tasks. ``dask_config`` sets
+the configured dask scheduler for the current process, a distributed cluster is
+started once by the main process and every worker process connects to it.
+Within the CPU workers, dask only uses the worker's share of the cores.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import StrEnum
+
+import dask
+from json2args.logger import logger
+
+from param import Params
+
+
+class TaskKind(StrEnum):
+    IO = "io"
+    CPU = "cpu"
+
+
+def default_io_workers() -> int:
+    # same default as the ThreadPoolExecutor uses
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def default_cpu_workers() -> int:
+    return os.cpu_count() or 1
+
+
+# the number of dask workers of the tasks in this process, only set in the CPU worker processes
+_CPU_WORKER_THREADS: int | None = None
+
+
+def _init_cpu_worker(threads: int):
+    global _CPU_WORKER_THREADS
+    _CPU_WORKER_THREADS = threads
+
+
+def _noop():
+    return None
+
+
+def _timed_call(fn: Callable, *args, **kwargs) -> tuple[object, float]:
+    # this has to be a module level function, so that it can be pickled for the process pool
+    t1 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    t2 = time.perf_counter()
+
+    return result, t2 - t1
+
+
+class Scheduler(Executor):
+    def __init__(self, io_workers: int | None = None, cpu_workers: int | None = None):
+        self.io_workers = io_workers if io_workers is not None else default_io_workers()
+        self.cpu_workers = cpu_workers if cpu_workers is not None else default_cpu_workers()
+
+        # the tool script has no main guard, thus the workers are forked, as spawning would run it again
+        # all workers are forked by the first task, which runs here, before any other thread is started
+        threads = max(1, default_cpu_workers() // self.cpu_workers)
+        self._cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_cpu_worker, initargs=(threads,))
+        self._cpu_pool.submit(_noop).result()
+        self._io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="loader-io")
+
+        # bookkeeping for the final report
+        self._lock = threading.Lock()
+        self._task_time = {TaskKind.IO: 0.0, TaskKind.CPU: 0.0}
+        self._task_count = {TaskKind.IO: 0, TaskKind.CPU: 0}
+        self._failed_count = 0
+        self._pending: set[Future] = set()
+        self._started = time.perf_counter()
+        self._stopped = None
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        return self.submit_io(fn, *args, **kwargs)
+
+    def submit_io(self, fn: Callable, /, *args, depends_on: Iterable[Future] = (), **kwargs) -> Future:
+        return self._submit(TaskKind.IO, fn, args, kwargs, depends_on)
+
+    def submit_cpu(self, fn: Callable, /, *args, depends_on: Iterable[Future] = (), **kwargs) -> Future:
+        return self._submit(TaskKind.CPU, fn, args, kwargs, depends_on)
+
+    def _submit(self, kind: TaskKind, fn: Callable, args: tuple, kwargs: dict, depends_on: Iterable[Future]) -> Future:
+        # the outer future is handed to the caller and resolved once the task finished
+        outer = Future()
+        with self._lock:
+            self._pending.add(outer)
+        outer.add_done_callback(self._forget)
+
+        dependencies = [dep for dep in depends_on if dep is not None]
+        if len(dependencies) == 0:
+            self._dispatch(kind, fn, args, kwargs, outer)
+            return outer
+
+        # count down the unfinished dependencies and dispatch once the last one is done
+        remaining = [len(dependencies)]
+        counter_lock = threading.Lock()
+
+        def on_dependency_done(dep: Future):
+            with counter_lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if not last:
+                return
+
+            # a failed dependency fails the task without running it
+            for d in dependencies:
+                if d.cancelled() or d.exception() is not None:
+                    exc = d.exception() if not d.cancelled() else RuntimeError("A dependency of this task was cancelled.")
+                    if outer.set_running_or_notify_cancel():
+                        outer.set_exception(exc)
+                    return
+            self._dispatch(kind, fn, args, kwargs, outer)
+
+        for dep in dependencies:
+            dep.add_done_callback(on_dependency_done)
+
+        return outer
+
+    def _dispatch(self, kind: TaskKind, fn: Callable, args: tuple, kwargs: dict, outer: Future):
+        pool = self._io_pool if kind == TaskKind.IO else self._cpu_pool
+        try:
+            inner = pool.submit(_timed_call, fn, *args, **kwargs)
+        except Exception as e:
+            # like a broken process pool or a pool that was shut down, the outer future has to be resolved anyway
+            with self._lock:
+                self._failed_count += 1
+            if outer.set_running_or_notify_cancel():
+                outer.set_exception(e)
+            return
+
+        def on_done(inner: Future):
+            if not outer.set_running_or_notify_cancel():
+                return
+            exc = inner.exception()
+            if exc is not None:
+                with self._lock:
+                    self._failed_count += 1
+                outer.set_exception(exc)
+                return
+
+            result, duration = inner.result()
+            with self._lock:
+                self._task_time[kind] += duration
+                self._task_count[kind] += 1
+            outer.set_result(result)
+
+        inner.add_done_callback(on_done)
+
+    def _forget(self, future: Future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def wait(self):
+        # tasks may submit new tasks, thus wait until nothing is pending anymore
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if len(pending) == 0:
+                return
+            for future in pending:
+                try:
+                    future.exception()
+                except Exception:
+                    pass
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        if wait:
+            self.wait()
+        self._io_pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+        self._cpu_pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+        if self._stopped is None:
+            self._stopped = time.perf_counter()
+
+    def report(self) -> str:
+        wall = (self._stopped or time.perf_counter()) - self._started
+        io_time = self._task_time[TaskKind.IO]
+        cpu_time = self._task_time[TaskKind.CPU]
+
+        msg = (
+            f"Scheduler report: wall-clock time {wall:.2f} seconds.\n"
+            f"  I/O pool ({self.io_workers} workers):  {self._task_count[TaskKind.IO]} tasks, summed task time {io_time:.2f} seconds, "
+            f"average parallelism {io_time / wall if wall > 0 else 0:.2f}\n"
+            f"  CPU pool ({self.cpu_workers} workers): {self._task_count[TaskKind.CPU]} tasks, summed task time {cpu_time:.2f} seconds, "
+            f"average parallelism {cpu_time / wall if wall > 0 else 0:.2f}\n"
+            f"  Failed tasks: {self._failed_count}\n"
+            "  Note: entry-level I/O tasks include the time they wait for their CPU tasks."
+        )
+        logger.info(msg)
+        return msg
+
+
+# one client per process, connected to the cluster of the main process
+_DASK_CLIENTS: dict[str, object] = {}
+_DASK_CLIENTS_LOCK = threading.Lock()
+
+
+def start_dask_cluster(params: Params):
+    # the distributed scheduler is optional
+    try:
+        from dask.distributed import LocalCluster
+    except ImportError as e:
+        raise ImportError("The 'distributed' dask scheduler requires the 'distributed' package: pip install 'dask[distributed]'") from e
+
+    cluster = LocalCluster(n_workers=params.dask_workers, threads_per_worker=1, processes=True)
+    params.dask_scheduler_address = cluster.scheduler_address
+    logger.info(f"Started a local dask cluster with {len(cluster.workers)} workers at {cluster.scheduler_address}.")
+
+    return cluster
+
+
+def _dask_client(address: str):
+    from dask.distributed import Client
+
+    with _DASK_CLIENTS_LOCK:
+        if address not in _DASK_CLIENTS:
+            _DASK_CLIENTS[address] = Client(address, set_as_default=False)
+        return _DASK_CLIENTS[address]
+
+
+@contextmanager
+def dask_config(params: Params) -> Iterator[None]:
+    # the scheduler has to be set while the tasks are built, as xarray picks its file locks depending on it
+    if params.dask_scheduler == "distributed":
+        if params.dask_scheduler_address is None:
+            raise ValueError("The 'distributed' dask scheduler needs a running cluster, but no scheduler address is set.")
+        config = {"scheduler": _dask_client(params.dask_scheduler_address)}
+    else:
+        # like the CPU pool, the processes are forked, as spawning would re-run the tool script, which has no main guard
+        config = {"scheduler": params.dask_scheduler.value, "multiprocessing.context": "fork"}
+
+        # the CPU workers already run in parallel, thus each one only uses its share of the cores, unless set explicitly
+        if params.dask_workers is not None:
+            config["num_workers"] = params.dask_workers
+        elif _CPU_WORKER_THREADS is not None:
+            config["num_workers"] = _CPU_WORKER_THREADS
+
+    with dask.config.set(config):
+        yield
@@ -0,0 +1,113 @@
+"""
+Temporal aggregation of datasources to a coarser resolution while loading.
+
+Instead of writing the native resolution, the time axis is reduced to hourly,
+daily, monthly or yearly values with one of the reducers shared with the spatial
+aggregation. Each period is labelled by its start. The reduction is applied where
+the data is read: lazily by xarray for netCDF sources, by the polars or pandas
+reader for CSV sources and as a GROUP BY over the truncated timestamps for
+database sources, thus only the reduced data is ever written.
+Columns describing the location, like the coordinates of a station, are kept as
+group keys, while all other columns are reduced.
+"""
+
+import pandas as pd
+import polars as pl
+import xarray as xr
+
+from param import Reducers, TemporalResolutions
+
+PANDAS_FREQUENCIES = {
+    TemporalResolutions.HOURLY: "h",
+    TemporalResolutions.DAILY: "D",
+    TemporalResolutions.MONTHLY: "MS",
+    TemporalResolutions.YEARLY: "YS",
+}
+
+POLARS_INTERVALS = {
+    TemporalResolutions.HOURLY: "1h",
+    TemporalResolutions.DAILY: "1d",
+    TemporalResolutions.MONTHLY: "1mo",
+    TemporalResolutions.YEARLY: "1y",
+}
+
+SQL_UNITS = {
+    TemporalResolutions.HOURLY: "hour",
+    TemporalResolutions.DAILY: "day",
+    TemporalResolutions.MONTHLY: "month",
+    TemporalResolutions.YEARLY: "year",
+}
+
+# the cdo statistics operators are named by the period and the reducer, like 'monmean'
+CDO_PERIODS = {
+    TemporalResolutions.HOURLY: "hour",
+    TemporalResolutions.DAILY: "day",
+    TemporalResolutions.MONTHLY: "mon",
+    TemporalResolutions.YEARLY: "year",
+}
+
+SQL_FUNCTIONS = {
+    Reducers.MEAN: "AVG",
+    Reducers.SUM: "SUM",
+    Reducers.MIN: "MIN",
+    Reducers.MAX: "MAX",
+}
+
+# sqlite has no date_trunc, the timestamps are formatted to the start of their period instead
+SQLITE_FORMATS = {
+    TemporalResolutions.HOURLY: "%Y-%m-%d %H:00:00",
+    TemporalResolutions.DAILY: "%Y-%m-%d 00:00:00",
+    TemporalResolutions.MONTHLY: "%Y-%m-01 00:00:00",
+    TemporalResolutions.YEARLY: "%Y-01-01 00:00:00",
+}
+
+
+def resample_xarray(data: xr.Dataset, time_dim: str, resolution: TemporalResolutions, reducer: Reducers) -> xr.Dataset:
+    # stays lazy for dask backed data, the reduction runs chunk-wise
+    resampler = data.resample({time_dim: PANDAS_FREQUENCIES[resolution]})
+    return getattr(resampler, reducer.value)()
+
+
+def resample_polars(data: pl.LazyFrame, time_col: str, resolution: TemporalResolutions, reducer: Reducers, group_by: list[str] | None = None) -> pl.LazyFrame:
+    group_by = [col for col in (group_by or []) if col != time_col]
+    schema = data.collect_schema()
+    values = [col for col, dtype in schema.items() if col != time_col and col not in group_by and (dtype.is_numeric() or reducer in (Reducers.MIN, Reducers.MAX))]
+
+    # the windows are built per group, thus the data has to be sorted by the groups first
+    return (
+        data.sort([*group_by, time_col])
+        .group_by_dynamic(time_col, every=POLARS_INTERVALS[resolution], group_by=group_by or None)
+        .agg([getattr(pl.col(col), reducer.value)() for col in values])
+        .select([time_col, *values, *group_by])
+    )
+
+
+def resample_pandas(data: pd.DataFrame, time_col: str, resolution: TemporalResolutions, reducer: Reducers, group_by: list[str] | None = None) -> pd.DataFrame:
+    # the time can be a column or the index
+    frame = data.reset_index() if time_col not in data.columns else data
+    group_by = [col for col in (group_by or []) if col != time_col]
+    values = [col for col in frame.columns if col != time_col and col not in group_by and (pd.api.types.is_numeric_dtype(frame[col]) or reducer in (Reducers.MIN, Reducers.MAX))]
+
+    grouper = [*group_by, pd.Grouper(key=time_col, freq=PANDAS_FREQUENCIES[resolution])]
+    reduced = frame.groupby(grouper)[values].agg(reducer.value).reset_index()
+    return reduced[[*group_by, time_col, *values]]
+
+
+def sql_time_bucket(column: str, resolution: TemporalResolutions, dialect: str) -> str | None:
+    # the expression that truncates the timestamps to the start of their period
+    if dialect == "postgresql":
+        return f"date_trunc('{SQL_UNITS[resolution]}', {column})"
+    if dialect == "sqlite":
+        return f"strftime('{SQLITE_FORMATS[resolution]}', {column})"
+    return None
+
+
+def floor_to_period(timestamp: pd.Timestamp, resolution: TemporalResolutions) -> pd.Timestamp:
+    # the start of the period the timestamp is in, keeping its timezone
+    timestamp = pd.Timestamp(timestamp)
+    naive = timestamp.tz_localize(None) if timestamp.tzinfo is not None else timestamp
+    if resolution in (TemporalResolutions.HOURLY, TemporalResolutions.DAILY):
+        start = naive.floor(PANDAS_FREQUENCIES[resolution])
+    else:
+        start = naive.to_period("M" if resolution == TemporalResolutions.MONTHLY else "Y").to_timestamp()
+    return start.tz_localize(timestamp.tzinfo) if timestamp.tzinfo is not None else start
@@ -2,38 +2,40 @@ from pathlib import Path
 import os
 import geopandas as gpd
 from json2args.logger import logger
+from metacatalog_api import core
+from metacatalog_api import models
+from metacatalog_api.models import Metadata
+from sqlalchemy.orm import selectinload
+from sqlmodel import col, select
 
 from param import Params
 
-# define a handler for whiteboxgis tools verbose output
-def whitebox_log_handler(msg: str):
-    # following https://www.whiteboxgeo.com/manual/wbt_book/python_scripting/tool_output.html
-    # we can ignore all lines that contain a '%' sign as that is the progress bar
-    if '%' in msg or msg.startswith('*'):
-        return
-    elif 'error' in msg.lower():
-        logger.error(f"WhiteboxTools Errored: {msg}")
-    else:
-        logger.debug(f"WhiteboxTools info: {msg}")
-
 
 def reference_area_to_file(params: Params, add_ascii: bool = False) -> str:
     # params = load_params()
 
-    # create a geodataframe
-    df = gpd.GeoDataFrame.from_features([params.reference_area])
+    # create a geodataframe with one row per feature
+    df = params.reference_area_df
 
     # save the reference area as a geojson file
     path = Path(params.base_path) / 'reference_area.geojson'
     df.to_file(path, driver='GeoJSON')
 
-    # save the coordinates to a ascii file
+    # save the coordinates to a ascii file, one per feature, as used by cdo selregion
     if add_ascii:
-        path = Path(params.base_path) / 'reference_area.ascii'
-        df.get_coordinates().to_csv(path, sep=' ', header=False, index=False)
+        for fid in df.index:
+            path = reference_area_ascii_path(params, fid)
+            df.loc[[fid]].get_coordinates().to_csv(path, sep=' ', header=False, index=False)
 
     return str(path)
 
+
+def reference_area_ascii_path(params: Params, feature_id: str) -> Path:
+    # with many features, each one gets its own file
+    if not params.multi_feature:
+        return Path(params.base_path) / 'reference_area.ascii'
+    return Path(params.base_path) / f'reference_area_{feature_id}.ascii'
+
 def parse_catchment_id(file_path: str) -> str:
     """
     Extract catchment ID from filename.
@@ -41,4 +43,47 @@ def parse_catchment_id(file_path: str) -> str:
     CAMELS_DE_discharge_sim_DE910910.csv -> DE910910
     """
     fname = os.path.basename(file_path)
-    return fname.rsplit("_", 1)[-1].replace(".csv", "").strip()
\ No newline at end of file
+    return fname.rsplit("_", 1)[-1].replace(".csv", "").strip()
+
+
+# all relationships that are needed to build the Metadata models, loaded with one query per relationship
+ENTRY_EAGER_LOADS = [
+    selectinload(models.EntryTable.license),
+    selectinload(models.EntryTable.author),
+    selectinload(models.EntryTable.coAuthors),
+    selectinload(models.EntryTable.variable).selectinload(models.VariableTable.unit),
+    selectinload(models.EntryTable.variable).selectinload(models.VariableTable.keyword).selectinload(models.KeywordTable.thesaurus),
+    selectinload(models.EntryTable.keywords).selectinload(models.KeywordTable.thesaurus),
+    selectinload(models.EntryTable.details).selectinload(models.DetailTable.thesaurus),
+    selectinload(models.EntryTable.datasource).selectinload(models.DatasourceTable.type),
+    selectinload(models.EntryTable.datasource).selectinload(models.DatasourceTable.temporal_scale),
+    selectinload(models.EntryTable.datasource).selectinload(models.DatasourceTable.spatial_scale),
+]
+
+
+def resolve_entries(dataset_ids: list[int], chunk_size: int = 500) -> dict[int, Metadata]:
+    """
+    Load the metadata of all requested dataset ids in bulk, instead of one query per id.
+    Ids that match several entries are logged as warnings, the first match is used in that case.
+    Missing ids are not part of the result.
+    """
+    # the metadata of an id requested several times is only queried once
+    unique_ids = list(dict.fromkeys(dataset_ids))
+
+    matches: dict[int, list[Metadata]] = {i: [] for i in unique_ids}
+    with core.connect() as session:
+        for start in range(0, len(unique_ids), chunk_size):
+            chunk = unique_ids[start:start + chunk_size]
+            sql = select(models.EntryTable).where(col(models.EntryTable.id).in_(chunk)).options(*ENTRY_EAGER_LOADS)
+            for entry in session.exec(sql).all():
+                matches[entry.id].append(Metadata.model_validate(entry))
+
+    entries = {}
+    for dataset_id, found in matches.items():
+        if len(found) == 0:
+            continue
+        elif len(found) > 1:
+            logger.warning(f"Found multiple datasets with ID <ID={dataset_id}>. Using the first one.")
+        entries[dataset_id] = found[0]
+
+    return entries
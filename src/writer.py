@@ -1,21 +1,31 @@
+import csv
+import functools
+import io
 import json
 import shutil
 import time
+from collections.abc import Iterable
 from concurrent.futures import Executor, Future
 from datetime import datetime as dt
 from decimal import Decimal
 from pathlib import Path
 from typing import Optional, Union
 
+import dask
+import numpy as np
 import pandas as pd
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import xarray as xr
+import zarr
 from dask.dataframe import DataFrame as DaskDataFrame
 from json2args.logger import logger
 from metacatalog_api.models import Metadata
 
 # create a union of all supported Dataframe types
-DataFrame = Union[pd.DataFrame, DaskDataFrame, pl.DataFrame]
+DataFrame = Union[pd.DataFrame, DaskDataFrame, pl.DataFrame, pl.LazyFrame]
 
 
 # create a custom serializer for Entry dict
@@ -57,7 +67,7 @@ def dispatch_save_file(
             logger.info(f"Saved metadata for dataset <ID={entry.id}> to {metafile_name}.")
 
     # switch the data type
-    if isinstance(data, (pd.DataFrame, DaskDataFrame, pl.DataFrame)):
+    if isinstance(data, (pd.DataFrame, DaskDataFrame, pl.DataFrame, pl.LazyFrame)):
         if str(target_path).endswith("csv"):
             future = executor.submit(dataframe_to_csv_saver, data, target_path)
         else:
@@ -84,7 +94,7 @@ def dispatch_result_saver(file_name: str, data: DataFrame, executor: Executor) -
             logger.error(f"Saving result file {file_name} errored: {str(exc)}")
 
     # switch the data type:
-    if isinstance(data, (pd.DataFrame, DaskDataFrame, pl.DataFrame)):
+    if isinstance(data, (pd.DataFrame, DaskDataFrame, pl.DataFrame, pl.LazyFrame)):
         future = executor.submit(dataframe_to_parquet_saver, data, file_name)
     else:
         raise NotImplementedError(f"Right now, the result handler can only dispatch save actions for DataFrames. Got a {type(data)} instead.")
@@ -99,10 +109,13 @@ def dataframe_to_parquet_saver(data: DataFrame, target_name: str) -> str:
     if isinstance(data, pd.DataFrame):
         data.to_parquet(target_name, index=False)
     elif isinstance(data, DaskDataFrame):
-        for partition in data.partitions:
-            partition.compute().to_parquet(target_name, append=True, index=False)
+        # pandas can't append to parquet files, thus each partition is written as row group of a single file
+        tables = (pa.Table.from_pandas(partition.compute(), preserve_index=False) for partition in data.partitions)
+        _write_arrow_tables(tables, target_name)
     elif isinstance(data, pl.DataFrame):
         data.write_parquet(target_name)
+    elif isinstance(data, pl.LazyFrame):
+        _sink_lazyframe(data, target_name, "parquet")
     else:
         logger.error(f"Could not save {target_name} as it is not a pandas or dask dataframe. Got a {type(data)} instead.")
     t2 = time.time()
@@ -113,39 +126,381 @@ def dataframe_to_parquet_saver(data: DataFrame, target_name: str) -> str:
     return target_name
 
 
+# the temporary column name of an unnamed pandas index
+UNNAMED_INDEX = "__unnamed_index__"
+
+# timestamps are written with a space and fractional seconds only if there are any, like pandas does
+CSV_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S%.f"
+
+
 def dataframe_to_csv_saver(data: DataFrame, target_name: str) -> str:
+    # all inputs are encoded by polars, dask partitions are appended one by one and the header is written once
     t1 = time.time()
-    if isinstance(data, pd.DataFrame):
-        data.to_csv(target_name, index=True)
+    rows = None
+    if isinstance(data, pl.LazyFrame):
+        _sink_lazyframe(data, target_name, "csv")
+    elif isinstance(data, (pd.DataFrame, DaskDataFrame, pl.DataFrame)):
+        rows = _write_csv_batches(_polars_batches(data), target_name)
+    else:
+        logger.error(f"Could not save {target_name} as it is not a pandas, polars or dask dataframe. Got a {type(data)} instead.")
+    t2 = time.time()
+
+    if rows is not None:
+        logger.info(f"Finished writing {rows} rows to {target_name} after {t2 - t1:.2f} seconds ({rows / max(t2 - t1, 1e-9):.0f} rows/s).")
+    else:
+        logger.info(f"Finished writing {target_name} after {t2 - t1:.2f} seconds.")
+    return target_name
+
+
+def _polars_batches(data: pd.DataFrame | DaskDataFrame | pl.DataFrame) -> Iterable[pl.DataFrame]:
+    if isinstance(data, pl.DataFrame):
+        yield data
     elif isinstance(data, DaskDataFrame):
         for partition in data.partitions:
-            partition.compute().to_csv(target_name, index=True)
-    elif isinstance(data, pl.DataFrame):
-        data.write_csv(target_name)
+            yield _pandas_to_polars(partition.compute())
     else:
-        logger.error(f"Could not save {target_name} as it is not a pandas, polars or dask dataframe. Got a {type(data)} instead.")
+        yield _pandas_to_polars(data)
+
+
+def _pandas_to_polars(data: pd.DataFrame) -> pl.DataFrame:
+    # the index is always written as first column, like pandas' to_csv does, an unnamed index gets an empty header
+    if isinstance(data.index, pd.MultiIndex) or data.index.name is not None:
+        return pl.from_pandas(data.reset_index())
+    return pl.from_pandas(data.rename_axis(UNNAMED_INDEX).reset_index()).rename({UNNAMED_INDEX: ""})
+
+
+def _csv_datetimes(batch: pl.DataFrame) -> pl.DataFrame:
+    # the timestamps are written like pandas' to_csv does: dates only, if all are at midnight, and with their UTC offset, if any
+    columns = []
+    for name, dtype in batch.schema.items():
+        if not isinstance(dtype, pl.Datetime):
+            continue
+        if dtype.time_zone is not None:
+            columns.append(pl.col(name).dt.to_string(f"{CSV_DATETIME_FORMAT}%:z"))
+        elif batch[name].dt.time().drop_nulls().eq(dt.min.time()).all():
+            columns.append(pl.col(name).dt.date())
+    return batch.with_columns(columns) if len(columns) > 0 else batch
+
+
+def _write_csv_batches(batches: Iterable[pl.DataFrame], target_name: str) -> int:
+    # append each batch to the file, only the first one writes the header
+    # the header is written by the csv module, as polars quotes the empty name of an unnamed index
+    rows = 0
+    with open(target_name, "wb") as f:
+        for batch in batches:
+            if rows == 0:
+                header = io.StringIO()
+                csv.writer(header, lineterminator="\n").writerow(batch.columns)
+                f.write(header.getvalue().encode())
+            _csv_datetimes(batch).write_csv(f, include_header=False, datetime_format=CSV_DATETIME_FORMAT)
+            rows += len(batch)
+
+    return rows
+
+
+def dataframe_batches_saver(batches: Iterable[pl.DataFrame], target_name: str) -> str:
+    # append each batch to the output file as it arrives, so the memory is bounded by the batch size
+    t1 = time.time()
+    if str(target_name).endswith(".parquet"):
+        rows = _write_arrow_tables((batch.to_arrow() for batch in batches), target_name)
+    else:
+        rows = _write_csv_batches(batches, target_name)
     t2 = time.time()
 
-    logger.info(f"Finished writing {target_name} after {t2 - t1:.2f} seconds.")
+    logger.info(f"Finished streaming {rows} rows to {target_name} after {t2 - t1:.2f} seconds ({rows / max(t2 - t1, 1e-9):.0f} rows/s).")
     return target_name
 
 
-def xarray_to_netcdf_saver(data: xr.Dataset, target_name: str) -> str:
+def _write_arrow_tables(tables: Iterable[pa.Table], target_name: str, **kwargs) -> int:
+    # a single writer for all tables, each table becomes at least one row group
+    writer = None
+    rows = 0
+    try:
+        for table in tables:
+            if writer is None:
+                writer = pq.ParquetWriter(target_name, table.schema, **kwargs)
+            writer.write_table(table.cast(writer.schema))
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
+
+
+def _sink_lazyframe(data: pl.LazyFrame, target_name: str, fmt: str):
+    # stream the lazy query into the file, so that the data never has to fit into memory
+    try:
+        if fmt == "csv":
+            data.sink_csv(target_name, datetime_format=CSV_DATETIME_FORMAT)
+        else:
+            data.sink_parquet(target_name)
+    except pl.exceptions.InvalidOperationError as e:
+        # not every query plan can be streamed, collect it in that case
+        logger.debug(f"writer._sink_lazyframe: could not stream into {target_name}, collecting the data instead: {str(e)}")
+        if fmt == "csv":
+            data.collect().write_csv(target_name, datetime_format=CSV_DATETIME_FORMAT)
+        else:
+            data.collect().write_parquet(target_name)
+
+
+def xarray_to_netcdf_saver(data: xr.Dataset, target_name: str, profile: str = "default", keep_packing: bool = True) -> str:
     # the netCDF is may already be written by the extracting process if CDO was used
     if Path(target_name).exists():
         logger.debug(f"writer.xarray_to_netcdf_saver: {target_name} already exists. Skipping.")
         return target_name
 
+    # the default profile keeps the encoding of the source
+    kwargs = {}
+    if profile != "default" or not keep_packing:
+        kwargs["encoding"] = netcdf_encoding(data, profile=profile, keep_packing=keep_packing)
+    if profile == "fast":
+        # contiguous variables can't have an unlimited dimension
+        kwargs["unlimited_dims"] = ()
+
+    # dask-backed data is written chunk by chunk, but xarray cannot share its file lock with dask worker processes
+    # thus the chunks are read, clipped and written using threads, if the processes scheduler is set
     t1 = time.time()
-    data.to_netcdf(target_name)
+    if dask.config.get("scheduler", None) == "processes":
+        with dask.config.set(scheduler="threads"):
+            data.to_netcdf(target_name, **kwargs)
+    else:
+        data.to_netcdf(target_name, **kwargs)
     t2 = time.time()
 
     # after finishing add a log message
-    logger.info(f"Finished writing {target_name} after {t2 - t1:.2f} seconds.")
+    size = Path(target_name).stat().st_size / 1024 / 1024
+    logger.info(f"Finished writing {target_name} with the '{profile}' encoding profile after {t2 - t1:.2f} seconds: {size:.2f} MiB.")
+
+    return target_name
+
+
+# the valid netCDF4 encoding keys, and those that pack floats into integers
+NETCDF_ENCODING_KEYS = ("dtype", "scale_factor", "add_offset", "_FillValue", "zlib", "complevel", "shuffle", "chunksizes", "contiguous", "fletcher32")
+NETCDF_PACKING_KEYS = ("dtype", "scale_factor", "add_offset")
+
+# the chunks of the timeseries profile hold about this many bytes
+NETCDF_TIMESERIES_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def netcdf_encoding(data: xr.Dataset, profile: str = "default", keep_packing: bool = True) -> dict[str, dict]:
+    """
+    Build the netCDF encoding of all data variables for one of the profiles:
+
+    - default: the encoding of the source, without chunks that do not fit the clipped shape
+    - fast: no compression and contiguous storage
+    - compact: zlib and shuffle, float64 is stored as float32, unless the packing of the source is kept
+    - timeseries: light compression and chunks spanning the full time axis
+
+    With keep_packing, the scale_factor / add_offset packing of the source is preserved, otherwise the unpacked floats are written.
+    """
+    encoding = {}
+    for name, var in data.data_vars.items():
+        inherited = var.encoding
+        packed = "scale_factor" in inherited or "add_offset" in inherited
+
+        if profile == "default":
+            enc = {key: value for key, value in inherited.items() if key in NETCDF_ENCODING_KEYS}
+            if inherited.get("original_shape") != var.shape:
+                enc.pop("chunksizes", None)
+        else:
+            enc = {"_FillValue": inherited["_FillValue"]} if "_FillValue" in inherited else {}
+            enc.update({key: inherited[key] for key in NETCDF_PACKING_KEYS if key in inherited})
+
+        # the unpacked data is written as floats, with NaN as fill value
+        if packed and not keep_packing:
+            for key in NETCDF_PACKING_KEYS:
+                enc.pop(key, None)
+            enc["_FillValue"] = np.nan
+            packed = False
+
+        if profile == "fast":
+            enc.update(zlib=False, contiguous=True)
+        elif profile == "compact":
+            enc.update(zlib=True, complevel=4, shuffle=True)
+            if not packed and var.dtype == np.float64:
+                enc["dtype"] = "float32"
+        elif profile == "timeseries":
+            enc.update(zlib=True, complevel=1, shuffle=True, chunksizes=_timeseries_chunks(var))
+        elif profile != "default":
+            raise ValueError(f"Unknown netCDF encoding profile '{profile}'.")
+
+        encoding[name] = enc
+
+    return encoding
+
+
+def _timeseries_chunks(var: xr.DataArray) -> tuple[int, ...] | None:
+    # the time axis is the dimension with a datetime coordinate
+    time_dims = [dim for dim in var.dims if dim in var.coords and np.issubdtype(var.coords[dim].dtype, np.datetime64)]
+    if len(time_dims) == 0 or var.ndim == 0:
+        return None
+    time_dim = time_dims[0]
+
+    # the other dimensions share the remaining bytes of the chunk
+    n_time = var.sizes[time_dim]
+    other = var.ndim - 1
+    edge = int((NETCDF_TIMESERIES_CHUNK_BYTES / (n_time * var.dtype.itemsize)) ** (1 / other)) if other > 0 else 1
+
+    return tuple(n_time if dim == time_dim else max(1, min(size, edge)) for dim, size in var.sizes.items())
+
+
+# each row group of gridded parquet outputs holds about this many rows
+PARQUET_ROW_GROUP_ROWS = 1_000_000
+
+
+def xarray_to_parquet_saver(data: xr.Dataset, target_name: str, time_dim: str | None = None, partition_by_year: bool = False) -> str:
+    # the cube is converted to a long table block by block along the time axis, so only one block is held in memory
+    cells = int(np.prod([size for dim, size in data.sizes.items() if dim != time_dim]))
+    if time_dim in data.dims:
+        step = max(1, PARQUET_ROW_GROUP_ROWS // max(1, cells))
+        blocks = (data.isel({time_dim: slice(i, i + step)}) for i in range(0, data.sizes[time_dim], step))
+    else:
+        blocks = iter([data])
+
+    # with hive partitioning, each year gets a folder next to the target, which holds a file of the same name
+    target = Path(target_name)
+    writers = {}
+    rows = 0
+    t1 = time.time()
+    try:
+        for block in blocks:
+            table = _xarray_block_to_table(block.load(), time_dim)
+            if table.num_rows == 0:
+                continue
+
+            parts = _split_table_by_year(table, time_dim, target) if partition_by_year and time_dim in data.dims else [(target, table)]
+            for path, part in parts:
+                if path not in writers:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    coord_columns = [name for name in part.column_names if name not in data.data_vars]
+                    writers[path] = pq.ParquetWriter(path, part.schema, use_dictionary=coord_columns, compression="zstd")
+                writers[path].write_table(part)
+            rows += table.num_rows
+    finally:
+        for writer in writers.values():
+            writer.close()
+    t2 = time.time()
+
+    # after finishing add a log message
+    logger.info(f"Finished streaming {rows} rows into {len(writers)} parquet files at {target_name} after {t2 - t1:.2f} seconds.")
+
+    return str(target.parent) if partition_by_year else target_name
+
+
+def _xarray_block_to_table(block: xr.Dataset, time_dim: str | None) -> pa.Table:
+    # all variables are broadcast to the dimensions of the first one
+    template = next(iter(block.data_vars.values()))
+    dims = list(template.dims)
+    shape = template.shape
+
+    # the dimension coordinates are dictionary-encoded, the index of each cell along the dimension is the dictionary index
+    columns = {}
+    for axis, dim in enumerate(dims):
+        index = np.broadcast_to(np.arange(shape[axis]).reshape([-1 if a == axis else 1 for a in range(len(dims))]), shape).ravel()
+        values = block[dim].values if dim in block.coords else np.arange(shape[axis])
+        if dim == time_dim:
+            columns[dim] = pa.array(values[index])
+        else:
+            columns[dim] = pa.DictionaryArray.from_arrays(pa.array(index.astype(np.int32)), pa.array(values))
+
+    # other coordinates, like 2D latitude and longitude
+    for name, coord in block.coords.items():
+        if name not in dims and coord.ndim > 0 and set(coord.dims) <= set(dims):
+            columns[name] = pa.array(coord.broadcast_like(template).transpose(*dims).values.ravel())
+
+    for name, var in block.data_vars.items():
+        columns[name] = pa.array(var.broadcast_like(template).transpose(*dims).values.ravel(), from_pandas=True)
+    table = pa.table(columns)
+
+    # drop the cells outside of the clipped area, where all variables are missing
+    valid = functools.reduce(pc.or_, [pc.is_valid(table[name]) for name in block.data_vars])
+    return table.filter(valid)
+
+
+def _split_table_by_year(table: pa.Table, time_dim: str, target: Path) -> list[tuple[Path, pa.Table]]:
+    years = pc.year(table[time_dim])
+    parts = []
+    for year in pc.unique(years).to_pylist():
+        parts.append((target.parent / f"year={year}" / target.name, table.filter(pc.equal(years, year))))
+
+    return parts
+
+
+# the chunks of a new zarr store hold about this many bytes, spanning as many time steps as possible
+ZARR_CHUNK_BYTES = 4 * 1024 * 1024
+ZARR_MAX_SPATIAL_CHUNK = 256
+
+
+def xarray_to_zarr_saver(data: xr.Dataset, target_name: str, append_dim: str | None = None, time_chunk: int | None = None) -> str:
+    # the first write creates the store, all further writes are appended along the time dimension
+    exists = Path(target_name).exists()
+    if exists and append_dim is None:
+        raise ValueError(f"Can't append to {target_name}, as the dataset has no time dimension.")
+
+    t1 = time.time()
+    if not exists:
+        chunks = {name: _zarr_chunks(var, append_dim, time_chunk) for name, var in data.data_vars.items()}
+        encoding = {name: {"chunks": tuple(var_chunks[dim] for dim in data[name].dims), **_zarr_compressor()} for name, var_chunks in chunks.items()}
+        data = _align_to_zarr_chunks(data, chunks, append_dim, offset=0)
+        data.to_zarr(target_name, mode="w-", encoding=encoding, consolidated=True)
+    else:
+        # the new data has to be chunked like the store, starting at the current end of the time axis
+        with xr.open_zarr(target_name) as store:
+            offset = store.sizes[append_dim]
+            chunks = {name: dict(zip(store[name].dims, store[name].encoding["chunks"], strict=True)) for name in data.data_vars}
+        data = _align_to_zarr_chunks(data, chunks, append_dim, offset=offset)
+        data.to_zarr(target_name, append_dim=append_dim, consolidated=True)
+    t2 = time.time()
+
+    # after finishing add a log message
+    logger.info(f"Finished {'appending to' if exists else 'writing'} {target_name} after {t2 - t1:.2f} seconds.")
 
     return target_name
 
 
+def _zarr_chunks(var: xr.DataArray, append_dim: str | None, time_chunk: int | None) -> dict[str, int]:
+    # the spatial chunks cover the clipped area, so that a time series needs only a few chunk reads
+    chunks = {dim: max(1, min(size, ZARR_MAX_SPATIAL_CHUNK)) for dim, size in var.sizes.items() if dim != append_dim}
+    if append_dim in var.dims:
+        if time_chunk is None:
+            cell_bytes = var.dtype.itemsize * max(1, int(np.prod(list(chunks.values()))))
+            time_chunk = ZARR_CHUNK_BYTES // cell_bytes
+        chunks[append_dim] = max(1, time_chunk)
+
+    return chunks
+
+
+def _align_to_zarr_chunks(data: xr.Dataset, chunks: dict[str, dict[str, int]], append_dim: str | None, offset: int) -> xr.Dataset:
+    # dask chunks must not overlap the zarr chunks, thus the first chunk fills up the last chunk of the store
+    data = data.copy()
+    for name, var_chunks in chunks.items():
+        dask_chunks = dict(var_chunks)
+        if append_dim in data[name].dims:
+            size, step = data.sizes[append_dim], var_chunks[append_dim]
+            first = min(size, (step - offset % step) % step or step)
+            rest = size - first
+            dask_chunks[append_dim] = tuple(c for c in (first, *[step] * (rest // step), rest % step) if c > 0)
+        data[name] = data[name].chunk(dask_chunks)
+
+        # drop the inherited netCDF encoding, it does not apply to zarr
+        data[name].encoding = {key: value for key, value in data[name].encoding.items() if key in ("dtype", "scale_factor", "add_offset", "_FillValue")}
+
+    return data
+
+
+def _zarr_compressor() -> dict:
+    # zarr-python 3 expects a list of codecs, while zarr-python 2 expects a single numcodecs compressor
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+
+        return {"compressors": (BloscCodec(cname="zstd", clevel=5, shuffle="bitshuffle"),)}
+
+    from numcodecs import Blosc
+
+    return {"compressor": Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE)}
+
+
 def entry_metadata_saver(entry: Metadata, target_name: str) -> str:
     entry_json = entry.model_dump_json(indent=4)
     with open(target_name, "w") as f:
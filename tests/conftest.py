@@ -0,0 +1,98 @@
+"""
+Shared fixtures of the tests. The tool modules live flat in src/, like in the
+container, thus src/ is put on the path. The log files go into a temporary
+directory instead of the working directory.
+"""
+
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+_LOG_DIR = tempfile.mkdtemp(prefix="loader_tests_")
+os.environ.setdefault("PROCESSING_LOG", str(Path(_LOG_DIR) / "processing.log"))
+os.environ.setdefault("ERROR_LOG", str(Path(_LOG_DIR) / "errors.log"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import pytest  # noqa: E402
+import xarray as xr  # noqa: E402
+from metacatalog_api.models import Metadata  # noqa: E402
+
+from param import Params  # noqa: E402
+
+# a 20 x 20 km square in the middle of the test grid, in WGS84
+SQUARE = {
+    "type": "Polygon",
+    "coordinates": [[[8.05, 49.05], [8.25, 49.05], [8.25, 49.2], [8.05, 49.2], [8.05, 49.05]]],
+}
+
+
+def catchment(n_vertices: int = 4000) -> dict:
+    # a detailed, wiggly boundary like that of a catchment, with several vertices per cell of the test grid
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    radius = 0.15 + 0.02 * np.sin(12 * angles) + np.random.default_rng(1).uniform(-0.002, 0.002, n_vertices)
+    ring = np.column_stack([8.15 + radius * np.cos(angles), 49.15 + radius * np.sin(angles)])
+    return {"type": "Polygon", "coordinates": [np.vstack([ring, ring[:1]]).tolist()]}
+
+
+@pytest.fixture
+def make_entry():
+    def factory(path: str, variable_names: list[str], source_type: str = "netCDF", time_dim: str | None = "time", spatial_dims: list[str] | None = None, args: dict | None = None) -> Metadata:
+        datasource = {
+            "id": 1,
+            "path": path,
+            "variable_names": variable_names,
+            "args": args or {},
+            "type": {"id": 1, "name": source_type, "title": source_type},
+        }
+        if time_dim is not None:
+            datasource["temporal_scale"] = {"resolution": "P1D", "observation_start": "2000-01-01", "observation_end": "2001-01-01", "support": 1.0, "dimension_names": [time_dim]}
+        if spatial_dims is not None:
+            datasource["spatial_scale"] = {"resolution": 1000, "support": 1.0, "dimension_names": spatial_dims}
+
+        return Metadata.model_validate(
+            {
+                "id": 1,
+                "uuid": str(uuid.uuid4()),
+                "title": "test dataset",
+                "abstract": "a dataset of the tests",
+                "license": {"id": 1, "short_title": "CC0", "title": "CC0", "summary": "public domain"},
+                "author": {"id": 1, "uuid": str(uuid.uuid4()), "first_name": "Jane", "last_name": "Doe"},
+                "variable": {"id": 1, "name": "precipitation", "symbol": "pr", "column_names": variable_names, "unit": {"id": 1, "name": "millimeter", "symbol": "mm"}},
+                "datasource": datasource,
+            }
+        )
+
+    return factory
+
+
+@pytest.fixture
+def make_params(tmp_path):
+    def factory(**kwargs) -> Params:
+        kwargs.setdefault("dataset_ids", [1])
+        kwargs.setdefault("base_path", str(tmp_path / "out"))
+        kwargs.setdefault("use_file_index", False)
+        return Params(**kwargs)
+
+    return factory
+
+
+@pytest.fixture
+def packed_netcdf(tmp_path) -> Path:
+    # int16 precipitation packed with scale_factor and add_offset, on a 0.01 degree grid
+    x = np.round(np.arange(7.905, 8.4, 0.01), 3)
+    y = np.round(np.arange(49.395, 48.9, -0.01), 3)
+    time = pd.date_range("2000-01-01", periods=6, freq="D")
+    values = np.random.default_rng(42).uniform(0, 50, size=(len(time), len(y), len(x)))
+
+    ds = xr.Dataset({"pr": (("time", "y", "x"), values)}, coords={"time": time, "y": y, "x": x})
+    ds.pr.attrs["units"] = "mm"
+    ds.rio.write_crs(4326, inplace=True)
+    ds.pr.encoding.update(dtype="int16", scale_factor=0.01, add_offset=1.0, _FillValue=-32768)
+
+    path = tmp_path / "pr_2000.nc"
+    ds.to_netcdf(path)
+    return path
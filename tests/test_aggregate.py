@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from conftest import SQUARE
+from rasterio.transform import from_origin
+
+from aggregate import cell_weights, raster_statistics
+from geometry import reference_geometries
+from loader import _rio_raster_statistics
+from masks import coverage_fractions, window_mask
+
+TRIANGLE = {"type": "Polygon", "coordinates": [[[8.0, 49.0], [8.3, 49.15], [8.0, 49.3], [8.0, 49.0]]]}
+FEATURES = {"type": "FeatureCollection", "features": [{"type": "Feature", "id": name, "geometry": geometry, "properties": {}} for name, geometry in (("square", SQUARE), ("triangle", TRIANGLE))]}
+
+
+@pytest.fixture
+def dem_file(tmp_path) -> str:
+    # a tiled DEM with a few nodata cells, the blocks are much smaller than the windows of the features
+    data = np.random.default_rng(1).uniform(100, 500, size=(2, 100, 100)).astype("float32")
+    data[:, 40:45, 40:45] = -9999.0
+    profile = {"driver": "GTiff", "height": 100, "width": 100, "count": 2, "dtype": "float32", "crs": "EPSG:4326", "transform": from_origin(7.9, 49.4, 0.005, 0.005), "nodata": -9999.0, "tiled": True, "blockxsize": 16, "blockysize": 16}
+    with rio.open(tmp_path / "dem.tif", "w", **profile) as dst:
+        dst.write(data)
+    return str(tmp_path / "dem.tif")
+
+
+def test_block_statistics_equal_a_single_read(dem_file, make_params):
+    params = make_params(reference_area=FEATURES)
+    statistics = _rio_raster_statistics(dem_file, params)
+
+    # the partial statistics of each feature, computed from its whole window at once
+    with rio.open(dem_file) as src:
+        assert src.block_shapes[0] == (16, 16)
+        for fid, geometry in reference_geometries(params, src.crs, cell_size=0.005).items():
+            rows, cols, mask = window_mask(geometry, src.transform, src.height, src.width, all_touched=True)
+            fractions = coverage_fractions(geometry, src.transform, (rows, cols, mask))
+            weights = cell_weights(fractions, src.transform, rows.start, True)
+            expected = raster_statistics(src.read(window=((rows.start, rows.stop), (cols.start, cols.stop))), src.nodata, fractions, weights)
+
+            assert sorted(statistics[fid]) == sorted(expected)
+            for key, values in expected.items():
+                np.testing.assert_allclose(statistics[fid][key], values, rtol=1e-10)
@@ -0,0 +1,126 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from cache import MANIFEST_NAME, ResultCache
+
+
+@pytest.fixture
+def source(tmp_path) -> Path:
+    fname = tmp_path / "source.csv"
+    fname.write_text("tstamp,value\n2000-01-01 00:00:00,1\n")
+    return fname
+
+
+@pytest.fixture
+def entry(make_entry, source):
+    return make_entry(str(source), ["value"], source_type="CSV", time_dim="tstamp")
+
+
+@pytest.fixture
+def cache(tmp_path) -> ResultCache:
+    return ResultCache(str(tmp_path / "cache"), max_size_mb=1)
+
+
+def write_output(dataset_path: Path, name: str, content: bytes = b"clipped") -> str:
+    # an output file with its metadata file, like the loaders write them
+    out = dataset_path / name
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_bytes(content)
+    (out.parent / f"{out.name}.metadata.json").write_text("{}")
+    return name
+
+
+def test_key_is_stable(cache, entry, source, make_params):
+    params = make_params()
+    key = cache.key(entry, params)
+
+    assert cache.key(entry, make_params()) == key
+    # runtime parameters do not change the output
+    assert cache.key(entry, make_params(io_workers=7, cache_max_size_mb=1)) == key
+
+    assert cache.key(entry, make_params(raster_block_size=256)) != key
+    assert cache.key(entry, make_params(reference_area={"type": "Point", "coordinates": [8.1, 49.1]})) != key
+
+    # a changed source file is a new result
+    stat = source.stat()
+    os.utime(source, (stat.st_atime, stat.st_mtime + 10))
+    assert cache.key(entry, params) != key
+
+
+def test_database_sources_are_not_cached(cache, make_entry, make_params):
+    entry = make_entry("sqlite:///observations.db#obs", ["value"], source_type="external", time_dim="tstamp")
+    assert cache.key(entry, make_params()) is None
+
+
+def test_hit_and_miss(cache, entry, tmp_path, make_params):
+    key = cache.key(entry, make_params())
+    assert cache.restore(key, tmp_path / "first") is None
+
+    data_path = write_output(tmp_path / "first", "source_1.csv")
+    cache.store(key, entry, data_path, tmp_path / "first")
+
+    assert cache.restore(key, tmp_path / "second") == data_path
+    assert (tmp_path / "second" / "source_1.csv").read_bytes() == b"clipped"
+    assert (tmp_path / "second" / "source_1.csv.metadata.json").exists()
+    assert (cache.hits, cache.misses, cache.stored) == (1, 1, 1)
+
+
+def test_editing_a_restored_output_keeps_the_cache(cache, entry, tmp_path, make_params):
+    key = cache.key(entry, make_params())
+    data_path = write_output(tmp_path / "first", "source_1.csv")
+    cache.store(key, entry, data_path, tmp_path / "first")
+
+    # both the stored and the restored output are edited in place
+    with open(tmp_path / "first" / data_path, "ab") as f:
+        f.write(b" edited")
+    cache.restore(key, tmp_path / "second")
+    with open(tmp_path / "second" / data_path, "ab") as f:
+        f.write(b" edited")
+
+    cache.restore(key, tmp_path / "third")
+    assert (tmp_path / "third" / data_path).read_bytes() == b"clipped"
+
+
+def test_many_features_are_restored(cache, entry, tmp_path, make_params):
+    key = cache.key(entry, make_params())
+    data_paths = [write_output(tmp_path / "first", f"source_{feature_id}.nc", feature_id.encode()) for feature_id in ("north", "south")]
+    cache.store(key, entry, data_paths, tmp_path / "first")
+
+    assert cache.restore(key, tmp_path / "second") == data_paths
+    for feature_id, name in zip(("north", "south"), data_paths, strict=True):
+        assert (tmp_path / "second" / name).read_bytes() == feature_id.encode()
+        assert (tmp_path / "second" / f"{name}.metadata.json").exists()
+
+
+def test_directory_outputs_are_restored(cache, entry, tmp_path, make_params):
+    # a Zarr store is a folder of nested chunk files
+    store = tmp_path / "first" / "pr.zarr"
+    for name in (".zmetadata", "pr/.zarray", "pr/0.0.0", "pr/1.0.0", "time/0"):
+        (store / name).parent.mkdir(parents=True, exist_ok=True)
+        (store / name).write_text(name)
+    key = cache.key(entry, make_params())
+    cache.store(key, entry, str(store), tmp_path / "first")
+
+    # absolute data paths are restored relative to the new dataset path
+    assert cache.restore(key, tmp_path / "second") == str(tmp_path / "second" / "pr.zarr")
+    restored = sorted(str(p.relative_to(tmp_path / "second" / "pr.zarr")) for p in (tmp_path / "second" / "pr.zarr").rglob("*") if p.is_file())
+    assert restored == [".zmetadata", "pr/.zarray", "pr/0.0.0", "pr/1.0.0", "time/0"]
+
+
+def test_least_recently_used_results_are_evicted(cache, entry, tmp_path, make_params):
+    # three results of 400 kB do not fit into 1 MB
+    keys = []
+    for n in range(3):
+        key = cache.key(entry, make_params(raster_block_size=256 + 16 * n))
+        data_path = write_output(tmp_path / f"run_{n}", "source_1.csv", bytes(400 * 1024))
+        cache.store(key, entry, data_path, tmp_path / f"run_{n}")
+        keys.append(key)
+
+    # the first result is used again, thus the second is the least recently used
+    assert cache.restore(keys[0], tmp_path / "again") is not None
+    cache.evict()
+
+    assert [(cache.cache_path / key / MANIFEST_NAME).exists() for key in keys] == [True, False, True]
+    assert cache.evicted == 1
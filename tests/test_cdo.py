@@ -0,0 +1,98 @@
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from conftest import SQUARE
+
+from loader import _netcdf_files_to_cdo
+from utils import reference_area_to_file
+
+# two features, thus each file is clipped twice and the parts are merged per feature
+FEATURES = {
+    "type": "FeatureCollection",
+    "features": [
+        {"type": "Feature", "id": "square", "geometry": SQUARE, "properties": {}},
+        {"type": "Feature", "id": "north", "geometry": {"type": "Polygon", "coordinates": [[[8.0, 49.25], [8.3, 49.25], [8.3, 49.35], [8.0, 49.35], [8.0, 49.25]]]}, "properties": {}},
+    ],
+}
+
+# a stand-in for cdo, that clips the first files slowest and merges the parts by concatenating them
+FAKE_CDO = """#!{python}
+import os, sys, time
+args = sys.argv[1:]
+if "-mergetime" in args:
+    with open(args[-1], "w") as out:
+        for part in args[args.index("-mergetime") + 1 : -1]:
+            with open(part) as f:
+                out.write(f.read())
+else:
+    name = os.path.basename(args[-2])
+    time.sleep(0.05 * (4 - int(name.split("_")[1].split(".")[0])))
+    with open(args[-1], "w") as out:
+        out.write(name + " " + " ".join(op.split(",")[0] for op in args[:-2]) + "\\n")
+"""
+
+
+def daily_files(tmp_path, n_files: int = 3) -> list[str]:
+    # consecutive daily netCDF files on a lon/lat grid, as cdo expects them
+    lon = np.round(np.arange(7.905, 8.4, 0.01), 3)
+    lat = np.round(np.arange(48.905, 49.4, 0.01), 3)
+    fnames = []
+    for n in range(n_files):
+        time = pd.date_range("2000-01-01", periods=4, freq="D") + pd.Timedelta(days=4 * n)
+        values = np.random.default_rng(n).uniform(0, 50, size=(len(time), len(lat), len(lon)))
+        ds = xr.Dataset({"pr": (("time", "lat", "lon"), values)}, coords={"time": time, "lat": lat, "lon": lon})
+        ds.lon.attrs.update(units="degrees_east", standard_name="longitude")
+        ds.lat.attrs.update(units="degrees_north", standard_name="latitude")
+        fname = tmp_path / f"pr_{n + 1}.nc"
+        ds.to_netcdf(fname)
+        fnames.append(str(fname))
+    return fnames
+
+
+def run_cdo_backend(fnames, make_entry, make_params, base_path: Path, workers: int) -> list[str]:
+    base_path.mkdir()
+    entry = make_entry(fnames[0], ["pr"], spatial_dims=["lon", "lat"])
+    params = make_params(base_path=str(base_path), reference_area=FEATURES, netcdf_backend="cdo", cdo_workers=workers)
+    reference_area_to_file(params, add_ascii=True)
+    return _netcdf_files_to_cdo(entry, fnames, params)
+
+
+def test_parallel_parts_are_merged_in_file_order(tmp_path, make_entry, make_params, monkeypatch):
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    (bin_path / "cdo").write_text(FAKE_CDO.format(python=sys.executable))
+    (bin_path / "cdo").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    fnames = [str(tmp_path / f"pr_{n}.nc") for n in (1, 2, 3)]
+
+    outputs = {workers: run_cdo_backend(fnames, make_entry, make_params, tmp_path / f"workers_{workers}", workers) for workers in (1, 6)}
+
+    for serial, parallel in zip(outputs[1], outputs[6], strict=True):
+        assert Path(serial).name == Path(parallel).name
+        assert Path(parallel).read_text() == Path(serial).read_text()
+        assert [line.split()[0] for line in Path(parallel).read_text().splitlines()] == ["pr_1.nc", "pr_2.nc", "pr_3.nc"]
+
+    # the parts are removed after the merge
+    assert not (tmp_path / "workers_6" / "intermediate").exists()
+
+
+@pytest.mark.skipif(shutil.which("cdo") is None, reason="cdo is not installed")
+def test_parallel_merge_equals_the_serial_merge(tmp_path, make_entry, make_params):
+    fnames = daily_files(tmp_path)
+
+    outputs = {workers: run_cdo_backend(fnames, make_entry, make_params, tmp_path / f"workers_{workers}", workers) for workers in (1, 6)}
+
+    assert len(outputs[6]) == len(FEATURES["features"])
+    for serial, parallel in zip(outputs[1], outputs[6], strict=True):
+        with xr.open_dataset(serial) as expected, xr.open_dataset(parallel) as merged:
+            # cdo logs the command with the paths into the history
+            expected.attrs.pop("history", None)
+            merged.attrs.pop("history", None)
+            xr.testing.assert_identical(merged, expected)
+            assert merged.sizes["time"] == 12
@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+
+from environment import io_environment, netcdf_chunk_cache_mb
+
+netCDF4 = pytest.importorskip("netCDF4")
+
+
+def test_chunk_cache_is_restored(make_params):
+    params = make_params(netcdf_chunk_cache_mb=12)
+    before = netCDF4.get_chunk_cache()
+
+    with io_environment(params):
+        assert netCDF4.get_chunk_cache()[0] == netcdf_chunk_cache_mb(params) * 2**20
+
+    assert netCDF4.get_chunk_cache() == before
+
+
+def test_chunk_cache_is_kept_until_the_last_task_finished(make_params):
+    params = make_params(netcdf_chunk_cache_mb=12)
+    before = netCDF4.get_chunk_cache()
+    first_entered, first_left = threading.Event(), threading.Event()
+    during = []
+
+    # the second task starts before and finishes after the first one, like two threads in one worker process
+    def first_task():
+        with io_environment(params):
+            first_entered.set()
+        first_left.set()
+
+    def second_task():
+        with io_environment(params):
+            thread = threading.Thread(target=first_task)
+            thread.start()
+            first_left.wait(timeout=10)
+            during.append(netCDF4.get_chunk_cache()[0])
+        thread.join()
+
+    second = threading.Thread(target=second_task)
+    second.start()
+    second.join()
+
+    assert first_entered.is_set()
+    assert during == [12 * 2**20]
+    assert netCDF4.get_chunk_cache() == before
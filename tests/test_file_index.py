@@ -0,0 +1,72 @@
+import json
+import threading
+
+import pytest
+
+from file_index import INDEX_FILE_NAME, FileIndex
+
+
+@pytest.fixture
+def csv_files(tmp_path) -> list[str]:
+    # twelve monthly files in one directory, like a multi-file datasource
+    fnames = []
+    for month in range(1, 13):
+        fname = tmp_path / f"data_{month:02d}.csv"
+        fname.write_text(f"tstamp,value\n2000-{month:02d}-01 00:00:00,1\n2000-{month:02d}-02 00:00:00,2\n")
+        fnames.append(str(fname))
+    return fnames
+
+
+def saved_records(directory) -> dict:
+    with open(directory / INDEX_FILE_NAME) as f:
+        return json.load(f)["files"]
+
+
+def test_indices_sharing_a_file_keep_each_others_records(csv_files, tmp_path, make_params):
+    params = make_params(use_file_index=True)
+
+    # both are loaded before either one saved, like two datasets loaded concurrently
+    first = FileIndex.for_files(csv_files[:6], params)
+    second = FileIndex.for_files(csv_files[6:], params)
+    for index, fnames in ((first, csv_files[:6]), (second, csv_files[6:])):
+        for fname in fnames:
+            index.record(fname, "csv", time_dim="tstamp")
+    first.save()
+    second.save()
+
+    assert sorted(saved_records(tmp_path)) == [f"data_{month:02d}.csv" for month in range(1, 13)]
+    assert saved_records(tmp_path)["data_01.csv"]["time_min"] == "2000-01-01T00:00:00"
+
+
+def test_concurrent_saves_keep_all_records(csv_files, tmp_path, make_params):
+    params = make_params(use_file_index=True)
+    barrier = threading.Barrier(len(csv_files), timeout=10)
+
+    def index_one(fname):
+        index = FileIndex.for_files([fname], params)
+        index.record(fname, "csv", time_dim="tstamp")
+        barrier.wait()
+        index.save()
+
+    threads = [threading.Thread(target=index_one, args=(fname,)) for fname in csv_files]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(saved_records(tmp_path)) == len(csv_files)
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_changed_files_are_indexed_again(csv_files, tmp_path, make_params):
+    params = make_params(use_file_index=True)
+    index = FileIndex.for_files(csv_files, params)
+    index.record(csv_files[0], "csv", time_dim="tstamp")
+    index.save()
+
+    with open(csv_files[0], "a") as f:
+        f.write("2001-06-01 00:00:00,3\n")
+    index = FileIndex.for_files(csv_files, params)
+    assert index.record(csv_files[0], "csv", time_dim="tstamp")["time_max"] == "2001-06-01T00:00:00"
+    index.save()
+    assert saved_records(tmp_path)["data_01.csv"]["time_max"] == "2001-06-01T00:00:00"
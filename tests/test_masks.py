@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+import shapely
+from affine import Affine
+from conftest import catchment
+from rasterio.transform import from_origin
+
+from geometry import reference_geometries
+from masks import cell_mask, simplification_mismatches, window_mask
+
+# a 0.005 degree grid around the catchment
+TRANSFORM = from_origin(7.9, 49.4, 0.005, 0.005)
+SHAPE = (100, 100)
+
+
+@pytest.fixture
+def geometry(make_params):
+    params = make_params(reference_area=catchment(), simplify_reference_area=True)
+    geometry = reference_geometries(params, 4326, cell_size=0.005)[params.feature_ids[0]]
+    assert geometry.simplified
+    assert shapely.get_num_coordinates(geometry.geometry) < shapely.get_num_coordinates(geometry.exact) / 4
+    return geometry
+
+
+@pytest.mark.parametrize("all_touched", [False, True])
+def test_simplified_geometry_selects_the_exact_cells(geometry, all_touched):
+    rows, cols, mask = window_mask(geometry, TRANSFORM, *SHAPE, all_touched)
+    exact_rows, exact_cols, exact_mask = window_mask(geometry, TRANSFORM, *SHAPE, all_touched, exact=True)
+
+    assert (rows, cols) == (exact_rows, exact_cols)
+    np.testing.assert_array_equal(mask, exact_mask)
+    assert simplification_mismatches(geometry, TRANSFORM, *SHAPE, all_touched) == 0
+
+
+@pytest.mark.parametrize("all_touched", [False, True])
+def test_simplified_geometry_selects_the_exact_cells_block_by_block(geometry, all_touched):
+    # the blocks of the raster clip are masked on their own, thus the boundary crosses their edges
+    for row in range(0, SHAPE[0], 16):
+        for col in range(0, SHAPE[1], 16):
+            shape = (min(16, SHAPE[0] - row), min(16, SHAPE[1] - col))
+            transform = TRANSFORM * Affine.translation(col, row)
+            np.testing.assert_array_equal(cell_mask(geometry, transform, shape, all_touched), cell_mask(geometry, transform, shape, all_touched, exact=True))
@@ -0,0 +1,87 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from loader import _clip_netcdf_xarray, _open_netcdf, load_netcdf_file
+from scheduler import Scheduler
+
+# the cells in the eastern corners of the bounding box are outside of the triangle
+TRIANGLE = {"type": "Polygon", "coordinates": [[[8.05, 49.05], [8.25, 49.125], [8.05, 49.2], [8.05, 49.05]]]}
+
+
+def test_clip_keeps_the_packing_of_the_source(packed_netcdf, make_entry, make_params):
+    entry = make_entry(str(packed_netcdf), ["pr"], spatial_dims=["x", "y"])
+    params = make_params(reference_area=TRIANGLE)
+
+    with _open_netcdf(str(packed_netcdf), params) as ds:
+        regions = _clip_netcdf_xarray(entry, str(packed_netcdf), ds, params)
+
+    pr = regions[params.feature_ids[0]].pr
+    assert pr.encoding["dtype"] == np.dtype("int16")
+    assert pr.encoding["scale_factor"] == 0.01
+    assert pr.encoding["add_offset"] == 1.0
+    assert pr.encoding["_FillValue"] == -32768
+
+    # the cells outside of the square are masked, the values within are those of the source
+    with xr.open_dataset(packed_netcdf) as source:
+        expected = source.pr.sel(y=pr.y, x=pr.x)
+        values = pr.values
+        assert np.isnan(values).any()
+        np.testing.assert_allclose(values[~np.isnan(values)], expected.values[~np.isnan(values)])
+
+
+@pytest.fixture
+def scheduler():
+    executor = Scheduler(io_workers=2, cpu_workers=1)
+    yield executor
+    executor.shutdown()
+
+
+def load_packed(packed_netcdf, make_entry, make_params, scheduler, **kwargs) -> xr.Dataset:
+    # clip the packed file through the loader and open the written part as it is stored
+    entry = make_entry(str(packed_netcdf), ["pr"], spatial_dims=["x", "y"])
+    params = make_params(reference_area=TRIANGLE, **kwargs)
+
+    out_path = load_netcdf_file(entry, scheduler, params)
+    parts = sorted(Path(out_path).glob("*.nc"))
+    assert len(parts) == 1
+    return xr.open_dataset(parts[0], mask_and_scale=False)
+
+
+@pytest.mark.parametrize("profile", ["default", "fast", "compact", "timeseries"])
+def test_profiles_keep_the_packing(packed_netcdf, make_entry, make_params, scheduler, profile):
+    with load_packed(packed_netcdf, make_entry, make_params, scheduler, netcdf_encoding=profile) as ds:
+        assert ds.pr.dtype == np.dtype("int16")
+        assert ds.pr.attrs["scale_factor"] == 0.01
+        assert ds.pr.attrs["add_offset"] == 1.0
+        assert ds.pr.attrs["_FillValue"] == -32768
+
+        # the cells outside of the triangle are stored as fill value
+        assert (ds.pr.values == -32768).any()
+        filters = ds.pr.encoding
+        if profile == "fast":
+            assert filters["contiguous"]
+        elif profile in ("compact", "timeseries"):
+            assert filters["zlib"] and filters["shuffle"]
+        if profile == "timeseries":
+            assert filters["chunksizes"][0] == ds.sizes["time"]
+
+
+@pytest.mark.parametrize("profile,dtype", [("default", "float64"), ("fast", "float64"), ("compact", "float32"), ("timeseries", "float64")])
+def test_profiles_without_packing(packed_netcdf, make_entry, make_params, scheduler, profile, dtype):
+    with load_packed(packed_netcdf, make_entry, make_params, scheduler, netcdf_encoding=profile, keep_packing=False) as ds:
+        assert ds.pr.dtype == np.dtype(dtype)
+        assert "scale_factor" not in ds.pr.attrs
+        assert "add_offset" not in ds.pr.attrs
+        assert np.isnan(ds.pr.attrs["_FillValue"])
+
+
+@pytest.mark.parametrize("profile", ["default", "fast", "compact", "timeseries"])
+def test_profiles_round_trip_the_values(packed_netcdf, make_entry, make_params, scheduler, profile):
+    with load_packed(packed_netcdf, make_entry, make_params, scheduler, netcdf_encoding=profile) as ds, xr.open_dataset(packed_netcdf) as source:
+        clipped = xr.decode_cf(ds).pr
+        expected = source.pr.sel(y=clipped.y, x=clipped.x)
+        valid = ~np.isnan(clipped.values)
+        np.testing.assert_allclose(clipped.values[valid], expected.values[valid])
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from conftest import SQUARE, catchment
+from rasterio.transform import from_origin
+
+from environment import cog_options, gdal_options
+from loader import _rio_clip_raster
+from raster import build_mosaic
+
+# a 0.005 degree DEM around the test square, split into a western and an eastern tile
+ORIGIN = (7.9, 49.4)
+RES = 0.005
+
+
+def write_tile(path, data, col_off=0, nodata=-9999.0):
+    transform = from_origin(ORIGIN[0] + col_off * RES, ORIGIN[1], RES, RES)
+    profile = {"driver": "GTiff", "height": data.shape[0], "width": data.shape[1], "count": 1, "dtype": data.dtype, "crs": "EPSG:4326", "transform": transform, "nodata": nodata}
+    with rio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+
+def clip(file_name, params, out_path):
+    # the single feature of the reference area
+    fid = params.feature_ids[0]
+    return _rio_clip_raster(str(file_name), params, {fid: out_path})[fid]
+
+
+@pytest.fixture
+def dem():
+    return np.random.default_rng(1).uniform(100, 500, size=(100, 100)).astype("float32")
+
+
+def test_mosaic_of_two_clipped_tiles(tmp_path, make_params, dem):
+    pytest.importorskip("osgeo")
+    params = make_params(reference_area=SQUARE, raster_block_size=16)
+
+    full = write_tile(tmp_path / "full.tif", dem)
+    tiles = [write_tile(tmp_path / "west.tif", dem[:, :50]), write_tile(tmp_path / "east.tif", dem[:, 50:], col_off=50)]
+
+    expected = clip(full, params, tmp_path / "expected.tif")
+    parts = [clip(tile, params, tmp_path / f"part_{n}.tif") for n, tile in enumerate(tiles, start=1)]
+    mosaic = build_mosaic(parts, tmp_path, "dem", cog=False, config=gdal_options(params), options=cog_options(params))
+
+    assert mosaic.endswith(".vrt")
+    with rio.open(expected) as exp, rio.open(mosaic) as mos:
+        assert mos.bounds == pytest.approx(exp.bounds)
+        np.testing.assert_array_equal(mos.read(1), exp.read(1))
+
+
+def test_mosaic_as_cog_replaces_the_parts(tmp_path, make_params, dem):
+    pytest.importorskip("osgeo")
+    params = make_params(reference_area=SQUARE, raster_block_size=16, raster_cog=True)
+
+    tiles = [write_tile(tmp_path / "west.tif", dem[:, :50]), write_tile(tmp_path / "east.tif", dem[:, 50:], col_off=50)]
+    parts = [clip(tile, params, tmp_path / f"part_{n}.tif") for n, tile in enumerate(tiles, start=1)]
+    mosaic = build_mosaic(parts, tmp_path, "dem", cog=True, config=gdal_options(params), options=cog_options(params))
+
+    assert mosaic == str(tmp_path / "dem.tif")
+    assert not any((tmp_path / f"part_{n}.tif").exists() for n in (1, 2))
+    with rio.open(mosaic) as src:
+        assert src.overviews(1) is not None
+        assert src.profile["tiled"]
+
+
+# the cells in the eastern corners of the bounding box are outside of the triangle
+TRIANGLE = {"type": "Polygon", "coordinates": [[[8.05, 49.05], [8.25, 49.125], [8.05, 49.2], [8.05, 49.05]]]}
+
+
+@pytest.mark.parametrize("dtype,nodata,expected", [("uint8", None, 255), ("uint16", None, 65535), ("int8", None, -128), ("int16", None, -9999), ("uint8", 0, 0)])
+def test_clip_uses_a_nodata_value_of_the_data_type(tmp_path, make_params, dtype, nodata, expected):
+    params = make_params(reference_area=TRIANGLE, raster_block_size=16)
+    data = np.random.default_rng(1).integers(1, 100, size=(100, 100)).astype(dtype)
+
+    clipped = clip(write_tile(tmp_path / "dem.tif", data, nodata=nodata), params, tmp_path / "clipped.tif")
+
+    with rio.open(clipped) as src:
+        assert src.nodata == expected
+        values = src.read(1)
+        col_off, row_off = round((src.bounds.left - ORIGIN[0]) / RES), round((ORIGIN[1] - src.bounds.top) / RES)
+    source = data[row_off:row_off + values.shape[0], col_off:col_off + values.shape[1]]
+
+    # the empty blocks and the masked cells are nodata, all other cells are those of the source
+    outside = values == expected
+    assert outside[0, -1] and outside[-1, -1]
+    assert 0 < outside.sum() < outside.size
+    np.testing.assert_array_equal(values[~outside], source[~outside])
+
+
+def test_simplified_reference_area_clips_the_same_cells(tmp_path, make_params, dem):
+    outputs = {}
+    for simplify in (False, True):
+        params = make_params(reference_area=catchment(), simplify_reference_area=simplify, raster_block_size=16)
+        with rio.open(clip(write_tile(tmp_path / "dem.tif", dem), params, tmp_path / f"clipped_{simplify}.tif")) as src:
+            outputs[simplify] = (src.bounds, src.read(1))
+
+    assert outputs[True][0] == outputs[False][0]
+    np.testing.assert_array_equal(outputs[True][1], outputs[False][1])
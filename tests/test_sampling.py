@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import shapely
+import xarray as xr
+
+from geometry import ReferenceGeometry
+from param import PointInterpolations
+from sampling import sample_points
+
+# points within the grid, on a cell center, in the outer half of an edge cell and outside of the grid
+POINTS = {"inner": (8.1234, 49.1567), "center": (8.105, 49.205), "edge": (7.901, 48.902), "outside": (9.0, 49.0)}
+
+
+@pytest.fixture
+def grid() -> xr.Dataset:
+    # 0.01 degree cells, the y coordinates are descending like those of most rasters
+    x = np.round(np.arange(7.905, 8.4, 0.01), 3)
+    y = np.round(np.arange(49.395, 48.9, -0.01), 3)
+    values = np.random.default_rng(1).uniform(0, 10, size=(3, y.size, x.size))
+    ds = xr.Dataset({"pr": (("time", "y", "x"), values)}, coords={"time": np.arange(3), "y": y, "x": x})
+    return ds.rio.write_crs("EPSG:4326")
+
+
+def geometries() -> dict[str, ReferenceGeometry]:
+    return {name: ReferenceGeometry(name, shapely.Point(*xy)) for name, xy in POINTS.items()}
+
+
+def bilinear(ds: xr.Dataset, x: float, y: float) -> np.ndarray:
+    # interpolate between the four surrounding cell centers by hand
+    col = (x - float(ds.x[0])) / 0.01
+    row = (float(ds.y[0]) - y) / 0.01
+    c0, r0 = int(np.floor(col)), int(np.floor(row))
+    wx, wy = col - c0, row - r0
+    v = ds.pr.values
+    return v[:, r0, c0] * (1 - wy) * (1 - wx) + v[:, r0, c0 + 1] * (1 - wy) * wx + v[:, r0 + 1, c0] * wy * (1 - wx) + v[:, r0 + 1, c0 + 1] * wy * wx
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_nearest_reads_the_containing_cell(grid, chunked):
+    data = grid.chunk({"time": 1}) if chunked else grid
+    sampled = sample_points(data, geometries(), PointInterpolations.NEAREST).compute()
+
+    assert list(sampled.feature_id.values) == list(POINTS)
+    np.testing.assert_array_equal(sampled.pr.sel(feature_id="inner").values, grid.pr.sel(x=8.125, y=49.155).values)
+    np.testing.assert_array_equal(sampled.pr.sel(feature_id="edge").values, grid.pr.isel(x=0, y=-1).values)
+    assert sampled.pr.sel(feature_id="outside").isnull().all()
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_bilinear_interpolates_between_the_cell_centers(grid, chunked):
+    data = grid.chunk({"time": 1}) if chunked else grid
+    sampled = sample_points(data, geometries(), PointInterpolations.BILINEAR).compute()
+
+    np.testing.assert_allclose(sampled.pr.sel(feature_id="inner").values, bilinear(grid, *POINTS["inner"]))
+    np.testing.assert_allclose(sampled.pr.sel(feature_id="center").values, grid.pr.sel(x=8.105, y=49.205).values)
+
+    # beyond the outermost cell centers, there are no four cells to interpolate
+    assert sampled.pr.sel(feature_id="edge").isnull().all()
+    assert sampled.pr.sel(feature_id="outside").isnull().all()
+    assert set(sampled.coords) == {"time", "feature_id"}
@@ -0,0 +1,58 @@
+import os
+
+import dask
+import pytest
+
+from scheduler import Scheduler, dask_config
+
+
+def dask_num_workers(params):
+    with dask_config(params):
+        return dask.config.get("num_workers", None)
+
+
+def test_cpu_workers_are_forked_up_front():
+    scheduler = Scheduler(io_workers=1, cpu_workers=2)
+    try:
+        # all workers exist before the first task is submitted
+        assert len(scheduler._cpu_pool._processes) == 2
+        assert scheduler.submit_cpu(os.getpid).result() != os.getpid()
+    finally:
+        scheduler.shutdown()
+
+
+def test_dask_uses_the_share_of_cores_in_cpu_tasks(make_params):
+    scheduler = Scheduler(io_workers=1, cpu_workers=2)
+    try:
+        assert scheduler.submit_cpu(dask_num_workers, make_params()).result() == max(1, (os.cpu_count() or 1) // 2)
+        assert scheduler.submit_cpu(dask_num_workers, make_params(dask_workers=3)).result() == 3
+
+        # the main process keeps the dask default
+        assert dask_num_workers(make_params()) is None
+    finally:
+        scheduler.shutdown()
+
+
+def test_failed_submit_resolves_the_future():
+    scheduler = Scheduler(io_workers=1, cpu_workers=1)
+    scheduler._cpu_pool.shutdown()
+
+    future = scheduler.submit_cpu(os.getpid)
+    with pytest.raises(RuntimeError):
+        future.result(timeout=5)
+
+    # nothing is left pending, thus the shutdown returns
+    scheduler.shutdown()
+    assert "Failed tasks: 1" in scheduler.report()
+
+
+def test_failed_submit_of_a_dependent_task_resolves_the_future():
+    scheduler = Scheduler(io_workers=1, cpu_workers=1)
+    dependency = scheduler.submit_io(os.getpid)
+    dependency.result()
+    scheduler._cpu_pool.shutdown()
+
+    future = scheduler.submit_cpu(os.getpid, depends_on=[dependency])
+    with pytest.raises(RuntimeError):
+        future.result(timeout=5)
+    scheduler.shutdown()
@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import polars as pl
+import pytest
+from sqlalchemy import exc
+
+from loader import _iter_sql_batches, load_sql_source
+from query import build_select, get_engine, time_windows
+from scheduler import Scheduler
+
+START = datetime(2000, 1, 1)
+HOURS = 4 * 24
+
+
+@pytest.fixture
+def sqlite_uri(tmp_path) -> str:
+    # hourly observations of three stations, the time windows of four partitions end exactly on a row
+    path = tmp_path / "observations.db"
+    with sqlite3.connect(path) as connection:
+        connection.execute("CREATE TABLE obs (tstamp TIMESTAMP, value REAL, lon REAL, lat REAL)")
+        rows = [((START + timedelta(hours=h)).strftime("%Y-%m-%d %H:%M:%S"), h * 0.5 + s, 8.1 + s * 0.05, 49.1) for h in range(HOURS + 1) for s in range(3)]
+        connection.executemany("INSERT INTO obs VALUES (?, ?, ?, ?)", rows)
+    return f"sqlite:///{path}"
+
+
+@pytest.fixture
+def scheduler():
+    executor = Scheduler(io_workers=4, cpu_workers=1)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def sql_entry(make_entry, sqlite_uri):
+    return make_entry(f"{sqlite_uri}#obs", ["value"], source_type="external", time_dim="tstamp", spatial_dims=["lon", "lat"])
+
+
+def read_output(path) -> pl.DataFrame:
+    # a partitioned source is a folder of ordered parts
+    files = sorted(path.glob("*_part_*.csv"), key=lambda p: int(p.stem.rsplit("_", 1)[1])) if path.is_dir() else [path]
+    return pl.concat([pl.read_csv(f) for f in files])
+
+
+def test_time_windows_have_no_gaps_or_overlaps(sql_entry, sqlite_uri, make_params):
+    params = make_params(start_date=START, end_date=START + timedelta(hours=HOURS))
+    windows = time_windows(sql_entry, params, get_engine(sqlite_uri), "obs", 4)
+
+    assert len(windows) == 4
+    assert windows[0][0] == START
+    assert windows[-1][1] == START + timedelta(hours=HOURS)
+    for (_, end, closed), (start, _, _) in zip(windows[:-1], windows[1:], strict=True):
+        assert end == start
+        assert not closed
+    assert windows[-1][2]
+
+
+def test_time_windows_take_missing_bounds_from_the_data(sql_entry, sqlite_uri, make_params):
+    windows = time_windows(sql_entry, make_params(), get_engine(sqlite_uri), "obs", 3)
+
+    assert windows[0][0] == START
+    assert windows[-1][1] == START + timedelta(hours=HOURS)
+
+
+@pytest.mark.parametrize("batch_size", [None, 50])
+def test_partitions_return_every_row_once(sql_entry, make_params, scheduler, batch_size):
+    params = make_params(start_date=START, end_date=START + timedelta(hours=HOURS), sql_partitions=4, sql_batch_size=batch_size)
+    out_path = params.dataset_path / load_sql_source(sql_entry, scheduler, params)
+
+    data = read_output(out_path)
+    assert len(data) == 3 * (HOURS + 1)
+    assert data.select("tstamp", "lon").is_duplicated().sum() == 0
+
+    # the rows on the inner window edges are in the later window
+    for edge in ("2000-01-02 00:00:00", "2000-01-03 00:00:00", "2000-01-04 00:00:00"):
+        assert len(data.filter(pl.col("tstamp") == edge)) == 3
+
+
+def test_pool_serves_more_streams_than_partitions(sqlite_uri):
+    # many datasets streaming at once, like the scheduler's I/O workers do, open connections beyond the pool size
+    engine = get_engine(sqlite_uri, pool_size=4)
+    connections, errors = [], []
+    barrier = threading.Barrier(8, timeout=10)
+
+    def hold_connection():
+        try:
+            with engine.connect() as connection:
+                connections.append(connection)
+                barrier.wait()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=hold_connection) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(connections) == 8
+
+
+def test_pool_is_bounded(sqlite_uri, caplog):
+    engine = get_engine(sqlite_uri, pool_size=2)
+    held = [engine.connect() for _ in range(4)]
+    assert engine.pool.overflow() == 2
+    # do not wait the default 30 seconds for a free connection
+    engine.pool._timeout = 0.1
+    try:
+        # the overflow is as large as the pool, thus the fifth connection has to wait
+        with pytest.raises(exc.TimeoutError, match="QueuePool limit"):
+            engine.connect()
+    finally:
+        for connection in held:
+            connection.close()
+
+    # a later, larger request gets the existing engine, but is logged
+    with caplog.at_level("WARNING"):
+        assert get_engine(sqlite_uri, pool_size=16) is engine
+    assert "existing pool keeps 2 connections" in caplog.text
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_batched_output_equals_a_one_shot_read(sql_entry, make_params, tmp_path, batch_size):
+    # the one-shot read is saved by a task of the scheduler, thus it is complete after the shutdown
+    outputs = {}
+    for name, size in (("one-shot", None), ("batched", batch_size)):
+        params = make_params(base_path=str(tmp_path / name), start_date=START + timedelta(hours=5), end_date=START + timedelta(hours=50), sql_batch_size=size)
+        executor = Scheduler(io_workers=2, cpu_workers=1)
+        target_name = load_sql_source(sql_entry, executor, params)
+        executor.shutdown()
+        outputs[name] = (params.dataset_path / target_name).read_text()
+
+    assert outputs["batched"] == outputs["one-shot"]
+    assert outputs["batched"].count("tstamp") == 1
+    assert len(outputs["batched"].splitlines()) == 1 + 3 * 46
+
+
+def test_batches_are_streamed(sql_entry, sqlite_uri, make_params):
+    params = make_params()
+    engine = get_engine(sqlite_uri)
+    sql, bind = build_select(sql_entry, params, engine, table="obs")
+    sizes = [len(batch) for batch in _iter_sql_batches(engine, sql, bind, 100, {})]
+
+    assert sizes == [100, 100] + [3 * (HOURS + 1) - 200]
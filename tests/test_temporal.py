@@ -0,0 +1,151 @@
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+import xarray as xr
+from conftest import SQUARE
+
+from loader import load_netcdf_file, load_sql_source
+from param import Reducers, TemporalResolutions
+from query import get_engine, time_windows
+from scheduler import Scheduler
+from temporal import resample_pandas, resample_polars, resample_xarray
+
+START = datetime(2000, 1, 1)
+
+
+@pytest.fixture
+def hourly() -> pd.DataFrame:
+    # 75 days of hourly values of three stations, the periods start and end within the data
+    tstamp = pd.date_range("2000-01-01 00:30", periods=75 * 24, freq="h")
+    frames = [pd.DataFrame({"tstamp": tstamp, "station": station, "value": np.random.default_rng(station).uniform(0, 10, len(tstamp))}) for station in range(3)]
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize("resolution", list(TemporalResolutions))
+@pytest.mark.parametrize("reducer", list(Reducers))
+def test_resamplers_give_the_same_result(hourly, resolution, reducer):
+    by_pandas = resample_pandas(hourly, "tstamp", resolution, reducer, group_by=["station"])
+    by_polars = resample_polars(pl.from_pandas(hourly).lazy(), "tstamp", resolution, reducer, group_by=["station"]).collect().to_pandas()
+    cube = hourly.set_index(["tstamp", "station"]).to_xarray()
+    by_xarray = resample_xarray(cube, "tstamp", resolution, reducer).to_dataframe().reset_index()
+
+    columns = ["station", "tstamp", "value"]
+    expected = by_pandas[columns].sort_values(["station", "tstamp"], ignore_index=True)
+    assert len(expected) > 1
+    for result in (by_polars, by_xarray):
+        result = result[columns].sort_values(["station", "tstamp"], ignore_index=True)
+        result["tstamp"] = result["tstamp"].astype(expected["tstamp"].dtype)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+@pytest.fixture
+def sqlite_uri(tmp_path, hourly) -> str:
+    path = tmp_path / "observations.db"
+    table = hourly.assign(tstamp=hourly.tstamp.dt.strftime("%Y-%m-%d %H:%M:%S"), lon=8.1 + hourly.station * 0.05, lat=49.1).drop(columns="station")
+    with sqlite3.connect(path) as connection:
+        table.to_sql("obs", connection, index=False)
+    return f"sqlite:///{path}"
+
+
+@pytest.fixture
+def sql_entry(make_entry, sqlite_uri):
+    return make_entry(f"{sqlite_uri}#obs", ["value"], source_type="external", time_dim="tstamp", spatial_dims=["lon", "lat"])
+
+
+def read_parts(path: Path) -> pd.DataFrame:
+    # a partitioned source is a folder of ordered parts
+    files = sorted(path.glob("*_part_*.csv"), key=lambda p: int(p.stem.rsplit("_", 1)[1])) if path.is_dir() else [path]
+    return pd.concat([pd.read_csv(f, parse_dates=["tstamp"]) for f in files], ignore_index=True)
+
+
+@pytest.mark.parametrize("partitions", [1, 4])
+@pytest.mark.parametrize("resolution", [TemporalResolutions.DAILY, TemporalResolutions.MONTHLY])
+def test_sqlite_group_by_equals_pandas(sql_entry, hourly, make_params, partitions, resolution):
+    params = make_params(temporal_resolution=resolution, temporal_reducer="sum", sql_partitions=partitions)
+    executor = Scheduler(io_workers=2, cpu_workers=1)
+    out_path = params.dataset_path / load_sql_source(sql_entry, executor, params)
+    executor.shutdown()
+
+    loaded = read_parts(out_path).assign(station=lambda df: ((df.lon - 8.1) / 0.05).round().astype(int))
+    expected = resample_pandas(hourly, "tstamp", resolution, Reducers.SUM, group_by=["station"])
+
+    # each period of each station is loaded once, also with partitioned reads
+    columns = ["station", "tstamp", "value"]
+    loaded = loaded[columns].sort_values(["station", "tstamp"], ignore_index=True)
+    pd.testing.assert_frame_equal(loaded, expected[columns].sort_values(["station", "tstamp"], ignore_index=True), check_dtype=False)
+
+
+@pytest.mark.parametrize("resolution", list(TemporalResolutions))
+def test_time_windows_start_at_periods(sql_entry, sqlite_uri, make_params, resolution):
+    params = make_params(start_date=START, end_date=START + timedelta(days=75), temporal_resolution=resolution)
+    windows = time_windows(sql_entry, params, get_engine(sqlite_uri), "obs", 4)
+
+    if resolution == TemporalResolutions.YEARLY:
+        # the whole range is in one year, thus it can not be split
+        assert windows == []
+        return
+
+    assert windows[0][0] == START
+    assert windows[-1][1] == START + timedelta(days=75)
+    for (_, end, _), (start, _, _) in zip(windows[:-1], windows[1:], strict=True):
+        assert end == start
+        if resolution == TemporalResolutions.MONTHLY:
+            assert start.day == 1 and start.hour == 0
+        else:
+            assert start.minute == 0 and (resolution == TemporalResolutions.HOURLY or start.hour == 0)
+
+
+@pytest.fixture
+def monthly_files(tmp_path) -> list[Path]:
+    # one file of daily values per month, the year spans all of them
+    x = np.round(np.arange(7.905, 8.4, 0.01), 3)
+    y = np.round(np.arange(49.395, 48.9, -0.01), 3)
+    fnames = []
+    for month in range(1, 13):
+        time = pd.date_range(f"2000-{month:02d}-01", periods=pd.Period(f"2000-{month:02d}").days_in_month, freq="D")
+        values = np.random.default_rng(month).uniform(0, 50, size=(len(time), len(y), len(x)))
+        ds = xr.Dataset({"pr": (("time", "y", "x"), values)}, coords={"time": time, "y": y, "x": x}).rio.write_crs(4326)
+        fname = tmp_path / f"pr_2000_{month:02d}.nc"
+        ds.to_netcdf(fname)
+        fnames.append(fname)
+    return fnames
+
+
+def expected_yearly(monthly_files, x, y) -> np.ndarray:
+    with xr.open_mfdataset(monthly_files, data_vars="minimal", coords="minimal", compat="override") as source:
+        return source.pr.sel(x=x, y=y).resample(time="YS").mean().values
+
+
+@pytest.mark.parametrize("backend", ["xarray", "parquet", "zarr"])
+def test_periods_spanning_files_are_resampled_once(monthly_files, tmp_path, make_entry, make_params, backend):
+    entry = make_entry(str(tmp_path / "pr_2000_*.nc"), ["pr"], spatial_dims=["x", "y"])
+    params = make_params(reference_area=SQUARE, netcdf_backend=backend, temporal_resolution="yearly")
+    executor = Scheduler(io_workers=1, cpu_workers=1)
+    out_path = Path(load_netcdf_file(entry, executor, params))
+    executor.shutdown()
+
+    if backend == "zarr":
+        with xr.open_zarr(out_path) as ds:
+            assert list(ds.time.values) == [np.datetime64("2000-01-01")]
+            np.testing.assert_allclose(ds.pr.values, expected_yearly(monthly_files, ds.x, ds.y))
+        return
+
+    parts = sorted(out_path.glob("*_part_*"))
+    assert [part.name for part in parts] == [f"{out_path.name}_part_1.{'nc' if backend == 'xarray' else 'parquet'}"]
+    if backend == "xarray":
+        with xr.open_dataset(parts[0]) as ds:
+            assert list(ds.time.values) == [np.datetime64("2000-01-01")]
+            values = ds.pr.values
+            expected = expected_yearly(monthly_files, ds.x, ds.y)
+            valid = ~np.isnan(values)
+            assert valid.any()
+            np.testing.assert_allclose(values[valid], expected[valid])
+    else:
+        table = pd.read_parquet(parts[0]).dropna(subset=["pr"])
+        assert set(table.time) == {pd.Timestamp("2000-01-01")}
+        assert not table.duplicated(["x", "y"]).any()
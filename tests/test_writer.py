@@ -0,0 +1,56 @@
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+
+from loader import load_csv_file
+from scheduler import Scheduler
+from writer import dataframe_to_csv_saver
+
+FRAMES = {
+    "timestamp index": pd.DataFrame({"discharge": [1.5, 2.25, np.nan]}, index=pd.Index(pd.date_range("2000-01-01", periods=3), name="tstamp")),
+    "unnamed index": pd.DataFrame({"tstamp": pd.date_range("2000-01-01 06:00", periods=3, freq="h"), "discharge": [1, 2, 3]}),
+    "timezone": pd.DataFrame({"tstamp": pd.date_range("2000-01-01", periods=3, tz="UTC"), "discharge": [1, 2, 3]}),
+    "multi index": pd.DataFrame({"discharge": [1, 2, 3]}, index=pd.MultiIndex.from_tuples([("a", 1), ("a", 2), ("b", 1)], names=["station", "n"])),
+    "text": pd.DataFrame({"name": ["x", None, 'quoted, "text"'], "discharge": [1.0, 2.0, 3.0]}),
+}
+
+
+@pytest.mark.parametrize("name", FRAMES)
+def test_pandas_frames_are_written_like_to_csv(tmp_path, name):
+    target = tmp_path / "out.csv"
+    dataframe_to_csv_saver(FRAMES[name], str(target))
+
+    assert target.read_text() == FRAMES[name].to_csv()
+
+
+def test_dask_partitions_are_appended_with_one_header(tmp_path):
+    data = pd.DataFrame({"discharge": np.arange(1000) * 0.5}, index=pd.Index(pd.date_range("2000-01-01", periods=1000, freq="h"), name="tstamp"))
+    partitioned = dd.from_pandas(data, npartitions=7)
+    target = tmp_path / "out.csv"
+    dataframe_to_csv_saver(partitioned, str(target))
+
+    lines = target.read_text().splitlines()
+    assert partitioned.npartitions == 7
+    assert lines.count("tstamp,discharge") == 1
+    assert len(lines) == 1001
+    assert lines == data.to_csv().splitlines()
+
+
+@pytest.mark.parametrize("timestamps", [["2000-01-01", "2000-01-02"], ["2000-01-01 00:00:00", "2000-01-01 06:30:00"]])
+def test_csv_engines_write_the_same_timestamps(tmp_path, make_entry, make_params, timestamps):
+    source = tmp_path / "discharge_DE1.csv"
+    source.write_text("tstamp,q\n" + "".join(f"{ts},{n}.5\n" for n, ts in enumerate(timestamps)))
+    entry = make_entry(str(source), ["q"], source_type="CSV", time_dim="tstamp")
+
+    outputs = {}
+    for engine in ("pandas", "polars"):
+        params = make_params(base_path=str(tmp_path / engine), csv_engine=engine)
+        executor = Scheduler(io_workers=1, cpu_workers=1)
+        target_name = load_csv_file(entry, executor, params)
+        executor.shutdown()
+        outputs[engine] = pl.read_csv(params.dataset_path / target_name, infer_schema=False)
+
+    assert outputs["pandas"].equals(outputs["polars"])
+    assert outputs["pandas"]["tstamp"].to_list() == timestamps